@@ -1,10 +1,11 @@
 import asyncio
 import sys
 from asyncio import Task
-from collections.abc import Iterable
+from collections import deque
+from collections.abc import Iterable, Mapping
 from datetime import UTC, datetime
 from enum import IntEnum
-from typing import Annotated, Awaitable, Coroutine, Literal, override
+from typing import Annotated, Coroutine, Literal, override
 
 import msgspec
 import valkey.asyncio as valkey
@@ -19,6 +20,31 @@ type DateTimeUTC = Annotated[datetime, ...]
 
 print_err = lambda *x: print(*x, file=sys.stderr)
 
+# Cache data layout: one hash per category. Fields, sensors: "{device_name}:{sensor_id}", relays: "{device_name}"
+CACHE_SENSORS = "sensors"
+CACHE_RELAYS = "relays"
+# Last time each sensor published, "{device_name}:{sensor_id}" -> epoch milliseconds. Also for unchanged readings,
+# which are only seen by readers through this (and the view/stream timestamps), not in the "sensors" hash.
+CACHE_SENSORS_SEEN = "sensors:seen"
+# Pre-rendered /data/sensors json. Hash with fields "version" and "json", always written together.
+CACHE_SENSORS_VIEW = "view:sensors"
+# Pub/sub channels for live updates. Every message is a json array of SensorData or StatusData.
+CHANNEL_SENSORS = "updates:sensors"
+CHANNEL_RELAYS = "updates:relays"
+# Versions of last-write-wins hash fields, e.g. "sensors:version". Used when several sensor_listener workers write.
+CACHE_VERSION_SUFFIX = ":version"
+
+# KEYS: hash, version hash. ARGV: field, version, value, ... Fields are only written if the version is not older.
+HSET_IF_NEWER = """
+for i = 1, #ARGV, 3 do
+    local current = redis.call("HGET", KEYS[2], ARGV[i])
+    if not current or tonumber(ARGV[i + 1]) >= tonumber(current) then
+        redis.call("HSET", KEYS[2], ARGV[i], ARGV[i + 1])
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 2])
+    end
+end
+"""
+
 
 class MeasurementTypes(IntEnum):
     TEMPERATURE = 0
@@ -26,21 +52,49 @@ class MeasurementTypes(IntEnum):
     AIRPRESSURE = 2
 
 
+# Valid (min, max) per measurement, inclusive
+MEASUREMENT_RANGES: dict[MeasurementTypes, tuple[float, float]] = {
+    MeasurementTypes.TEMPERATURE: (-50, 60),
+    MeasurementTypes.HUMIDITY: (0, 100),
+    MeasurementTypes.AIRPRESSURE: (800, 1300),
+}
+
+
 class MQTTPacket(msgspec.Struct):
     topic: str
     payload: bytes
     retain: bool = False
 
 
-class SensorData(msgspec.Struct):
-    date: str  # isoformat
+# Inter-location link frame: several readings in one msgpack publish to "{location}/batch", as list[LinkReading]
+LINK_BATCH_TOPIC = "batch"
+
+
+class LinkReading(msgspec.Struct, array_like=True, gc=False):
+    topic: str  # Without the location
+    payload: bytes
+
+
+# Cached SensorData layout. 1: isoformat "date", 2: epoch milliseconds "timestamp"
+SENSOR_DATA_VERSION = 2
+
+
+class SensorData(msgspec.Struct, omit_defaults=True):
     location: str
     device_name: str
     sensor_id: int
     data: dict[str, float]
+    timestamp: int = 0  # epoch milliseconds
+    version: int = 1
+    date: str | None = None  # isoformat, version 1 only
+
+    def __post_init__(self):  # Version 1 records are converted when decoded
+        if self.date is not None:
+            self.timestamp = int(datetime.fromisoformat(self.date).timestamp() * 1000)
+            self.date, self.version = None, SENSOR_DATA_VERSION
 
     def to_dict(self):
-        return dict(date=self.date, data=self.data)
+        return dict(date=unixtime_to_isofmtZ(self.timestamp / 1000), timestamp=self.timestamp, data=self.data)
 
 
 class StatusData(msgspec.Struct):
@@ -80,6 +134,33 @@ class ValkeyBasic(valkey.Valkey):
     async def set(self, key: str | bytes, value: bytes) -> bool:
         return await super().set(key, value)
 
+    async def set_batch(
+        self,
+        keys: Mapping[str, bytes],
+        hashes: Mapping[str, Mapping[str, bytes]],
+        publish: Mapping[str, bytes] | None = None,
+        versioned: Mapping[str, Mapping[str, tuple[int, bytes]]] | None = None,
+    ) -> None:
+        """MSET, HSETs and PUBLISHes (after the writes) in a single round trip.
+        versioned: {hash: {field: (version, value)}}, only written if newer than the stored version (< 2**53)."""
+        async with self.pipeline(transaction=False) as pipe:
+            if keys:
+                pipe.mset(keys)  # type: ignore
+            for name, fields in hashes.items():
+                pipe.hset(name, mapping=fields)  # type: ignore
+            for name, versions in (versioned or {}).items():
+                args = [arg for field, (version, value) in versions.items() for arg in (field, version, value)]
+                pipe.eval(HSET_IF_NEWER, 2, name, name + CACHE_VERSION_SUFFIX, *args)  # type: ignore
+            for channel, message in (publish or {}).items():
+                pipe.publish(channel, message)  # type: ignore
+            await pipe.execute()
+
+    async def hash_values(self, name: str) -> list[bytes]:
+        return await super().hvals(name)  # type: ignore
+
+    async def hash_get_many(self, name: str, *fields: str) -> list[bytes | None]:
+        return await super().hmget(name, fields)  # type: ignore
+
     @override
     async def keys(self, pattern: str | bytes) -> list[bytes]:
         return await super().keys(pattern)
@@ -89,10 +170,128 @@ class ValkeyBasic(valkey.Valkey):
         await super().aclose()
 
 
-def fire_forget_coro(coro: Coroutine | Awaitable, name: str | None = None, _tasks: set[Task] = set()):
-    task = asyncio.create_task(coro, name=name)  # type: ignore
-    _tasks.add(task)
-    task.add_done_callback(_tasks.discard)
+class TaskStats(msgspec.Struct):
+    pending: int = 0  # Waiting for a free slot
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+    dropped: int = 0  # Rejected due to a full pending queue
+    last_error: str | None = None
+
+
+class TaskCategory:  # Runs at most max_running tasks, queues up to max_pending, drops the rest.
+    __slots__ = ("name", "max_running", "max_pending", "stats", "_queue", "_tasks", "_slot_free")
+
+    def __init__(self, name: str, max_running: int, max_pending: int):
+        if max_running <= 0 or max_pending < 0:
+            raise ValueError("max_running has to be positive and max_pending non-negative")
+        self.name = name
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self.stats = TaskStats()
+        self._queue: deque[Coroutine] = deque()
+        self._tasks: set[Task] = set()
+        self._slot_free = asyncio.Event()
+
+    def spawn(self, coro: Coroutine) -> bool:
+        """Drop policy: start now, queue, or close the coroutine and return False."""
+        if self.stats.running < self.max_running:
+            self._start(coro)
+        elif len(self._queue) < self.max_pending:
+            self._queue.append(coro)
+            self.stats.pending += 1
+        else:
+            coro.close()
+            self.stats.dropped += 1
+            return False
+        return True
+
+    async def submit(self, coro: Coroutine) -> None:
+        """Backpressure policy: wait until a slot is free, then start. Closes the coroutine if cancelled meanwhile."""
+        try:
+            while self.stats.running >= self.max_running or self._queue:
+                self._slot_free.clear()
+                await self._slot_free.wait()
+        except BaseException:
+            coro.close()
+            raise
+        self._start(coro)
+
+    async def join(self, cancel=False) -> None:
+        if cancel:
+            while self._queue:
+                self._queue.popleft().close()
+                self.stats.pending -= 1
+            for task in self._tasks:
+                task.cancel()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self, coro: Coroutine):
+        task = asyncio.create_task(coro, name=self.name)
+        self._tasks.add(task)
+        self.stats.running += 1
+        task.add_done_callback(self._done)
+
+    def _done(self, task: Task):
+        self._tasks.discard(task)
+        self.stats.running -= 1
+        if task.cancelled():
+            pass
+        elif exc := task.exception():
+            self.stats.failed += 1
+            self.stats.last_error = repr(exc)
+            print_err(f"Task category {self.name}:", exc)
+        else:
+            self.stats.completed += 1
+
+        if self._queue:
+            self.stats.pending -= 1
+            self._start(self._queue.popleft())
+        else:
+            self._slot_free.set()
+
+
+class TaskSupervisor:
+    __slots__ = ("default_max_running", "default_max_pending", "_categories")
+
+    def __init__(self, default_max_running: int = 64, default_max_pending: int = 1024):
+        self.default_max_running = default_max_running
+        self.default_max_pending = default_max_pending
+        self._categories: dict[str, TaskCategory] = {}
+
+    def configure(self, name: str, max_running: int, max_pending: int = 0) -> TaskCategory:
+        if name in self._categories:
+            category = self._categories[name]
+            category.max_running = max_running
+            category.max_pending = max_pending
+        else:
+            category = self._categories[name] = TaskCategory(name, max_running, max_pending)
+        return category
+
+    def category(self, name: str) -> TaskCategory:
+        if (category := self._categories.get(name)) is None:
+            category = self.configure(name, self.default_max_running, self.default_max_pending)
+        return category
+
+    def spawn(self, name: str, coro: Coroutine) -> bool:
+        return self.category(name).spawn(coro)
+
+    async def submit(self, name: str, coro: Coroutine) -> None:
+        await self.category(name).submit(coro)
+
+    def stats(self) -> dict[str, TaskStats]:
+        return {name: category.stats for name, category in self._categories.items()}
+
+    async def close(self, cancel=False) -> None:
+        await asyncio.gather(*(category.join(cancel) for category in self._categories.values()))
+
+
+task_supervisor = TaskSupervisor()
+
+
+def fire_forget_coro(coro: Coroutine, name: str = "default") -> bool:
+    return task_supervisor.spawn(name, coro)
 
 
 def datetime_to_isofmtZ(dt: DateTimeUTC, timespec: __TimeSpec = "milliseconds") -> str:
@@ -102,3 +301,7 @@ def datetime_to_isofmtZ(dt: DateTimeUTC, timespec: __TimeSpec = "milliseconds")
 
 def datetime_now_isofmtZ(timespec: __TimeSpec = "milliseconds") -> str:
     return datetime_to_isofmtZ(datetime.now(UTC), timespec=timespec)
+
+
+def unixtime_to_isofmtZ(timestamp: float, timespec: __TimeSpec = "milliseconds") -> str:
+    return datetime_to_isofmtZ(datetime.fromtimestamp(timestamp, UTC), timespec=timespec)
@@ -59,6 +59,22 @@ def internal(dbfilepath: str):
             ON UPDATE CASCADE
             ON DELETE CASCADE
     );
+    CREATE INDEX idx_user_registration_created_date_user ON user_registration(created_date, user_id); -- Keyset pages
+
+    -- Substring search (case-insensitive, 3+ characters), ranked with bm25. Kept in sync with user.
+    CREATE VIRTUAL TABLE user_search USING fts5(user_id, tokenize = 'trigram');
+    CREATE TRIGGER user_search_insert AFTER INSERT ON user
+    BEGIN
+        INSERT INTO user_search (user_id) VALUES (NEW.user_id);
+    END;
+    CREATE TRIGGER user_search_update AFTER UPDATE OF user_id ON user
+    BEGIN
+        UPDATE user_search SET user_id = NEW.user_id WHERE user_id = OLD.user_id;
+    END;
+    CREATE TRIGGER user_search_delete AFTER DELETE ON user
+    BEGIN
+        DELETE FROM user_search WHERE user_id = OLD.user_id;
+    END;
 
     CREATE TABLE role (
         name TEXT PRIMARY KEY NOT NULL COLLATE NOCASE
@@ -138,19 +154,72 @@ def data(dbfilepath: str):
         name      TEXT NOT NULL UNIQUE COLLATE NOCASE
     );
 
-    CREATE TABLE measurements (
-        timestamp   UNIXTIME NOT NULL,
-        device_name TEXT NOT NULL COLLATE NOCASE,
-        sensor_id   INTEGER NOT NULL,
-        type_id     INTEGER NOT NULL,
-        value       REAL NOT NULL,
-        FOREIGN KEY(type_id) REFERENCES measurement_types(type_id)
+    CREATE TABLE device (
+        device_id INTEGER PRIMARY KEY,
+        name      TEXT NOT NULL UNIQUE COLLATE NOCASE
     );
 
+    -- Clustered on the primary key, range queries per sensor need no secondary index
+    CREATE TABLE measurements (
+        device_id INTEGER NOT NULL,
+        sensor_id INTEGER NOT NULL,
+        type_id   INTEGER NOT NULL,
+        timestamp UNIXTIME NOT NULL,
+        value     REAL NOT NULL,
+        FOREIGN KEY(device_id) REFERENCES device(device_id),
+        FOREIGN KEY(type_id) REFERENCES measurement_types(type_id),
+        PRIMARY KEY(device_id, sensor_id, type_id, timestamp)
+    ) WITHOUT ROWID;
+
     CREATE INDEX idx_measurements_timestamp ON measurements (timestamp);
-    CREATE INDEX idx_measurements_sensor ON measurements (sensor_id);
-    CREATE INDEX idx_measurements_sensor_type_time ON measurements (sensor_id, type_id, timestamp);
-    CREATE INDEX idx_measurements_type_time ON measurements (type_id, timestamp);
+
+    -- Written by sensor_listener, one row per sensor and type every window. Disabled aggregates are NULL.
+    CREATE TABLE measurement_windows (
+        window_start UNIXTIME NOT NULL,
+        window_sec   INTEGER NOT NULL,
+        device_name  TEXT NOT NULL COLLATE NOCASE,
+        sensor_id    INTEGER NOT NULL,
+        type_id      INTEGER NOT NULL,
+        count        INTEGER NOT NULL,
+        min          REAL,
+        max          REAL,
+        sum          REAL,
+        last         REAL,
+        last_ts      UNIXTIME,  -- Of the reading in last, workers merge their windows by it
+        FOREIGN KEY(type_id) REFERENCES measurement_types(type_id),
+        PRIMARY KEY(device_name, sensor_id, type_id, window_start)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_measurement_windows_time ON measurement_windows (window_start);
+
+    -- Maintained by the scheduler, see services/scheduler/rollups.py
+    CREATE TABLE measurements_hourly (
+        bucket_start UNIXTIME NOT NULL,
+        device_name  TEXT NOT NULL COLLATE NOCASE,
+        sensor_id    INTEGER NOT NULL,
+        type_id      INTEGER NOT NULL,
+        count        INTEGER NOT NULL,
+        min          REAL,
+        max          REAL,
+        sum          REAL,
+        PRIMARY KEY(device_name, sensor_id, type_id, bucket_start)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE measurements_daily (
+        bucket_start UNIXTIME NOT NULL,
+        device_name  TEXT NOT NULL COLLATE NOCASE,
+        sensor_id    INTEGER NOT NULL,
+        type_id      INTEGER NOT NULL,
+        count        INTEGER NOT NULL,
+        min          REAL,
+        max          REAL,
+        sum          REAL,
+        PRIMARY KEY(device_name, sensor_id, type_id, bucket_start)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE rollup_state (
+        name       TEXT PRIMARY KEY NOT NULL,
+        high_water UNIXTIME NOT NULL
+    );
     """
 
     from appdata.shared import MeasurementTypes
@@ -171,9 +240,11 @@ def app(dbfilepath: str):
 
     from services.api.core import enums
     from services.api.storage.db.repositories.user_account_repository import (
+        NewUser,
         UserAccountRepository,
     )
     from services.api.storage.db.repositories.user_role_repository import (
+        NewRole,
         UserRoleRepository,
     )
     from services.api.storage.db.sql import sqlite
@@ -192,27 +263,20 @@ def app(dbfilepath: str):
         repo_account = UserAccountRepository(db)
         repo_role = UserRoleRepository(db)
         try:
-            for user in CONFIG["api"]["users"]:
-                roles = [enums.UserRoles(role) for role in user["roles"]]
-                user_id = await repo_account.create_user(
-                    login_name=user["name"],
-                    login_mail=None,
-                    password_hash=helpers.hash_password_b64(user["password"]),
-                    enabled=True,
-                    created_by=None,
-                )
-                await asyncio.gather(
-                    *(
-                        repo_role.insert_user_role(
-                            user_id=user_id,
-                            role=role,
-                            valid_from=None,
-                            valid_to=None,
-                            given_by=None,
-                        )
-                        for role in roles
-                    )
-                )
+            users = CONFIG["api"]["users"]
+            password_hashes = await helpers.hash_passwords_b64_threaded(user["password"] for user in users)
+            user_ids = await repo_account.create_users(
+                [NewUser(user["name"], None, pwd_hash, True) for user, pwd_hash in zip(users, password_hashes)]
+            )
+            roles = []
+            for user, user_id in zip(users, user_ids):
+                if isinstance(user_id, Exception):
+                    print("exc", user["name"], user_id, file=sys.stderr)
+                    continue
+                roles.extend(NewRole(user_id, enums.UserRoles(role), None, None) for role in user["roles"])
+            for role, error in zip(roles, await repo_role.insert_user_roles(roles)):
+                if error is not None:
+                    print("exc", role.user_id, role.role, error, file=sys.stderr)
         except Exception as e:
             print("exc", e, file=sys.stderr)
         finally:
@@ -88,13 +88,17 @@ app = Litestar(
         "acl_service": Provide(dependencies.provide_acl_service),
         "auth_service": Provide(dependencies.provide_auth_service),
         "ban_service": Provide(dependencies.provide_ban_service),
+        "measurement_service": Provide(dependencies.provide_measurement_service),
         "meta_service": Provide(dependencies.provide_meta_service),
         "registration_service": Provide(dependencies.provide_registration_service),
         "role_service": Provide(dependencies.provide_role_service),
         "token_service": Provide(dependencies.provide_token_service),
         "user_service": Provide(dependencies.provide_user_service),
+        "stream_service": Provide(dependencies.provide_stream_service),
         # Caches
         "data_cache": Provide(dependencies.provide_data_cache),
+        # Metrics
+        "db_stats": Provide(dependencies.provide_db_stats),
     },
     on_startup=[startup],
     on_shutdown=[shutdown],
@@ -0,0 +1,83 @@
+"""
+Compares decoding result sets into table Structs: aiosqlite.Row + msgspec.convert per row (legacy) against plain tuples
+decoded as one batch by RowDecoder. Reads go through SQLite's reader pool, on a temporary app database.
+
+python3 bench_rows.py [rows=10000] [rounds=20]
+"""
+
+__import__("sys").path.append("/")
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import msgspec
+
+from storage.db import tables
+from storage.db.sql.rows import RowDecoder
+from storage.db.sql.sqlite import SQLite
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage/db/sql/schema.sql")
+
+
+def make_database(path: str, rows: int):
+    now = "2026-01-01T00:00:00.000Z"
+    conn = sqlite3.connect(path)
+    conn.executescript(open(SCHEMA).read())
+    conn.execute("INSERT INTO user VALUES (?,?,?,?,?,?,?)", ("bench", "bench", None, "hash", True, now, now))
+    conn.executemany(
+        "INSERT INTO service (name, url, description, created_date) VALUES (?,?,?,?)",
+        ((f"service{i}", f"https://service{i}", "bench", now) for i in range(rows)),
+    )
+    conn.executemany(
+        "INSERT INTO has_service (user_id, service_name, rwx, valid_from, valid_to, given_by, created_date)"
+        " VALUES (?,?,?,?,?,?,?)",
+        (
+            ("bench", f"service{i}", 7, "1970-01-01T00:00:00.000Z", "9999-12-31T23:59:59.000Z", None, now)
+            for i in range(rows)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+async def main(rows: int, rounds: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        make_database(os.path.join(tmp, "app.db"), rows)
+        db = SQLite(os.path.join(tmp, "app.db"))
+        try:
+            for table in (tables.Service, tables.Has_Service):
+                decoder = RowDecoder(table)
+                query = f"SELECT {decoder.columns} FROM {table.__name__}"
+
+                async def legacy():
+                    return [msgspec.convert(row, type=table, strict=False) for row in await db.fetch_all(query)]
+
+                async def batch():
+                    return await db.fetch_structs(decoder, query)
+
+                assert await legacy() == await batch()
+                print(f"{table.__name__}, {rows} rows")
+                for name, func in (("legacy", legacy), ("batch", batch)):
+                    timings: list[float] = []
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        await func()
+                        timings.append((time.perf_counter() - start) * 1000)
+                    timings.sort()
+                    print(f"{name:>8}: median {timings[len(timings) // 2]:8.2f} ms, min {timings[0]:8.2f} ms")
+        finally:
+            await db.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(
+        main(
+            rows=int(args[0]) if len(args) > 0 else 10_000,
+            rounds=int(args[1]) if len(args) > 1 else 20,
+        )
+    )
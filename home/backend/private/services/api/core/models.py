@@ -83,8 +83,23 @@ class AllUserView(Struct):
     roles: list[enums.UserRoles]
 
 
+class BulkResult(Struct, omit_defaults=True):
+    """One per item of a bulk request, in order. error is set if the item was left out"""
+
+    user_id: types.UserID | None = None
+    error: str | None = None
+
+
 # class UserBasic(Struct):
 #     user_id: int
 #     login_name: str
 #     login_mail: str
 #     login_mail: str
+
+
+class HistoryPoint(Struct, array_like=True, gc=False):  # [timestamp, mean, min, max, count]
+    timestamp: types.Unixtime  # Bucket start
+    mean: float | None
+    min: float | None
+    max: float | None
+    count: int
@@ -23,6 +23,8 @@ INTERNAL_MQTT_DEVICES_SETTINGS = __CONFIG_FILE["mqtt"]["publish"]
 
 
 MIN_PASSWORD_LENGTH = 8
+MAX_BULK_ITEMS = 1000  # Per bulk request
+MAX_BULK_USERS = 100  # Per bulk user request, every password is hashed with bcrypt on the process pool
 
 CACHE_DEFAULT_EXPIRY = 300  # seconds
 # CACHE_TOKEN_EXPIRY = int(timedelta(days=7).total_seconds())
@@ -5,24 +5,28 @@ from litestar import Litestar
 from services.acl_service import AclService
 from services.auth_service import AuthService
 from services.ban_service import BanService
+from services.measurement_service import MeasurementService
 from services.meta_service import MetaService
 from services.registration_service import RegistrationService
 from services.role_service import RoleService
+from services.stream_service import StreamService
 from services.token_service import TokenService
 from services.user_service import UserService
 from storage.cache.valkeyCacheClient import ValkeyCacheClient
+from storage.db.repositories.measurement_repository import MeasurementRepository
 from storage.db.repositories.user_account_repository import UserAccountRepository
 from storage.db.repositories.user_acl_repository import UserACLRepository
 from storage.db.repositories.user_ban_repository import UserBanRepository
 from storage.db.repositories.user_meta_repository import UserMetaRepository
 from storage.db.repositories.user_profile_repository import UserProfileRepository
 from storage.db.repositories.user_role_repository import UserRoleRepository
-from storage.db.sql.sqlite import SQLite
+from storage.db.sql.sqlite import SQLite, WriterStats
 from valkey.asyncio import Valkey
 
 from appdata import shared  # type: ignore
 
 __db_app_client = SQLite(dbfile=paths.DATA_PATH + paths.DB_APP, pool_size=10)
+__db_data_client = SQLite(dbfile=paths.DATA_PATH + paths.DB_DATA, pool_size=2)
 __cache_app_client = Valkey(unix_socket_path="/mem/cache_app")  # Used as an attribute
 __cache_api_client = Valkey(unix_socket_path="/mem/cache_api")  # Used as an attribute
 __cache_online_users_counter_client = Valkey(unix_socket_path="/mem/cache_data", db=1)  # Used as an attribute
@@ -30,6 +34,7 @@ __cache_data_client = shared.ValkeyBasic(unix_socket_path="/mem/cache_data")
 
 # Repositories
 __repo_account = UserAccountRepository(__db_app_client)
+__repo_measurement = MeasurementRepository(__db_data_client)
 __repo_acl = UserACLRepository(__db_app_client)
 __repo_ban = UserBanRepository(__db_app_client)
 __repo_meta = UserMetaRepository(__db_app_client, __cache_online_users_counter_client)
@@ -37,8 +42,13 @@ __repo_profile = UserProfileRepository(__db_app_client)
 __repo_role = UserRoleRepository(__db_app_client)
 
 _cache_app = ValkeyCacheClient(__cache_app_client, prefix="app", default_ttl=settings.CACHE_DEFAULT_EXPIRY)
+_update_stream = StreamService(__cache_data_client, channels=(shared.CHANNEL_SENSORS, shared.CHANNEL_RELAYS))
 _cache_token = ValkeyCacheClient(__cache_app_client, prefix="tok", default_ttl=settings.CACHE_DEFAULT_EXPIRY)
 
+# Background tasks. Online marker is best effort, login dates rather wait in a deep queue than be dropped.
+shared.task_supervisor.configure("online_users", max_running=16, max_pending=256)
+shared.task_supervisor.configure("login_date", max_running=4, max_pending=4096)
+
 
 def get_api_cache_client() -> Valkey:
     return __cache_api_client
@@ -48,13 +58,24 @@ async def provide_data_cache() -> shared.ValkeyBasic:
     return __cache_data_client
 
 
+async def provide_db_stats() -> dict[str, WriterStats]:
+    return {"app": __db_app_client.stats, "data": __db_data_client.stats}
+
+
+async def provide_stream_service() -> StreamService:
+    return _update_stream
+
+
 async def start(app: Litestar):
-    pass
+    _update_stream.start()
 
 
 async def close():
+    await shared.task_supervisor.close()
+    await _update_stream.close()
     await asyncio.gather(
         __db_app_client.close(),
+        __db_data_client.close(),
         __cache_app_client.aclose(),
         __cache_data_client.aclose(),
         __cache_api_client.aclose(),
@@ -74,6 +95,10 @@ async def provide_ban_service() -> BanService:
     return BanService(token_service=await provide_token_service(), repo_ban=__repo_ban)
 
 
+async def provide_measurement_service() -> MeasurementService:
+    return MeasurementService(repo_measurement=__repo_measurement)
+
+
 async def provide_meta_service() -> MetaService:
     return MetaService(repo_meta=__repo_meta)
 
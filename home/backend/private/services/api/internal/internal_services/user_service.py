@@ -2,11 +2,13 @@ import asyncio
 from typing import Unpack
 
 import msgspec
+from core import exceptions
 from internal import internal_models
 from internal.storage.repositories.internal_user_repository import (
     InternalUserRepository,
 )
 from storage.cache.valkeyCacheClient import ValkeyCacheClient
+from storage.db.sql import keyset
 from utils import cache_helpers
 
 from appdata import internal_shared  # type: ignore
@@ -53,8 +55,18 @@ class InternalUserService(msgspec.Struct):
     async def search_user(self, search_term: str):
         return await self.repo_user.search_user(search_term)
 
-    async def get_all_users_view(self):
-        return await self.repo_user.get_all_users_view()
+    async def get_all_users_view(self, limit: int, cursor: str | None = None):
+        """
+        Returns the page and an opaque cursor to the next, None on the last page.
+
+        Raises:
+            UserInputError
+        """
+        if limit <= 0:
+            raise exceptions.UserInputError("Invalid limit given")
+        after = None if cursor is None else keyset.decode(cursor, tuple[str, str])
+        users, last = await self.repo_user.get_all_users_view(limit, after)
+        return users, None if last is None else keyset.encode(*last)
 
     async def get_all_user_view(self, username: str):
         return await self.repo_user.get_all_user_view(username)
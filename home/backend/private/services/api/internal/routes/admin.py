@@ -6,6 +6,7 @@ from internal.internal_services.user_service import InternalUserService
 from internal.storage import internal_tables
 from litestar import delete, get, patch, post
 from litestar.controller import Controller
+from litestar.response import Response
 from litestar.exceptions import (
     ClientException,
     NotFoundException,
@@ -40,15 +41,21 @@ class AdminController(Controller):
     async def get_users(self, internal_user_service: InternalUserService) -> list[internal_tables.User]:
         return await internal_user_service.get_users()
 
-    @get(path="/all_users", cache=60)
+    @get(path="/all_users", cache=60, raises=[ClientException])
     async def get_users_view(
         self,
         internal_user_service: InternalUserService,
         search: str | None = None,
-    ) -> list[internal_models.AllUserView]:
+        limit: int = 100,
+        cursor: str | None = None,  # From the X-Next-Cursor header of the previous page
+    ) -> Response[list[internal_models.AllUserView]]:
         if search:
-            return await internal_user_service.search_user(search)
-        return await internal_user_service.get_all_users_view()
+            return Response(await internal_user_service.search_user(search))
+        try:
+            users, next_cursor = await internal_user_service.get_all_users_view(limit, cursor)
+        except exceptions.UserInputError as e:
+            raise ClientException(str(e)) from e
+        return Response(users, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
 
     @get(path="/{username:str}")
     async def get_user_view(
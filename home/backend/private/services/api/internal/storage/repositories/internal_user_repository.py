@@ -8,11 +8,15 @@ from core import exceptions, paths
 from internal import internal_models
 from internal.storage import internal_tables
 from internal.storage.sqlite_basic import INTERNALSQLite
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 from utils import helpers, validation
 
 from appdata import internal_shared, shared  # type:ignore
 
+USER_ROW = RowDecoder(internal_tables.User)
+HAS_ROLE_ROW = RowDecoder(internal_tables.Has_Role)
+
 
 class InternalUserRepository(msgspec.Struct, gc=False):
     db: SQLite | INTERNALSQLite
@@ -79,18 +83,15 @@ class InternalUserRepository(msgspec.Struct, gc=False):
     # region: Read
 
     async def get_user(self, username: str):
-        query = f"SELECT * FROM {internal_tables.User.__name__} WHERE user_id = ?"
-        if row := await self.db.fetch_one(query, (username,)):
-            return msgspec.convert(row, type=internal_tables.User)
+        query = f"SELECT {USER_ROW.columns} FROM {internal_tables.User.__name__} WHERE user_id = ?"
+        return await self.db.fetch_struct(USER_ROW, query, (username,))
 
     async def get_users(self):
-        rows = await self.db.fetch_all(f"SELECT * FROM {internal_tables.User.__name__}")
-        return [msgspec.convert(row, type=internal_tables.User) for row in rows]
+        return await self.db.fetch_structs(USER_ROW, f"SELECT {USER_ROW.columns} FROM {internal_tables.User.__name__}")
 
     async def get_user_has_roles(self, username: str):
-        query = f"SELECT * FROM {internal_tables.Has_Role.__name__} WHERE user_id = ?"
-        rows = await self.db.fetch_all(query, (username,))
-        return [msgspec.convert(row, type=internal_tables.Has_Role) for row in rows]
+        query = f"SELECT {HAS_ROLE_ROW.columns} FROM {internal_tables.Has_Role.__name__} WHERE user_id = ?"
+        return await self.db.fetch_structs(HAS_ROLE_ROW, query, (username,))
 
     async def get_user_roles(self, username: str):
         """Only get if user is already authed!"""
@@ -102,16 +103,42 @@ class InternalUserRepository(msgspec.Struct, gc=False):
         query = f"SELECT 1 FROM {internal_tables.User.__name__} WHERE user_id = ?"
         return await self.db.fetch_one(query, (username,)) is not None
 
-    async def get_all_users_view(self):
-        rows = await self.db.fetch_all(_get_all_user_view_query("ORDER BY ur.created_date"))
-        return [_alluserview_query_row_to_struct(row) for row in rows]
+    async def get_all_users_view(self, limit: int, after: tuple[str, str] | None = None):
+        """
+        Ordered by (registration date, user_id), continues after the key of the previous page's last row.
+
+        Returns:
+            The page, and the key of its last row if more rows follow.
+        """
+        if after is None:
+            query = _get_all_user_view_query(f"{_PAGE_ORDER} LIMIT ?", _VIEW_ORDER)
+            params: tuple = (limit + 1,)
+        else:
+            query = _get_all_user_view_query(f"{_PAGE_AFTER} {_PAGE_ORDER} LIMIT ?", _VIEW_ORDER)
+            params = (*after, limit + 1)
+        rows = list(await self.db.fetch_all(query, params))
+        if len(rows) <= limit:
+            return [_alluserview_query_row_to_struct(row) for row in rows], None
+        del rows[limit:]
+        return [_alluserview_query_row_to_struct(row) for row in rows], (rows[-1]["created_date"], rows[-1]["user_id"])
 
     async def get_all_user_view(self, username: str):
-        if row := await self.db.fetch_one("WHERE user_id = ?", (username,)):
+        if row := await self.db.fetch_one(_get_all_user_view_query("WHERE u.user_id = ?"), (username,)):
             return _alluserview_query_row_to_struct(row)
 
     async def search_user(self, search_term: str):
-        rows = await self.db.fetch_all("WHERE u.user_id LIKE ? COLLATE NOCASE", (f"%{search_term}%",))
+        """Search of 3+ characters uses user_search, best match first"""
+        if len(search_term) < 3:  # Shortest trigram match
+            query = _get_all_user_view_query("WHERE u.user_id LIKE ? COLLATE NOCASE", "ORDER BY u.user_id")
+            params = (f"%{search_term}%",)
+        else:
+            query = _get_all_user_view_query(
+                "JOIN (SELECT user_id, rank FROM user_search WHERE user_search MATCH ?) s ON u.user_id = s.user_id",
+                "ORDER BY u.rank",
+                ", s.rank",
+            )
+            params = (f'"{search_term.replace('"', '""')}"',)  # One phrase, FTS5 query syntax is escaped
+        rows = await self.db.fetch_all(query, params)
         return [_alluserview_query_row_to_struct(row) for row in rows]
 
     async def get_serving_service(self, username: str) -> list[str]:
@@ -168,46 +195,46 @@ class InternalUserRepository(msgspec.Struct, gc=False):
 # region: Helpers
 
 
-def _get_all_user_view_query(query_filter: str = ""):
+_PAGE_ORDER = "ORDER BY reg.created_date, u.user_id"
+_VIEW_ORDER = "ORDER BY u.created_date, u.user_id"
+_PAGE_AFTER = "WHERE (reg.created_date, u.user_id) > (?, ?)"
+
+
+def _get_all_user_view_query(query_filter: str = "", order_by: str = "", columns: str = ""):
     """
+    Roles and services are aggregated for the users of the page only.
     `Tables`:
-        `ur`: User_Registration
+        `reg`: User_Registration
         `u`: User
     """
     return (
-        " WITH roles_agg AS ("
-        "   SELECT user_id, json_group_array(role_name) AS roles"
-        f"  FROM {internal_tables.Has_Role.__name__}"
-        "   GROUP BY user_id"
-        " ),"
-        " WITH serving_agg AS ("
-        "   SELECT user_id, json_group_array(LOWER(service_name)) AS services"
-        f"  FROM {internal_tables.Service_Ownership.__name__}"
-        "   GROUP BY user_id"
-        " ),"
-        " paged_users AS ("
-        "   SELECT u.user_id, u.enabled, reg.created_date"
+        " WITH paged_users AS ("
+        f"  SELECT u.user_id, u.enabled, reg.created_date{columns}"
         f"  FROM {internal_tables.User.__name__} u"
         f"  JOIN {internal_tables.User_Registration.__name__} reg ON u.user_id = reg.user_id"
         f"  {query_filter}"
         " )"
-        " SELECT "
+        " SELECT"
         "   u.user_id,"
         "   u.enabled,"
         "   u.created_date,"
-        "   COALESCE(r.roles, '[]') AS roles"
-        "   COALESCE(s.services, '[]') AS services"
+        "   (SELECT json_group_array(role_name)"
+        f"     FROM {internal_tables.Has_Role.__name__} WHERE user_id = u.user_id) AS roles,"
+        "   (SELECT json_group_array(LOWER(service_name))"
+        f"     FROM {internal_tables.Service_Ownership.__name__} WHERE user_id = u.user_id) AS services"
         " FROM paged_users u"
-        " LEFT JOIN roles_agg r ON u.user_id = r.user_id"
-        " LEFT JOIN serving_agg s ON u.user_id = s.user_id"
+        f" {order_by}"
     )
 
 
-def _alluserview_query_row_to_struct(row: dict[str, Any]):
-    # for s in ("roles", "services"):
-    #     concat_row: str = row[s]
-    #     row[s] = concat_row.split("|") if concat_row else []
-    return msgspec.convert(row, type=internal_models.AllUserView, strict=False)
+def _alluserview_query_row_to_struct(row: Any):
+    return internal_models.AllUserView(
+        roles=msgspec.json.decode(row["roles"], type=list[internal_shared.InternalRolesEnum]),
+        user_id=row["user_id"],
+        services=msgspec.json.decode(row["services"], type=list[str]),
+        enabled=bool(row["enabled"]),
+        created_date=msgspec.convert(row["created_date"], type=shared.DateTimeUTC),
+    )
 
 
 # endregion
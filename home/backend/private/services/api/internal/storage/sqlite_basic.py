@@ -2,6 +2,8 @@ from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator, Iterable
 
 import aiosqlite
+import msgspec
+from storage.db.sql.rows import RowDecoder
 
 # No pool for this. Expecting low usage. If higher usage, swap for API database
 
@@ -32,6 +34,21 @@ class INTERNALSQLite:
             cur = await conn.execute(query, params)
             return await cur.fetchone()
 
+    async def fetch_structs[T: msgspec.Struct](
+        self, decoder: RowDecoder[T], query: str, params: Iterable[Any] | None = None
+    ) -> list[T]:
+        async with self.connect() as conn:
+            conn.row_factory = None
+            return decoder.all(await conn.execute_fetchall(query, params))
+
+    async def fetch_struct[T: msgspec.Struct](
+        self, decoder: RowDecoder[T], query: str, params: Iterable[Any] | None = None
+    ) -> T | None:
+        async with self.connect() as conn:
+            conn.row_factory = None
+            cur = await conn.execute(query, params)
+            return None if (row := await cur.fetchone()) is None else decoder.one(row)
+
     async def execute_void(self, query: str, params: Iterable[Any]) -> None:
         """Return nothing. Should be for INSERT, UPDATE, DELETE"""
         async with self.connect() as conn:
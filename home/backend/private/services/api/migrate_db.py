@@ -0,0 +1,83 @@
+"""
+Brings existing app and internal databases up to date with schema.sql and gen_db.py. Every step is idempotent,
+the search indexes are rebuilt from their tables.
+
+python3 migrate_db.py [app db, default: $DATA_PATH/$DB_APP] [internal db, default: $DATA_PATH/$DB_INTERNAL]
+"""
+
+import os
+import sqlite3
+import sys
+
+APP = """
+DROP INDEX IF EXISTS idx_registration_created_date;
+CREATE INDEX IF NOT EXISTS idx_registration_created_date_user ON registration(created_date, user_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+    user_id UNINDEXED,
+    login_name,
+    login_mail,
+    display_name,
+    tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS user_search_insert_user AFTER INSERT ON user
+BEGIN
+    INSERT INTO user_search (user_id, login_name, login_mail) VALUES (NEW.user_id, NEW.login_name, NEW.login_mail);
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_update_user AFTER UPDATE OF login_name, login_mail ON user
+BEGIN
+    UPDATE user_search SET login_name = NEW.login_name, login_mail = NEW.login_mail WHERE user_id = NEW.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_delete_user AFTER DELETE ON user
+BEGIN
+    DELETE FROM user_search WHERE user_id = OLD.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_insert_profile AFTER INSERT ON user_profile
+BEGIN
+    UPDATE user_search SET display_name = NEW.display_name WHERE user_id = NEW.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_update_profile AFTER UPDATE OF display_name ON user_profile
+BEGIN
+    UPDATE user_search SET display_name = NEW.display_name WHERE user_id = NEW.user_id;
+END;
+DELETE FROM user_search;
+INSERT INTO user_search (user_id, login_name, login_mail, display_name)
+SELECT u.user_id, u.login_name, u.login_mail, up.display_name
+FROM user u
+LEFT JOIN user_profile up ON u.user_id = up.user_id;
+INSERT INTO user_search (user_search) VALUES ('optimize');
+"""
+
+INTERNAL = """
+CREATE INDEX IF NOT EXISTS idx_user_registration_created_date_user ON user_registration(created_date, user_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(user_id, tokenize = 'trigram');
+CREATE TRIGGER IF NOT EXISTS user_search_insert AFTER INSERT ON user
+BEGIN
+    INSERT INTO user_search (user_id) VALUES (NEW.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_update AFTER UPDATE OF user_id ON user
+BEGIN
+    UPDATE user_search SET user_id = NEW.user_id WHERE user_id = OLD.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_search_delete AFTER DELETE ON user
+BEGIN
+    DELETE FROM user_search WHERE user_id = OLD.user_id;
+END;
+DELETE FROM user_search;
+INSERT INTO user_search (user_id) SELECT user_id FROM user;
+"""
+
+
+def migrate(dbfilepath: str, script: str) -> None:
+    conn = sqlite3.connect(dbfilepath, isolation_level=None)  # Explicit transactions
+    conn.execute("PRAGMA busy_timeout = 10000")
+    conn.executescript(f"BEGIN IMMEDIATE; {script} COMMIT;")
+    conn.close()
+    print(f"Migrated {dbfilepath}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    migrate(args[0] if len(args) > 0 else os.path.join(os.environ["DATA_PATH"], os.environ["DB_APP"]), APP)
+    migrate(args[1] if len(args) > 1 else os.path.join(os.environ["DATA_PATH"], os.environ["DB_INTERNAL"]), INTERNAL)
@@ -1,10 +1,17 @@
 from collections import defaultdict
-from typing import Mapping
+from typing import AsyncGenerator
 
 import msgspec
+from core import exceptions, models, types
 from guards.guards import root_or_local_jwt_guard
-from litestar import get
+from litestar import MediaType, Request, get
 from litestar.controller import Controller
+from litestar.exceptions import ClientException, ValidationException
+from litestar.response import Response, ServerSentEvent, ServerSentEventMessage, Stream
+from litestar.status_codes import HTTP_304_NOT_MODIFIED
+from services.measurement_service import MeasurementService
+from services.stream_service import StreamService
+from utils import time_helpers
 
 from appdata import shared  # type: ignore
 from appdata.shared import SensorData, StatusData  # type: ignore
@@ -20,16 +27,27 @@ class DataController(Controller):
     sensor_decoder = msgspec.msgpack.Decoder(SensorData).decode
     status_decoder = msgspec.msgpack.Decoder(StatusData).decode
 
-    @get(path="/sensors", description="Root-prop: Location\n\nChild-prop: Device")
-    async def get_sensors_data(
-        self, data_cache: shared.ValkeyBasic
-    ) -> Mapping[Location, dict[DeviceName, dict[SensorID, float]]]:
-        all_data = defaultdict(lambda: defaultdict(dict))
-        data = await data_cache.keys("sensor:*")
-        result = await data_cache.get_many(*(x.decode() for x in await data_cache.keys("sensor:*")))
-        for data in (self.sensor_decoder(data) for data in result if data):
-            all_data[data.location][data.device_name][data.sensor_id] = data.to_dict()
-        return all_data
+    @get(
+        path="/sensors",
+        description="Root-prop: Location\n\nChild-prop: Device\n\nSupports If-None-Match with the returned ETag",
+    )
+    async def get_sensors_data(self, request: Request, data_cache: shared.ValkeyBasic) -> Response[bytes]:
+        version, content = await data_cache.hash_get_many(shared.CACHE_SENSORS_VIEW, "version", "json")
+        if version is None or content is None:  # View not rendered (yet), build it from the readings
+            all_data: dict[Location, dict[DeviceName, dict[SensorID, dict]]] = defaultdict(lambda: defaultdict(dict))
+            sensors = list(map(self.sensor_decoder, await data_cache.hash_values(shared.CACHE_SENSORS)))
+            fields = [f"{data.device_name}:{data.sensor_id}" for data in sensors]
+            seen = await data_cache.hash_get_many(shared.CACHE_SENSORS_SEEN, *fields) if fields else []
+            for data, seen_ms in zip(sensors, seen):
+                if seen_ms is not None:  # Unchanged readings only update the seen time
+                    data.timestamp = max(data.timestamp, int(seen_ms))
+                all_data[data.location][data.device_name][data.sensor_id] = data.to_dict()
+            return Response(msgspec.json.encode(all_data), media_type=MediaType.JSON)
+
+        headers = {"ETag": f'"{version.decode()}"', "Cache-Control": "no-cache"}
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return Response(b"", status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content, media_type=MediaType.JSON, headers=headers)
 
     @get(
         path="/relays",
@@ -39,52 +57,69 @@ class DataController(Controller):
     )
     async def get_status(self, data_cache: shared.ValkeyBasic) -> dict[str, dict[str, StatusData]]:
         all_data = defaultdict(dict)
-        result = await data_cache.get_many(*(x.decode() for x in await data_cache.keys("relay:*")))
-        for data in (self.status_decoder(data) for data in result if data):
+        result = await data_cache.hash_values(shared.CACHE_RELAYS)
+        for data in map(self.status_decoder, result):
             all_data[data.location][data.device_name] = data.data
         return all_data
 
-    # @get(path="/sensors/logs", return_dto=MsgspecDTO[SensorData], raises=[ClientException])
-    # async def get_sensors_logs(
-    #     self,
-    #     start: str = "",
-    #     end: str = "",
-    #     limit: int = 10,
-    #     offset: int = 0,
-    #     device: str = "",
-    #     location: str = "",
-    # ) -> list[SensorData]:
-    #     if not (0 < limit <= 1_000_000_000_000 and 0 <= offset <= 1_000_000_000_000):
-    #         raise ClientException("Limit or offset contain invalid values")
-    #     for i in start, end, device, location:
-    #         if len(i) >= 50:
-    #             raise ClientException
+    @get(
+        path="/sensors/history",
+        raises=[ClientException, ValidationException],
+        description=(
+            "Downsampled history, at most [points] rows of [timestamp, mean, min, max, count]."
+            " Dates can be int for unixtimestamps. Default range: the last day"
+        ),
+    )
+    async def get_sensors_history(
+        self,
+        measurement_service: MeasurementService,
+        device: str,
+        sensor_id: int,
+        type: str,
+        start: types.DateTimeStr | types.Unixtime | None = None,
+        end: types.DateTimeStr | types.Unixtime | None = None,
+        points: int = 500,
+    ) -> Stream:
+        try:
+            rows = measurement_service.get_history(
+                device_name=device,
+                sensor_id=sensor_id,
+                measurement_type=type,
+                start=time_helpers.parse_date(start),
+                end=time_helpers.parse_date(end),
+                points=points,
+            )
+        except ValueError as e:
+            raise ValidationException(str(e))
+        except exceptions.UserInputError as e:
+            raise ClientException(str(e))
+        return Stream(self.__json_array(rows), media_type=MediaType.JSON)
+
+    @staticmethod
+    async def __json_array(rows: AsyncGenerator[models.HistoryPoint, None]):
+        encode = msgspec.json.Encoder().encode
+        separator = b"["
+        async for row in rows:
+            yield separator + encode(row)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
 
-    #     qry_args = None
-    #     where = ""
-    #     if device or location:
-    #         if device and location:
-    #             raise ClientException("Either device or location")
-    #         if ":" in device or ":" in location:
-    #             raise ClientException("Invalid device")
-    #         qry_args = {}
-    #         if device:
-    #             qry_args["setting"] = device
-    #             where = "WHERE device_name=$setting"
-    #         elif location:
-    #             qry_args["setting"] = location
-    #             where = "WHERE location=$setting"
+    @get(
+        path="/sensors/stream",
+        description="Server-sent events, event: sensors. Data: json array of updated SensorData",
+    )
+    async def stream_sensors(self, stream_service: StreamService) -> ServerSentEvent:
+        return ServerSentEvent(self.__events(stream_service, shared.CHANNEL_SENSORS))
 
-    #     try:
-    #         if start:
-    #             start = '{date:"%s"}' % datetime_to_isoformat(datetime.fromisoformat(start), "minutes")
-    #         if end:
-    #             end = '{date:"%s"}' % datetime_to_isoformat(datetime.fromisoformat(end), "minutes")
-    #     except:
-    #         raise ClientException("Invalid start and end date format")
-    #     if start and end and (start >= end):
-    #         raise ClientException("Start date is equal or larger to end date")
+    @get(
+        path="/stream",
+        guards=[root_or_local_jwt_guard],
+        description="Server-sent events, event: sensors | relays. Data: json array of updated SensorData | StatusData",
+    )
+    async def stream_all(self, stream_service: StreamService) -> ServerSentEvent:
+        return ServerSentEvent(self.__events(stream_service, shared.CHANNEL_SENSORS, shared.CHANNEL_RELAYS))
 
-    #     ranges = ":" + start + ".." + end if (start or end) else ""
-    #     qry = f"SELECT * FROM sensor{ranges} {where} LIMIT {limit} {f'START {offset}' if offset else ''}"
-    #     return (await self.db.query(qry, qry_args)).data
+    @staticmethod
+    async def __events(stream_service: StreamService, *channels: str):
+        async for channel, message in stream_service.subscribe(*channels):
+            yield ServerSentEventMessage(data=message.decode(), event=channel.rsplit(":", 1)[-1])
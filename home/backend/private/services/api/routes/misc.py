@@ -3,6 +3,10 @@ from guards.guards import root_guard, root_or_local_guard, root_or_local_jwt_gua
 from litestar import get
 from litestar.controller import Controller
 from services.meta_service import MetaService
+from storage.db.sql import queries
+from storage.db.sql.sqlite import WriterStats
+
+from appdata import shared  # type: ignore
 
 
 class MiscController(Controller):
@@ -19,3 +23,15 @@ class MiscController(Controller):
     @get(path="/online_users", cache=20)
     async def online_users(self, meta_service: MetaService) -> int:
         return await meta_service.online_users()
+
+    @get(path="/tasks", guards=[root_guard], description="Background task gauges of this worker")
+    async def background_tasks(self) -> dict[str, shared.TaskStats]:
+        return shared.task_supervisor.stats()
+
+    @get(path="/db", guards=[root_guard], description="Write queue and group commit counters of this worker")
+    async def db_writers(self, db_stats: dict[str, WriterStats]) -> dict[str, WriterStats]:
+        return db_stats
+
+    @get(path="/queries", guards=[root_guard], description="Per statement execution counters of this worker")
+    async def db_queries(self) -> dict[str, queries.QueryStats]:
+        return queries.stats()
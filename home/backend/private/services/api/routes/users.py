@@ -1,7 +1,7 @@
 from typing import Annotated, Any, TypedDict
 
 import msgspec
-from core import enums, exceptions, models, types
+from core import enums, exceptions, models, settings, types
 from core.constants import SECURITY_TAG
 from guards.guards import root_guard, root_or_local_guard, self_userid_or_root_guard
 from litestar import Request, delete, get, patch, post
@@ -14,13 +14,19 @@ from litestar.exceptions import (
     ValidationException,
 )
 from litestar.params import Parameter
+from litestar.response import Response
 from middleware.middlewares import JWTAuthenticationMiddleware
 from services.user_service import UserProfileUpdateFields, UserService, UserUpdateFields
 from storage.db import tables
+from storage.db.repositories.user_acl_repository import NewUserService
+from storage.db.repositories.user_role_repository import NewRole
 from typing_extensions import Annotated
 from utils import time_helpers
 
 
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
 def cache_key_builder(request: Request) -> str:
     return request.url.path + request.headers.get("Authorization", "")
 
@@ -57,6 +63,19 @@ class CreateUser(msgspec.Struct):
     password: str
 
 
+class BulkRolePayload(RolePayload):
+    user_id: types.UserID
+
+
+class BulkACLPayload(ACLPayload):
+    user_id: types.UserID
+
+
+def check_bulk_size(data: list, max_items: int = settings.MAX_BULK_ITEMS):
+    if not data or len(data) > max_items:
+        raise ClientException(f"Between 1 and {max_items} items per request")
+
+
 class UserController(Controller):
     path = "/users"
     tags = ["users"]
@@ -91,6 +110,26 @@ class UserController(Controller):
         except exceptions.IntegrityError as e:
             raise types.AlreadyExists(str(e))
 
+    @post(
+        path="/bulk",
+        guards=[root_guard],
+        status_code=200,
+        description="Creates the valid users in one transaction. Returns [user_id] or [error] per user, in order",
+        raises=[ClientException],
+    )
+    async def create_users(
+        self,
+        request: types.AuthRequest,
+        user_service: UserService,
+        data: list[CreateUser],
+    ) -> list[models.BulkResult]:
+        check_bulk_size(data, settings.MAX_BULK_USERS)
+        return await user_service.create_users(
+            [(user.name, user.mail, user.password) for user in data],
+            enable=True,
+            created_by=request.user.user_id,
+        )
+
     @get(
         path="/{user_id:str}",
         raises=[NotFoundException],
@@ -107,7 +146,9 @@ class UserController(Controller):
     @get(
         path="/",
         guards=[root_guard],
-        description="Use of [query], changes to search mode for login_name or login_mail",
+        raises=[ClientException],
+        description="Use of [query], changes to search mode for login_name or login_mail."
+        f" Otherwise pages by registration date, pass the {NEXT_CURSOR_HEADER} response header as [cursor]",
     )
     async def all_users(
         self,
@@ -116,10 +157,15 @@ class UserController(Controller):
         offset: int = 0,
         asc: bool = True,
         query: str | None = None,  # Search for username
-    ) -> list[models.AllUserView]:
+        cursor: str | None = None,
+    ) -> Response[list[models.AllUserView]]:
         if query:
-            return await user_service.search_user(query, limit=limit, offset=offset)
-        return await user_service.get_alluserview(limit=limit, offset=offset, asc=asc)
+            return Response(await user_service.search_user(query, limit=limit, offset=offset))
+        try:
+            users, next_cursor = await user_service.get_alluserview(limit=limit, offset=offset, asc=asc, cursor=cursor)
+        except exceptions.UserInputError as e:
+            raise ClientException(str(e))
+        return Response(users, headers={NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None)
 
     @patch(
         path="/{user_id:str}/account",
@@ -199,6 +245,35 @@ class UserController(Controller):
         except exceptions.IntegrityError as e:
             raise types.AlreadyExists(str(e))
 
+    @post(
+        path="/bulk/roles",
+        guards=[root_guard],
+        status_code=200,
+        raises=[ClientException, ValidationException],
+        description="Gives the valid roles in one transaction. Returns [error] per role, in order."
+        " Dates can be int for unixtimestamps",
+    )
+    async def give_users_roles(
+        self,
+        request: types.AuthRequest,
+        user_service: UserService,
+        data: list[BulkRolePayload],
+    ) -> list[models.BulkResult]:
+        check_bulk_size(data)
+        try:
+            roles = [
+                NewRole(
+                    user_id=item.user_id,
+                    role=item.role,
+                    valid_from=time_helpers.parse_date(item.valid_from_date),
+                    valid_to=time_helpers.parse_date(item.valid_to_date),
+                )
+                for item in data
+            ]
+        except ValueError as e:
+            raise ValidationException(str(e))
+        return await user_service.add_roles(roles, given_by=request.user.user_id)
+
     @patch(
         path="/{user_id:str}/roles",
         guards=[root_guard],
@@ -274,6 +349,36 @@ class UserController(Controller):
         except exceptions.IntegrityError as e:
             raise types.AlreadyExists(str(e))
 
+    @post(
+        path="/bulk/acl",
+        guards=[root_guard],
+        status_code=200,
+        raises=[ClientException, ValidationException],
+        description="Gives the valid grants in one transaction. Returns [error] per grant, in order."
+        " Dates can be int for unixtimestamps",
+    )
+    async def give_users_acl(
+        self,
+        request: types.AuthRequest,
+        user_service: UserService,
+        data: list[BulkACLPayload],
+    ) -> list[models.BulkResult]:
+        check_bulk_size(data)
+        try:
+            services = [
+                NewUserService(
+                    user_id=item.user_id,
+                    service_name=item.service_name,
+                    rwx=types.RWX.from_int(item.rwx),
+                    valid_from=time_helpers.parse_date(item.valid_from_date),
+                    valid_to=time_helpers.parse_date(item.valid_to_date),
+                )
+                for item in data
+            ]
+        except (ValueError, exceptions.UserInputError) as e:
+            raise ValidationException(str(e))
+        return await user_service.add_acls(services, given_by=request.user.user_id)
+
     @patch(path="/{user_id:str}/acl/{service_name:str}")
     async def update_user_acl(
         self,
@@ -32,7 +32,7 @@ class AuthService(msgspec.Struct):
                 self.repo_ban.is_user_banned(user.user_id),
             )
             if result and user.enabled and not is_banned:
-                shared.fire_forget_coro(self.user_service.update_user_login_date(user.user_id))
+                shared.task_supervisor.spawn("login_date", self.user_service.update_user_login_date(user.user_id))
                 return user.user_id
         else:
             await helpers.check_password_b64_threaded(password, None)
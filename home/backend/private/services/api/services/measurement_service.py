@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+import msgspec
+from core import exceptions
+from storage.db.repositories.measurement_repository import MeasurementRepository
+from utils import time_helpers
+
+from appdata import shared  # type: ignore
+
+MAX_HISTORY_POINTS = 5000
+
+
+class MeasurementService(msgspec.Struct):
+    repo_measurement: MeasurementRepository
+
+    def get_history(
+        self,
+        device_name: str,
+        sensor_id: int,
+        measurement_type: str,
+        start: datetime | None,
+        end: datetime | None,
+        points: int,
+    ):
+        """
+        Returns an async generator of at most [points] buckets.
+
+        Raises:
+            UserInputError: if value(s) given are invalid
+        """
+        try:
+            type_id = shared.MeasurementTypes[measurement_type.upper()].value
+        except KeyError:
+            raise exceptions.UserInputError(f"Unknown measurement type: {measurement_type}")
+        if not 0 < points <= MAX_HISTORY_POINTS:
+            raise exceptions.UserInputError(f"Points should be 1 to {MAX_HISTORY_POINTS}")
+
+        end_time = int(end.timestamp()) if end else time_helpers.unixtime()
+        start_time = int(start.timestamp()) if start else end_time - int(timedelta(days=1).total_seconds())
+        if start_time >= end_time:
+            raise exceptions.UserInputError("Start date is equal or larger to end date")
+
+        bucket_sec = max(1, -(-(end_time - start_time) // points))  # ceil
+        return self.repo_measurement.get_history(device_name, sensor_id, type_id, start_time, end_time, bucket_sec)
@@ -0,0 +1,91 @@
+import asyncio
+from contextlib import suppress
+from typing import AsyncGenerator
+
+import valkey.asyncio as valkey
+
+from appdata import shared  # type: ignore
+
+
+class _Subscriber:
+    __slots__ = ("channels", "queue")
+
+    def __init__(self, channels: tuple[str, ...], max_buffer: int):
+        self.channels = channels
+        self.queue = asyncio.Queue[tuple[str, bytes] | None](maxsize=max_buffer)
+
+
+class StreamService:
+    """One Valkey subscription per worker, fanned out to a bounded buffer per client.
+    Clients that fall behind by max_buffer messages are evicted and have to reconnect."""
+
+    __slots__ = ("client", "channels", "max_buffer", "evictions", "_subscribers", "_task")
+
+    def __init__(self, client: valkey.Valkey, channels: tuple[str, ...], max_buffer: int = 32):
+        self.client = client
+        self.channels = channels
+        self.max_buffer = max_buffer
+        self.evictions = 0
+        self._subscribers: dict[str, set[_Subscriber]] = {channel: set() for channel in channels}
+        self._task: asyncio.Task | None = None
+
+    @property
+    def clients(self) -> int:
+        return len(set().union(*self._subscribers.values()))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="stream_service")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for subscribers in self._subscribers.values():
+            for subscriber in tuple(subscribers):
+                self._evict(subscriber)
+
+    async def subscribe(self, *channels: str) -> AsyncGenerator[tuple[str, bytes], None]:
+        """Yields (channel, message) until the client disconnects or is evicted"""
+        subscriber = _Subscriber(channels, self.max_buffer)
+        for channel in channels:
+            self._subscribers[channel].add(subscriber)
+        try:
+            while (item := await subscriber.queue.get()) is not None:
+                yield item
+        finally:
+            self._remove(subscriber)
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.subscribe(*self.channels)
+                    async for msg in pubsub.listen():
+                        if msg["type"] == "message":
+                            self._fan_out(msg["channel"].decode(), msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                shared.print_err(e)
+                await asyncio.sleep(5)
+
+    def _fan_out(self, channel: str, message: bytes):
+        for subscriber in tuple(self._subscribers.get(channel, ())):
+            try:
+                subscriber.queue.put_nowait((channel, message))
+            except asyncio.QueueFull:
+                self.evictions += 1
+                self._evict(subscriber)
+
+    def _evict(self, subscriber: _Subscriber):
+        self._remove(subscriber)
+        while not subscriber.queue.empty():  # Make room for the stop marker
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def _remove(self, subscriber: _Subscriber):
+        for channel in subscriber.channels:
+            self._subscribers[channel].discard(subscriber)
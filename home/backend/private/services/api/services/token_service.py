@@ -27,7 +27,10 @@ class TokenService(msgspec.Struct):
             http_helpers.get_token_str(connection.headers),
         ):
             if result := await self.authenticate_access_token(token):
-                shared.fire_forget_coro(self.cache_online_users.set(result[0].user_id, value=b"1", ex=90))
+                shared.task_supervisor.spawn(
+                    "online_users",
+                    self.cache_online_users.set(result[0].user_id, value=b"1", ex=90),
+                )
                 return result
         return None
 
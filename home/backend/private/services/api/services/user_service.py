@@ -1,15 +1,17 @@
 import asyncio
-from typing import Unpack
+from typing import Iterable, Sequence, Unpack
 
 import msgspec
 from core import enums, exceptions, models, types
 from storage.cache.valkeyCacheClient import ValkeyCacheClient
 from storage.db.repositories.user_account_repository import (
+    NewUser,
     UserAccountRepository,
     UserColumnFetch,
     UserUpdateFields,
 )
 from storage.db.repositories.user_acl_repository import (
+    NewUserService,
     UpdateUserServiceField,
     UserACLRepository,
 )
@@ -17,7 +19,8 @@ from storage.db.repositories.user_profile_repository import (
     UserProfileRepository,
     UserProfileUpdateFields,
 )
-from storage.db.repositories.user_role_repository import UserRoleRepository
+from storage.db.repositories.user_role_repository import NewRole, UserRoleRepository
+from storage.db.sql import keyset
 from utils import cache_helpers, helpers, validation
 
 from appdata import shared  # type: ignore
@@ -122,6 +125,44 @@ class UserService(msgspec.Struct):
         password_hash = await helpers.hash_password_b64_threaded(password)
         return await self.repo_account.create_user(login_name, login_mail, password_hash, enable, created_by)
 
+    async def create_users(
+        self,
+        users: Sequence[tuple[str, str | None, str]],
+        enable: bool,
+        created_by: types.UserID | None = None,
+    ) -> list[models.BulkResult]:
+        """
+        users as (login_name, login_mail, password). Valid users are created in one transaction,
+        their passwords hashed in parallel on the process pool.
+        """
+        results = [models.BulkResult() for _ in users]
+        valid: list[tuple[models.BulkResult, str, str | None, str]] = []
+        for result, (login_name, login_mail, password) in zip(results, users):
+            try:
+                validation.validate_password(password)
+                validation.validate_name(login_name)
+                if login_mail:
+                    validation.validate_mail(login_mail)
+            except exceptions.ValidationError as e:
+                result.error = str(e)
+                continue
+            valid.append((result, login_name, login_mail, password))
+
+        password_hashes = await helpers.hash_passwords_b64_threaded(password for *_, password in valid)
+        created = await self.repo_account.create_users(
+            [
+                NewUser(login_name, login_mail, password_hash, enable)
+                for (_, login_name, login_mail, _), password_hash in zip(valid, password_hashes)
+            ],
+            created_by,
+        )
+        for (result, *_), user_id in zip(valid, created):
+            if isinstance(user_id, Exception):
+                result.error = str(user_id)
+            else:
+                result.user_id = user_id
+        return results
+
     async def search_user(
         self,
         name_or_email: str,
@@ -206,6 +247,14 @@ class UserService(msgspec.Struct):
         await self.repo_role.insert_user_role(user_id, role, valid_from, valid_to, given_by)
         await cache_helpers.incr_version(self.cache_app, user_id=user_id)
 
+    async def add_roles(
+        self, roles: Sequence[NewRole], given_by: types.UserID | None = None
+    ) -> list[models.BulkResult]:
+        """Valid roles are given in one transaction"""
+        errors = await self.repo_role.insert_user_roles(roles, given_by)
+        await self._incr_versions(role.user_id for role, error in zip(roles, errors) if error is None)
+        return [models.BulkResult(role.user_id, error and str(error)) for role, error in zip(roles, errors)]
+
     async def replace_role(
         self,
         user_id: types.UserID,
@@ -252,6 +301,14 @@ class UserService(msgspec.Struct):
         await self.repo_acl.insert_service(user_id, service_name, rwx, valid_from, valid_to, given_by)
         await cache_helpers.incr_version(self.cache_app, user_id=user_id)
 
+    async def add_acls(
+        self, services: Sequence[NewUserService], given_by: types.UserID | None = None
+    ) -> list[models.BulkResult]:
+        """Valid grants are given in one transaction"""
+        errors = await self.repo_acl.insert_services(services, given_by)
+        await self._incr_versions(service.user_id for service, error in zip(services, errors) if error is None)
+        return [models.BulkResult(service.user_id, error and str(error)) for service, error in zip(services, errors)]
+
     async def update_acl(self, user_id: types.UserID, service_name: str, **fields: Unpack[UpdateUserServiceField]):
         """
         Raises:
@@ -266,11 +323,27 @@ class UserService(msgspec.Struct):
 
     # endregion
     # region: Views
-    async def get_alluserview(self, limit=10, offset=0, asc=True):
+    async def get_alluserview(
+        self, limit=10, offset=0, asc=True, cursor: str | None = None
+    ) -> tuple[list[models.AllUserView], str | None]:
+        """
+        Returns the page and an opaque cursor to the next, None on the last page.
+        A cursor carries the order, asc is ignored. offset is only for jumping to a page, it scans the skipped rows.
+
+        Raises:
+            UserInputError
+        """
         if limit <= 0:
             raise exceptions.UserInputError("Invalid limit given")
         if offset < 0:
             raise exceptions.UserInputError("Invalid offset given")
-        return await self.repo_account.get_alluserview(limit, offset, asc)
+        after = None
+        if cursor is not None:
+            asc, *after = keyset.decode(cursor, tuple[bool, str, types.UserID])
+        users, last = await self.repo_account.get_alluserview(limit, asc, after=after, offset=offset)  # type: ignore
+        return users, None if last is None else keyset.encode(asc, *last)
 
     # endregion
+
+    async def _incr_versions(self, user_ids: Iterable[types.UserID]):
+        await asyncio.gather(*(cache_helpers.incr_version(self.cache_app, user_id=uid) for uid in set(user_ids)))
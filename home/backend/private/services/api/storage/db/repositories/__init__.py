@@ -2,27 +2,43 @@ import aiosqlite
 from appdata import shared  # type: ignore
 
 from core import exceptions, types
+from storage.db import tables
+from storage.db.sql import queries
 from storage.db.sql.sqlite import SQLite
 from utils import helpers
 
+# Only rows with a changed value are written, and get a new last_updated_date
+UPDATE_FIELDS: dict[str, dict[frozenset[str], str]] = {
+    table.__name__: queries.register_updates(
+        f"{table.__name__.lower()}.update",
+        table.__name__,
+        columns,
+        where="user_id = :user_id",
+        extra_set=", last_updated_date = :now",
+        only_if_changed=True,
+    )
+    for table, columns in (
+        (tables.User, ("login_name", "login_mail", "password")),
+        (tables.User_Profile, ("display_name",)),
+    )
+}
+
 
 async def update_fields(db: SQLite, table: str, user_id: types.UserID, **fields):
     if not fields:
         raise exceptions.UserInputError("No fields given")
-
-    time_now = shared.datetime_now_isofmtZ()
-
-    _fields = ",".join(f"{col} = :{col}" for col in fields.keys())
-    _diff_clause = " OR ".join(f"{col} IS NOT :{col}" for col in fields.keys())
-    query = (
-        f"UPDATE {table} SET {_fields}, last_updated_date = '{time_now}'"
-        f"  WHERE user_id = :user_id AND ({_diff_clause})"
-    )
+    if (query := UPDATE_FIELDS[table].get(frozenset(fields))) is None:
+        raise exceptions.UserInputError("Unknown fields given")
 
     try:
-        await db.execute_void(query, dict(**fields, user_id=user_id))
+        await db.execute_void(query, dict(**fields, user_id=user_id, now=shared.datetime_now_isofmtZ()))
     except aiosqlite.IntegrityError as e:
         raise exceptions.IntegrityError(str(e)) from e
     except Exception as e:
         shared.print_err(e)
         raise
+
+
+def integrity_errors(errors: list[Exception | None]) -> list[Exception | None]:
+    """execute_batch errors, with aiosqlite's IntegrityError as exceptions.IntegrityError"""
+    return [exceptions.IntegrityError(str(e)) if isinstance(e, aiosqlite.IntegrityError) else e for e in errors]
@@ -0,0 +1,100 @@
+from typing import AsyncGenerator, Literal
+
+import msgspec
+from core import models, types
+from storage.db.sql import queries
+from storage.db.sql.sqlite import SQLite
+
+type Resolution = Literal["raw", "hourly", "daily"]
+
+# (table, bucket size in seconds) of the rollups maintained by the scheduler, coarsest first
+ROLLUP_TABLES: dict[Resolution, tuple[str, int]] = {
+    "daily": ("measurements_daily", 86400),
+    "hourly": ("measurements_hourly", 3600),
+}
+
+# Columns: ts, n, lo, hi, total, of the raw sources in [{lo}, {hi})
+_RAW_SOURCE = """
+    SELECT timestamp AS ts, 1 AS n, value AS lo, value AS hi, value AS total
+    FROM measurements
+    WHERE device_id = (SELECT device_id FROM device WHERE name = :device_name)
+        AND sensor_id = :sensor_id AND type_id = :type_id AND timestamp >= {lo} AND timestamp < {hi}
+    UNION ALL
+    SELECT window_start, count, COALESCE(min, last), COALESCE(max, last), COALESCE(sum, last * count)
+    FROM measurement_windows
+    WHERE device_name = :device_name AND sensor_id = :sensor_id AND type_id = :type_id
+        AND window_start >= {lo} AND window_start < {hi}
+"""
+# Whole buckets in [:rollup_start, :rollup_end), raw data for the partial bucket before and everything after
+_ROLLUP_SOURCE = (
+    _RAW_SOURCE.format(lo=":start", hi=":head_end")
+    + """
+    UNION ALL
+    SELECT bucket_start AS ts, count AS n, min AS lo, max AS hi, sum AS total
+    FROM {table}
+    WHERE device_name = :device_name AND sensor_id = :sensor_id AND type_id = :type_id
+        AND bucket_start >= :rollup_start AND bucket_start < :rollup_end
+    UNION ALL
+"""
+    + _RAW_SOURCE.format(lo=":rollup_end", hi=":end")
+)
+_BUCKETED = """
+SELECT :start + ((ts - :start) / :bucket) * :bucket AS bucket, SUM(total) / SUM(n), MIN(lo), MAX(hi), SUM(n)
+FROM ({source})
+GROUP BY bucket
+ORDER BY bucket
+"""
+HISTORY_QUERIES: dict[Resolution, str] = {
+    "raw": queries.register(
+        "measurements.history_raw", _BUCKETED.format(source=_RAW_SOURCE.format(lo=":start", hi=":end"))
+    ),
+    **{
+        resolution: queries.register(
+            f"measurements.history_{resolution}", _BUCKETED.format(source=_ROLLUP_SOURCE.format(table=table))
+        )
+        for resolution, (table, _) in ROLLUP_TABLES.items()
+    },
+}
+SELECT_HIGH_WATER = queries.register("rollup_state.high_water", "SELECT high_water FROM rollup_state WHERE name = ?")
+
+
+class MeasurementRepository(msgspec.Struct, gc=False):
+    db: SQLite
+
+    async def get_history(
+        self,
+        device_name: str,
+        sensor_id: int,
+        type_id: int,
+        start: types.Unixtime,
+        end: types.Unixtime,
+        bucket_sec: int,
+    ) -> AsyncGenerator[models.HistoryPoint, None]:
+        """Bucketed mean/min/max over [start, end).
+        Reads the coarsest rollup that fits in a bucket for the whole buckets in the range, up to its high-water mark,
+        raw data around them. All sources are range scans on their (device_name, sensor_id, type_id, time) keys."""
+        resolution: Resolution = next(
+            (resolution for resolution, (_, size) in ROLLUP_TABLES.items() if size <= bucket_sec),
+            "raw",
+        )
+        params = dict(
+            device_name=device_name,
+            sensor_id=sensor_id,
+            type_id=type_id,
+            start=start,
+            end=end,
+            bucket=bucket_sec,
+        )
+        async with self.db.read() as conn:
+            if resolution != "raw":
+                size = ROLLUP_TABLES[resolution][1]
+                rollup_start = start + -start % size  # First whole bucket
+                rollup_end = rollup_start
+                async with conn.execute(SELECT_HIGH_WATER, (resolution,)) as cur:
+                    if row := await cur.fetchone():
+                        rollup_end = max(rollup_start, min(row[0], end - end % size))
+                params.update(head_end=min(rollup_start, end), rollup_start=rollup_start, rollup_end=rollup_end)
+
+            async with conn.execute(HISTORY_QUERIES[resolution], params) as cur:
+                async for row in cur:
+                    yield models.HistoryPoint(*row)
@@ -1,15 +1,17 @@
-from typing import Any, Iterable, Literal, TypedDict, Unpack
+from typing import Any, Iterable, Literal, NamedTuple, Sequence, TypedDict, Unpack
 
 import aiosqlite
 import msgspec
 from core import exceptions, models, types
 from storage.db import tables
+from storage.db.sql import queries
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 from utils import helpers, time_helpers, validation
 
 from appdata import shared  # type: ignore
 
-from . import update_fields
+from . import integrity_errors, update_fields
 
 type UserColumnFetch = Literal["login_mail", "login_name", "user_id"]
 
@@ -20,6 +22,54 @@ class UserUpdateFields(TypedDict, total=False):
     password: str
 
 
+class NewUser(NamedTuple):
+    login_name: str
+    login_mail: str | None
+    password_hash: str
+    enabled: bool
+
+
+INSERT_USER = queries.register(
+    "user.insert",
+    f"INSERT INTO {tables.User.__name__}"
+    " (user_id, login_name, login_mail, password, enabled, last_login_date, last_updated_date)"
+    " VALUES (?,?,?,?,?,?,?)",
+)
+INSERT_REGISTRATION = queries.register(
+    "registration.insert",
+    f"INSERT INTO {tables.Registration.__name__} (user_id, name, mail, created_by, created_date) VALUES (?,?,?,?,?)",
+)
+INSERT_PROFILE = queries.register(
+    "user_profile.insert",
+    f"INSERT INTO {tables.User_Profile.__name__} (user_id, display_name, last_updated_date) VALUES (?,?,?)",
+)
+USER_ROW = RowDecoder(tables.User)
+REGISTRATION_ROW = RowDecoder(tables.Registration)
+SELECT_USER: dict[UserColumnFetch, str] = {
+    method: queries.register(
+        f"user.by_{method}", f"SELECT {USER_ROW.columns} FROM {tables.User.__name__} WHERE {method} = ?"
+    )
+    for method in ("login_mail", "login_name", "user_id")
+}
+EXISTS_USER: dict[UserColumnFetch, str] = {
+    method: queries.register(
+        f"user.exists_{method}", f"SELECT 1 FROM {tables.User.__name__} WHERE {method} = ? LIMIT 1"
+    )
+    for method in ("login_mail", "login_name", "user_id")
+}
+SELECT_REGISTRATION = queries.register(
+    "registration.by_user_id",
+    f"SELECT {REGISTRATION_ROW.columns} FROM {tables.Registration.__name__} WHERE user_id = ?",
+)
+UPDATE_ENABLED = queries.register(
+    "user.update_enabled", f"UPDATE {tables.User.__name__} SET enabled = ? WHERE user_id = ?"
+)
+UPDATE_LOGIN_DATE = queries.register(
+    "user.update_login_date", f"UPDATE {tables.User.__name__} SET last_login_date = ? WHERE user_id = ?"
+)
+DELETE_USER = queries.register("user.delete", f"DELETE FROM {tables.User.__name__} WHERE user_id = ?")
+
+
 class UserAccountRepository(msgspec.Struct, gc=False):
     db: SQLite
 
@@ -42,23 +92,12 @@ class UserAccountRepository(msgspec.Struct, gc=False):
         try:
             async with self.db.connect() as conn:
                 await conn.execute(
-                    f"INSERT INTO {tables.User.__name__}"
-                    " (user_id, login_name, login_mail, password, enabled, last_login_date, last_updated_date)"
-                    " VALUES (?,?,?,?,?,?,?)",
-                    (user_id, login_name, login_mail, password_hash, enabled, min_time, min_time),
+                    INSERT_USER, (user_id, login_name, login_mail, password_hash, enabled, min_time, min_time)
                 )
                 await conn.execute(
-                    f"INSERT INTO {tables.Registration.__name__}"
-                    " (user_id, name, mail, created_by, created_date)"
-                    " VALUES (?,?,?,?,?)",
-                    (user_id, login_name, login_mail, created_by, shared.datetime_now_isofmtZ()),
-                )
-                await conn.execute(
-                    f"INSERT INTO {tables.User_Profile.__name__}"
-                    " (user_id, display_name, last_updated_date)"
-                    " VALUES (?,?,?)",
-                    (user_id, login_name, min_time),
+                    INSERT_REGISTRATION, (user_id, login_name, login_mail, created_by, shared.datetime_now_isofmtZ())
                 )
+                await conn.execute(INSERT_PROFILE, (user_id, login_name, min_time))
                 await conn.commit()
                 return user_id
         except aiosqlite.IntegrityError as e:
@@ -67,6 +106,27 @@ class UserAccountRepository(msgspec.Struct, gc=False):
             shared.print_err(e)
             raise
 
+    async def create_users(
+        self, users: Sequence[NewUser], created_by: types.UserID | None = None
+    ) -> list[types.UserID | Exception]:
+        """In one transaction. Returns the user_id of every created user, or its error (IntegrityError if a value
+        already exists)"""
+        user_ids = [helpers.uuid7() for _ in users]
+        min_time = time_helpers.DATETIME_MIN_STR
+        now = shared.datetime_now_isofmtZ()
+
+        errors = await self.db.execute_batch(
+            (
+                (INSERT_USER, [(uid, *user, min_time, min_time) for uid, user in zip(user_ids, users)]),
+                (
+                    INSERT_REGISTRATION,
+                    [(uid, u.login_name, u.login_mail, created_by, now) for uid, u in zip(user_ids, users)],
+                ),
+                (INSERT_PROFILE, [(uid, u.login_name, min_time) for uid, u in zip(user_ids, users)]),
+            )
+        )
+        return [user_id if e is None else e for user_id, e in zip(user_ids, integrity_errors(errors))]
+
     # endregion
     # region: Read
     async def get_user(self, method: UserColumnFetch, value: str):
@@ -74,9 +134,8 @@ class UserAccountRepository(msgspec.Struct, gc=False):
         Raises:
             NotFoundError: if name or mail does not exist
         """
-        query = f"SELECT * FROM {tables.User.__name__} WHERE {method} = ?"
-        if row := await self.db.fetch_one(query, (value,)):
-            return msgspec.convert(row, type=tables.User, strict=False)
+        if user := await self.db.fetch_struct(USER_ROW, SELECT_USER[method], (value,)):
+            return user
         raise exceptions.NotFoundError
 
     async def get_user_registration(self, user_id: types.UserID):
@@ -84,24 +143,20 @@ class UserAccountRepository(msgspec.Struct, gc=False):
         Raises:
             NotFoundError: if name or mail does not exist
         """
-        query = f"SELECT * FROM {tables.Registration.__name__} WHERE user_id = ?"
-        if row := await self.db.fetch_one(query, (user_id,)):
-            return msgspec.convert(row, type=tables.Registration)
+        if registration := await self.db.fetch_struct(REGISTRATION_ROW, SELECT_REGISTRATION, (user_id,)):
+            return registration
         raise exceptions.NotFoundError
 
     async def exists_user(self, method: UserColumnFetch, value: str) -> bool:
-        query = f"SELECT 1 FROM {tables.User.__name__} WHERE {method} = ? LIMIT 1"
-        return await self.db.fetch_one(query, (value,)) is not None
+        return await self.db.fetch_one(EXISTS_USER[method], (value,)) is not None
 
     # endregion
     # region: Update
     async def update_user_enabled(self, user_id: types.UserID, enable: bool):
-        query = f"UPDATE {tables.User.__name__} SET enabled = ? WHERE user_id = ?"
-        await self.db.execute_void(query, (enable, user_id))
+        await self.db.execute_void(UPDATE_ENABLED, (enable, user_id))
 
     async def update_user_login_date(self, user_id: types.UserID):
-        query = f"UPDATE {tables.User.__name__} SET last_login_date = ? WHERE user_id = ?"
-        await self.db.execute_void(query, (shared.datetime_now_isofmtZ(), user_id))
+        await self.db.execute_void(UPDATE_LOGIN_DATE, (shared.datetime_now_isofmtZ(), user_id))
 
     async def update_user(self, user_id: types.UserID, **fields: Unpack[UserUpdateFields]):
         """
@@ -114,8 +169,7 @@ class UserAccountRepository(msgspec.Struct, gc=False):
     # endregion
     # region: Delete
     async def delete_user(self, user_id: types.UserID):
-        query = f"DELETE FROM {tables.User.__name__} WHERE user_id = ?"
-        await self.db.execute_void(query, (user_id,))
+        await self.db.execute_void(DELETE_USER, (user_id,))
 
     # endregion
     # region: Misc
@@ -126,61 +180,67 @@ class UserAccountRepository(msgspec.Struct, gc=False):
         offset: int | None = None,
         exact_match=False,
     ) -> list[models.AllUserView]:
+        """Substring search of 3+ characters uses user_search, best match first"""
         if "@" in name_or_email:
             if exact_match:
                 validation.validate_mail(name_or_email)
-                where_clause = "u.login_mail = :term"
-            else:
-                where_clause = "u.login_mail LIKE :term"
+            search = "mail_exact" if exact_match else "mail"
         else:
             validation.validate_name(name_or_email)
-            if exact_match:
-                where_clause = "u.login_name = :term"
-            else:
-                where_clause = "u.login_name LIKE :term OR u.login_mail LIKE :term"
-
-        selections = [f"WHERE {where_clause}"]
-        if limit is not None:
-            selections.append(f"LIMIT {limit}")
-        if offset is not None:
-            selections.append(f"OFFSET {offset}")
+            search = "name_exact" if exact_match else "name"
 
-        query = __get_alluserview_base_query(" ".join(selections))
-        param = {"term": name_or_email if exact_match else f"%{name_or_email}%"}
-
-        rows = await self.db.fetch_all(query, param)
-        return __alluserview_query_rows_to_struct(rows)
+        if exact_match:
+            term = name_or_email
+        elif len(name_or_email) < SEARCH_MIN_CHARS:
+            term = f"%{name_or_email}%"
+        else:
+            search = "ranked"
+            term = f'"{name_or_email.replace('"', '""')}"'  # One phrase, FTS5 query syntax is escaped
+            if "@" in name_or_email:
+                term = "login_mail : " + term
+        param = {
+            "term": term,
+            "limit": -1 if limit is None else limit,  # No limit
+            "offset": offset or 0,
+        }
+        rows = await self.db.fetch_all(SEARCH_ALLUSERVIEW[search], param)
+        return _alluserview_query_rows_to_struct(rows)
 
-    async def get_alluserview(self, limit=10, offset=0, asc=True) -> list[models.AllUserView]:
-        query = __get_alluserview_base_query(f"ORDER BY reg.created_date {"ASC" if asc else "DESC"} LIMIT ? OFFSET ?")
+    async def get_alluserview(
+        self, limit=10, asc=True, after: tuple[str, types.UserID] | None = None, offset=0
+    ) -> tuple[list[models.AllUserView], tuple[str, types.UserID] | None]:
+        """
+        Ordered by (registration date, user_id). Continues after the key of the previous page's last row,
+        or skips offset rows from the start.
 
-        rows = await self.db.fetch_all(query, (limit, offset))
-        return __alluserview_query_rows_to_struct(rows)
+        Returns:
+            The page, and the key of its last row if more rows follow.
+        """
+        if after is None:
+            params = {"limit": limit + 1, "offset": offset}
+        else:
+            params = {"limit": limit + 1, "created_date": after[0], "user_id": after[1]}
+        rows = list(await self.db.fetch_all(SELECT_ALLUSERVIEW[asc, after is not None], params))
+        if len(rows) <= limit:
+            return _alluserview_query_rows_to_struct(rows), None
+        del rows[limit:]
+        return _alluserview_query_rows_to_struct(rows), (rows[-1]["registration_date"], rows[-1]["user_id"])
 
 
-def __get_alluserview_base_query(query_filter: str = ""):
+def _get_alluserview_query(query_filter: str = "", order_by: str = "", columns: str = ""):
     """
+    Roles and services are aggregated for the users of the page only.
     `Tables`:
         `reg`: Registration
         `u`: User
     """
     return (
-        " WITH roles_agg AS ("
-        "   SELECT user_id, json_group_array(role_name) AS roles"
-        f"  FROM {tables.Has_Role.__name__}"
-        "   GROUP BY user_id"
-        " ),"
-        " services_agg AS ("
-        "   SELECT user_id, json_group_object(LOWER(service_name), rwx) AS acl"
-        f"  FROM {tables.Has_Service.__name__}"
-        "   GROUP BY user_id"
-        " ),"
-        " paged_users AS ("
+        " WITH paged_users AS ("
         "    SELECT u.user_id, u.login_name, u.login_mail, u.enabled,"
         "      reg.created_date as registration_date,"
-        "      reg.created_by AS created_by"
+        f"      reg.created_by AS created_by{columns}"
         f"   FROM {tables.User.__name__} u"
-        f"   LEFT JOIN {tables.Registration.__name__} reg ON u.user_id = reg.user_id"
+        f"   JOIN {tables.Registration.__name__} reg ON u.user_id = reg.user_id"
         f"   {query_filter}"
         " )"
         " SELECT"
@@ -191,20 +251,67 @@ def __get_alluserview_base_query(query_filter: str = ""):
         "  u.login_name,"
         "  u.login_mail,"
         "  u.created_by,"
-        "  COALESCE(s.acl, '[]') AS services,"
-        "  COALESCE(r.roles, '[]') AS roles"
+        "  (SELECT json_group_object(LOWER(service_name), rwx)"
+        f"    FROM {tables.Has_Service.__name__} WHERE user_id = u.user_id) AS services,"
+        "  (SELECT json_group_array(role_name)"
+        f"    FROM {tables.Has_Role.__name__} WHERE user_id = u.user_id) AS roles"
         " FROM paged_users u"
-        " LEFT JOIN roles_agg r ON u.user_id = r.user_id"
-        " LEFT JOIN services_agg s ON u.user_id = s.user_id "
-        f"LEFT JOIN {tables.User_Profile.__name__} up ON u.user_id = up.user_id"
+        f" LEFT JOIN {tables.User_Profile.__name__} up ON u.user_id = up.user_id"
+        f" {order_by}"
+    )
+
+
+SEARCH_MIN_CHARS = 3  # Shortest trigram match
+_RANKED = (
+    "JOIN (SELECT user_id, rank FROM user_search WHERE user_search MATCH :term"
+    "   ORDER BY rank LIMIT :limit OFFSET :offset) s ON u.user_id = s.user_id"
+)
+SEARCH_ALLUSERVIEW = {
+    **{
+        search: queries.register(
+            f"alluserview.search_{search}",
+            _get_alluserview_query(f"WHERE {where_clause} LIMIT :limit OFFSET :offset"),
+        )
+        for search, where_clause in (
+            ("mail_exact", "u.login_mail = :term"),
+            ("mail", "u.login_mail LIKE :term"),
+            ("name_exact", "u.login_name = :term"),
+            ("name", "u.login_name LIKE :term OR u.login_mail LIKE :term"),
+        )
+    },
+    "ranked": queries.register(
+        "alluserview.search_ranked", _get_alluserview_query(_RANKED, "ORDER BY u.rank", ", s.rank")
+    ),
+}
+
+
+def _alluserview_page_query(asc: bool, after: bool):
+    direction, compare = ("ASC", ">") if asc else ("DESC", "<")
+    where = f"WHERE (reg.created_date, reg.user_id) {compare} (:created_date, :user_id)" if after else ""
+    return _get_alluserview_query(
+        f"{where} ORDER BY reg.created_date {direction}, reg.user_id {direction}"
+        f" LIMIT :limit{"" if after else " OFFSET :offset"}",
+        f"ORDER BY u.registration_date {direction}, u.user_id {direction}",
     )
 
 
-# decode=msgspec.json.Decoder().decode
-def __alluserview_query_rows_to_struct(rows: Iterable[dict[str, Any]]):
+# Keyed by (asc, after a key)
+SELECT_ALLUSERVIEW = {
+    (asc, after): queries.register(
+        f"alluserview.page_{"asc" if asc else "desc"}{"_after" if after else ""}", _alluserview_page_query(asc, after)
+    )
+    for asc in (True, False)
+    for after in (False, True)
+}
+
+
+def _alluserview_query_rows_to_struct(rows: Iterable[dict[str, Any]]):
+    decode = msgspec.json.decode
+
     def apply(row: dict[str, Any]):
-        # for key in ("services", "roles"):
-        #     row[key] = decode(row[key])
+        row = dict(row)
+        for key in ("services", "roles"):
+            row[key] = decode(row[key])
         return msgspec.convert(row, type=models.AllUserView, strict=False)
 
     return [apply(row) for row in rows]
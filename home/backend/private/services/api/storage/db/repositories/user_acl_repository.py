@@ -1,5 +1,5 @@
 from datetime import UTC, datetime
-from typing import TypedDict, Unpack
+from typing import NamedTuple, Sequence, TypedDict, Unpack
 
 import aiosqlite
 import msgspec
@@ -7,11 +7,15 @@ from core import exceptions, paths, types
 from core.models import AppUserACL
 from internal.constants import DB_INTERNAL
 from storage.db import tables
+from storage.db.sql import queries
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 from utils import time_helpers
 
 from appdata import shared  # type: ignore
 
+from . import integrity_errors
+
 
 class UpdateUserServiceField(TypedDict, total=False):
     rwx: types.RWX
@@ -25,17 +29,73 @@ class UpdateServiceFields(TypedDict, total=False):
     description: str
 
 
+class NewUserService(NamedTuple):
+    user_id: types.UserID
+    service_name: str
+    rwx: types.RWX
+    valid_from: shared.DateTimeUTC | None
+    valid_to: types.DateT
+
+
+SERVICE_ROW = RowDecoder(tables.Service)
+HAS_SERVICE_ROW = RowDecoder(tables.Has_Service)
+REGISTER_SERVICE = queries.register(
+    "service.register",
+    f"INSERT OR IGNORE INTO {tables.Service.__name__} (name, url, description, created_date) VALUES (?,?,?,?)",
+)
+INSERT_USER_SERVICE = queries.register(
+    "has_service.insert",
+    f"INSERT INTO {tables.Has_Service.__name__}"
+    " (user_id, service_name, rwx, valid_from, valid_to, given_by, created_date) VALUES (?,?,?,?,?,?,?)",
+)
+SELECT_SERVICE = queries.register(
+    "service.by_name", f"SELECT {SERVICE_ROW.columns} FROM {tables.Service.__name__} WHERE name = ?"
+)
+SELECT_SERVICES = queries.register("service.all", f"SELECT {SERVICE_ROW.columns} FROM {tables.Service.__name__}")
+SELECT_SERVICE_NAMES = queries.register("service.all_names", f"SELECT name FROM {tables.Service.__name__}")
+SELECT_USER_SERVICES = queries.register(
+    "has_service.by_user_id", f"SELECT {HAS_SERVICE_ROW.columns} FROM {tables.Has_Service.__name__} WHERE user_id = ?"
+)
+SELECT_USER_VALID_SERVICES = queries.register(
+    "has_service.valid_by_user_id",
+    f"SELECT LOWER(service_name) AS name, rwx FROM {tables.Has_Service.__name__}"
+    " WHERE user_id = :user_id AND valid_from <= :now AND valid_to >= :now AND rwx != 0",
+)
+SELECT_SERVICE_USER_IDS = queries.register(
+    "has_service.user_ids", f"SELECT user_id FROM {tables.Has_Service.__name__} WHERE service_name = ?"
+)
+UPDATE_USER_SERVICE = queries.register_updates(
+    "has_service.update",
+    tables.Has_Service.__name__,
+    ("rwx", "valid_from", "valid_to"),
+    where="user_id = :user_id AND service_name = :service_name",
+)
+UPDATE_SERVICE = queries.register_updates(
+    "service.update", tables.Service.__name__, ("name", "url", "description"), where="name = :sn"
+)
+UPDATE_SERVICE_OWNERSHIP = queries.register(
+    "service_ownership.update_name",
+    "UPDATE internal.service_ownership SET service_name = ? WHERE service_name = ?",
+)
+DELETE_USER_SERVICE = queries.register(
+    "has_service.delete", f"DELETE FROM {tables.Has_Service.__name__} WHERE user_id = ? AND service_name = ?"
+)
+DELETE_SERVICE = queries.register("service.delete", f"DELETE FROM {tables.Service.__name__} WHERE name = ?")
+DELETE_SERVICE_OWNERSHIP = queries.register(
+    "service_ownership.delete", "DELETE FROM internal.service_ownership WHERE service_name = ?"
+)
+
+
 class UserACLRepository(msgspec.Struct, gc=False):
     db: SQLite
 
     # region: Create
     async def register_service(self, service_name: str, url: str | None, description: str):
-        query = "INSERT OR IGNORE INTO service (name, url, description, created_date) VALUES (?,?,?,?)"
         # query = (
         #     "INSERT INTO service (name, url, description, created_date) VALUES (?,?,?,?)"
         #     " ON CONFLICT(name) DO UPDATE SET url = EXCLUDED.url, description = EXCLUDED.description"
         # )
-        await self.db.execute_void(query, (service_name, url, description, shared.datetime_now_isofmtZ()))
+        await self.db.execute_void(REGISTER_SERVICE, (service_name, url, description, shared.datetime_now_isofmtZ()))
 
     async def insert_service(
         self,
@@ -50,52 +110,61 @@ class UserACLRepository(msgspec.Struct, gc=False):
         start_time = shared.datetime_to_isofmtZ(valid_from) if valid_from else time_helpers.DATETIME_MIN_STR
         end_time = time_helpers.generate_end_date(now, valid_to)
         _now = shared.datetime_to_isofmtZ(now)
-        query = (
-            f"INSERT INTO {tables.Has_Service.__name__}"
-            " (user_id, service_name, rwx, valid_from, valid_to, given_by, created_date) "
-            f"VALUES (?,?,?,?,?,?,?)"
-        )
 
         try:
             await self.db.execute_void(
-                query, (user_id, service_name, rwx.to_int(), start_time, end_time, given_by, _now)
+                INSERT_USER_SERVICE, (user_id, service_name, rwx.to_int(), start_time, end_time, given_by, _now)
             )
         except aiosqlite.IntegrityError as e:
             raise exceptions.IntegrityError(str(e)) from e
 
+    async def insert_services(
+        self, services: Sequence[NewUserService], given_by: types.UserID | None = None
+    ) -> list[Exception | None]:
+        """In one transaction. Returns the error of every grant, or None. IntegrityError if a value already exists or
+        the user or service is missing, UserInputError if valid_to is expired"""
+        now = datetime.now(UTC)
+        _now = shared.datetime_to_isofmtZ(now)
+        errors: list[Exception | None] = [None] * len(services)
+        indices: list[int] = []
+        rows: list[tuple] = []
+        for i, (user_id, service_name, rwx, valid_from, valid_to) in enumerate(services):
+            try:
+                end_time = time_helpers.generate_end_date(now, valid_to)
+            except exceptions.UserInputError as e:
+                errors[i] = e
+                continue
+            start_time = shared.datetime_to_isofmtZ(valid_from) if valid_from else time_helpers.DATETIME_MIN_STR
+            indices.append(i)
+            rows.append((user_id, service_name, rwx.to_int(), start_time, end_time, given_by, _now))
+
+        for i, error in zip(indices, integrity_errors(await self.db.execute_batch(((INSERT_USER_SERVICE, rows),)))):
+            errors[i] = error
+        return errors
+
     # endregion
     # region: Read
     async def get_service(self, service_name: str):
-        query = f"SELECT * FROM {tables.Service.__name__} WHERE name = ?"
-        if row := await self.db.fetch_one(query, (service_name,)):
-            return msgspec.convert(row, type=tables.Service)
+        return await self.db.fetch_struct(SERVICE_ROW, SELECT_SERVICE, (service_name,))
 
     async def get_all_services(self):
-        query = f"SELECT * FROM {tables.Service.__name__}"
-        return [msgspec.convert(row, type=tables.Service) for row in await self.db.fetch_all(query)]
+        return await self.db.fetch_structs(SERVICE_ROW, SELECT_SERVICES)
 
     async def get_all_service_names(self) -> list[str]:
-        query = f"SELECT name FROM {tables.Service.__name__}"
-        return [row["name"] for row in await self.db.fetch_all(query)]
+        return [row["name"] for row in await self.db.fetch_all(SELECT_SERVICE_NAMES)]
 
     async def get_user_services(self, user_id: types.UserID):
-        query = f"SELECT * FROM {tables.Has_Service.__name__} WHERE user_id = ?"
-        return [msgspec.convert(row, type=tables.Has_Service) for row in await self.db.fetch_all(query, (user_id,))]
+        return await self.db.fetch_structs(HAS_SERVICE_ROW, SELECT_USER_SERVICES, (user_id,))
 
     async def get_user_valid_services(self, user_id: types.UserID):
         """RWX 0 should mean no access but granted service, like a soft ban"""
-        now = shared.datetime_now_isofmtZ()
-        query = (
-            f"SELECT LOWER(service_name) AS name, rwx FROM {tables.Has_Service.__name__} "
-            f"WHERE user_id = ? AND valid_from <= '{now}' AND valid_to >= '{now}' AND rwx != 0"
-        )
-        rows = await self.db.fetch_all(query, (user_id,))
+        params = {"user_id": user_id, "now": shared.datetime_now_isofmtZ()}
+        rows = await self.db.fetch_all(SELECT_USER_VALID_SERVICES, params)
         trans: AppUserACL = {row["name"]: types.RWX.from_int(row["rwx"]) for row in rows}
         return trans
 
     async def find_user_ids_by_service(self, service_name: str) -> list[types.UserID]:
-        query = f"SELECT user_id FROM {tables.Has_Service.__name__} WHERE service_name = ?"
-        return await self.db.fetch_all(query, (service_name,))  # type: ignore
+        return await self.db.fetch_all(SELECT_SERVICE_USER_IDS, (service_name,))  # type: ignore
 
     # endregion
     # region: Update
@@ -106,37 +175,39 @@ class UserACLRepository(msgspec.Struct, gc=False):
             raise exceptions.UserInputError("No fields given")
 
         now = datetime.now(UTC)
-        clauses = []
+        values: dict[str, str | int] = {}
         if field := fields.get("valid_from"):
             if field <= now:
                 raise exceptions.UserInputError("Not allowed to move valid date in the past")
-            clauses.append(f"valid_from = '{shared.datetime_to_isofmtZ(field)}'")
+            values["valid_from"] = shared.datetime_to_isofmtZ(field)
         if "valid_to" in fields:
-            clauses.append(f"valid_to = '{time_helpers.generate_end_date(now, fields['valid_to'])}'")
+            values["valid_to"] = time_helpers.generate_end_date(now, fields["valid_to"])
         if field := fields.get("rwx"):
             value = field.to_int()
             if not (0 <= value <= 7):
                 raise exceptions.UserInputError("Invalid RWX value")
-            clauses.append(f"rwx = {value}")
+            values["rwx"] = value
+        if not values:
+            raise exceptions.UserInputError("No fields given")
 
-        query = f"UPDATE {tables.Has_Service.__name__} SET {",".join(clauses)} WHERE user_id = ? AND service_name = ?"
-        await self.db.execute_void(query, (user_id, service_name))
+        query = UPDATE_USER_SERVICE[frozenset(values)]
+        await self.db.execute_void(query, dict(**values, user_id=user_id, service_name=service_name))
 
     async def update_service(self, service_name: str, **fields: Unpack[UpdateServiceFields]):
         if not fields:
             raise exceptions.UserInputError("No fields given")
 
-        clauses = [f"{field} = :{field}" for field in fields.keys()]
-        query = f"UPDATE {tables.Service.__name__} SET {",".join(clauses)} WHERE name = :sn"
+        if (query := UPDATE_SERVICE.get(frozenset(fields))) is None:
+            raise exceptions.UserInputError("Unknown fields given")
         if (new_service_name := fields.get("name")) is not None:
-            internal_query = "UPDATE internal.service_ownership SET service_name = ? WHERE service_name = ?"
             async with self.db.connect() as conn:
                 try:
+                    # Detached by connect(), whatever happens
                     await conn.execute("ATTACH DATABASE ? AS internal", (paths.DATA_PATH + DB_INTERNAL,))
                     await conn.execute("PRAGMA internal.foreign_keys = ON")
                     await conn.execute("BEGIN")
                     await conn.execute(query, dict(**fields, sn=service_name))
-                    await conn.execute(internal_query, (new_service_name, service_name))
+                    await conn.execute(UPDATE_SERVICE_OWNERSHIP, (new_service_name, service_name))
                     await conn.commit()
                 except aiosqlite.IntegrityError as e:
                     await conn.rollback()
@@ -145,8 +216,6 @@ class UserACLRepository(msgspec.Struct, gc=False):
                     shared.print_err(e)
                     await conn.rollback()
                     raise
-                finally:
-                    await conn.execute("DETACH DATABASE internal")
             return None
 
         await self.db.execute_void(query, dict(**fields, sn=service_name))
@@ -154,17 +223,22 @@ class UserACLRepository(msgspec.Struct, gc=False):
     # endregion
     # region: Delete
     async def delete_service_from_user(self, user_id: types.UserID, service_name: str):
-        query = f"DELETE FROM {tables.Has_Service.__name__} WHERE user_id = ? AND service_name = ?"
-        await self.db.execute_void(query, (user_id, service_name))
+        await self.db.execute_void(DELETE_USER_SERVICE, (user_id, service_name))
 
     async def unregister_service(self, service_name: str):
         async with self.db.connect() as conn:
             try:
+                # Detached by connect(), whatever happens
                 await conn.execute("ATTACH DATABASE ? AS internal", (paths.DATA_PATH + DB_INTERNAL,))
                 await conn.execute("PRAGMA internal.foreign_keys = ON")
                 await conn.execute("BEGIN")
-                await conn.execute(f"DELETE FROM {tables.Service.__name__} WHERE name = ?", (service_name,))
-                await conn.execute("DELETE FROM internal.service_ownership WHERE service_name = ?", (service_name,))
+                await conn.execute(DELETE_SERVICE, (service_name,))
+                await conn.execute(DELETE_SERVICE_OWNERSHIP, (service_name,))
                 await conn.commit()
-            finally:
-                await conn.execute("DETACH DATABASE internal")
+            except aiosqlite.IntegrityError as e:
+                await conn.rollback()
+                raise exceptions.IntegrityError(str(e)) from e
+            except Exception as e:
+                shared.print_err(e)
+                await conn.rollback()
+                raise
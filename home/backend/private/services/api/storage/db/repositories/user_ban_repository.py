@@ -3,11 +3,40 @@ from datetime import UTC, datetime
 import msgspec
 from core import types
 from storage.db import tables
+from storage.db.sql import queries
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 from utils import time_helpers
 
 from appdata import shared  # type: ignore
 
+_ACTIVE = "user_id = ? AND is_active = 1 AND end_time > ?"
+
+USER_BANS_ROW = RowDecoder(tables.User_Bans)
+SELECT_ACTIVE_BAN = queries.register(
+    "user_bans.active", f"SELECT {USER_BANS_ROW.columns} FROM {tables.User_Bans.__name__} WHERE {_ACTIVE} LIMIT 1"
+)
+EXISTS_ACTIVE_BAN = queries.register(
+    "user_bans.is_banned", f"SELECT 1 FROM {tables.User_Bans.__name__} WHERE {_ACTIVE} LIMIT 1"
+)
+INSERT_BAN = queries.register(
+    "user_bans.insert",
+    f"INSERT INTO {tables.User_Bans.__name__}"
+    " (user_id, is_active, banned_by, unbanned_by, reason, start_time, end_time) VALUES (?,?,?,?,?,?,?)",
+)
+COUNT_BANS = queries.register(
+    "user_bans.count", f"SELECT COUNT(*) FROM {tables.User_Bans.__name__} WHERE user_id = ? LIMIT 1"
+)
+UNBAN = queries.register(
+    "user_bans.unban", f"UPDATE {tables.User_Bans.__name__} SET is_active = 0, unbanned_by = ? WHERE {_ACTIVE}"
+)
+UPDATE_END_TIME = queries.register(
+    "user_bans.update_end_time", f"UPDATE {tables.User_Bans.__name__} SET end_time = ? WHERE {_ACTIVE}"
+)
+UPDATE_REASON = queries.register(
+    "user_bans.update_reason", f"UPDATE {tables.User_Bans.__name__} SET reason = ? WHERE {_ACTIVE}"
+)
+
 
 class UserBanRepository(msgspec.Struct, gc=False):
     db: SQLite
@@ -30,54 +59,37 @@ class UserBanRepository(msgspec.Struct, gc=False):
         _end_time = time_helpers.generate_end_date(now, end_time)
         _now = shared.datetime_to_isofmtZ(now)
 
-        query_check = f"SELECT * FROM {self._table_name} WHERE user_id = ? AND is_active = 1 AND end_time > ? LIMIT 1"
-        query_insert = (
-            f"INSERT INTO {self._table_name} (user_id, is_active, banned_by, unbanned_by, reason, start_time, end_time) "
-            "VALUES (?,?,?,?,?,?)"
-        )
         async with self.db.connect() as conn:
-            async with conn.execute(query_check, (user_id, _now)) as cur:
+            async with conn.execute(SELECT_ACTIVE_BAN, (user_id, _now)) as cur:
                 if row := await cur.fetchone():
                     return msgspec.convert(row, type=self._table)
 
-            await conn.execute(query_insert, (user_id, True, banned_by, None, reason, _now, _end_time))
+            await conn.execute(INSERT_BAN, (user_id, True, banned_by, None, reason, _now, _end_time))
             await conn.commit()
 
     # endregion
     # region: Read
     async def get_user_ban(self, user_id: types.UserID):
-        query = f"SELECT * FROM {self._table_name} WHERE user_id = ? AND is_active = 1 AND end_time > ? LIMIT 1"
-        if row := await self.db.fetch_one(query, (user_id, shared.datetime_now_isofmtZ())):
-            return msgspec.convert(row, type=self._table, strict=False)
+        return await self.db.fetch_struct(USER_BANS_ROW, SELECT_ACTIVE_BAN, (user_id, shared.datetime_now_isofmtZ()))
 
     async def is_user_banned(self, user_id: types.UserID):
-        query = f"SELECT 1 FROM {self._table_name} WHERE user_id = ? AND is_active = 1 AND end_time > ? LIMIT 1"
-        return await self.db.fetch_one(query, (user_id, shared.datetime_now_isofmtZ())) is not None
+        return await self.db.fetch_one(EXISTS_ACTIVE_BAN, (user_id, shared.datetime_now_isofmtZ())) is not None
 
     async def user_number_of_bans(self, user_id: types.UserID) -> int:
-        query = f"SELECT COUNT(*) FROM {self._table_name} WHERE user_id = ? LIMIT 1"
-        return await self.db.fetch_one(query, (user_id,))  # type: ignore
+        return await self.db.fetch_one(COUNT_BANS, (user_id,))  # type: ignore
 
     # endregion
     # region: Update
     async def unban_user(self, user_id: types.UserID, unbanned_by: types.UserID | None):
-        query = (
-            f"UPDATE {self._table_name}"
-            " SET is_active = 0, unbanned_by = ? WHERE user_id = ? AND is_active = 1 AND end_time > ?"
-        )
-
-        return await self.db.execute_void(query, (unbanned_by, user_id, shared.datetime_now_isofmtZ()))
+        return await self.db.execute_void(UNBAN, (unbanned_by, user_id, shared.datetime_now_isofmtZ()))
 
     async def update_user_ban_end_time(self, user_id: types.UserID, end_time: types.DateT):
         now = datetime.now(UTC)
         _end_time = time_helpers.generate_end_date(now, end_time)
-
-        query = f"UPDATE {self._table_name} SET end_time = ? WHERE user_id = ? AND is_active = 1 AND end_time > ?"
-        return await self.db.execute_void(query, (_end_time, user_id, shared.datetime_to_isofmtZ(now)))
+        return await self.db.execute_void(UPDATE_END_TIME, (_end_time, user_id, shared.datetime_to_isofmtZ(now)))
 
     async def update_user_ban_reason(self, user_id: types.UserID, new_reason: str):
-        query = f"UPDATE {self._table_name} SET reason = ? WHERE user_id = ? AND is_active = 1 AND end_time > ?"
-        return await self.db.execute_void(query, (new_reason, user_id, shared.datetime_now_isofmtZ()))
+        return await self.db.execute_void(UPDATE_REASON, (new_reason, user_id, shared.datetime_now_isofmtZ()))
 
     # endregion
     # region: Delete
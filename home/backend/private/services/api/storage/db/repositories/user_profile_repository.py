@@ -3,10 +3,17 @@ from typing import TypedDict, Unpack
 import msgspec
 from core import exceptions, types
 from storage.db import tables
+from storage.db.sql import queries
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 
 from . import update_fields
 
+PROFILE_ROW = RowDecoder(tables.User_Profile)
+SELECT_PROFILE = queries.register(
+    "user_profile.by_user_id", f"SELECT {PROFILE_ROW.columns} FROM {tables.User_Profile.__name__} WHERE user_id = ?"
+)
+
 
 class UserProfileUpdateFields(TypedDict, total=False):
     display_name: str
@@ -20,9 +27,8 @@ class UserProfileRepository(msgspec.Struct):
         Raises:
             NotFoundError: if name or mail does not exist
         """
-        query = f"SELECT * FROM {tables.User_Profile.__name__} WHERE user_id = ?"
-        if row := await self.db.fetch_one(query, (user_id,)):
-            return msgspec.convert(row, type=tables.User_Profile)
+        if profile := await self.db.fetch_struct(PROFILE_ROW, SELECT_PROFILE, (user_id,)):
+            return profile
         raise exceptions.NotFoundError
 
     async def update_user_profile(self, user_id: types.UserID, **fields: Unpack[UserProfileUpdateFields]):
@@ -1,21 +1,65 @@
 from datetime import UTC, datetime
-from typing import TypedDict, Unpack
+from typing import NamedTuple, Sequence, TypedDict, Unpack
 
 import aiosqlite
 import msgspec
 from core import enums, exceptions, types
 from storage.db import tables
+from storage.db.sql import queries
+from storage.db.sql.rows import RowDecoder
 from storage.db.sql.sqlite import SQLite
 from utils import time_helpers
 
 from appdata import shared  # type: ignore
 
+from . import integrity_errors
+
 
 class UpdateRoleField(TypedDict, total=False):
     valid_from: shared.DateTimeUTC
     valid_to: types.DateT
 
 
+class NewRole(NamedTuple):
+    user_id: types.UserID
+    role: enums.UserRoles
+    valid_from: shared.DateTimeUTC | None
+    valid_to: types.DateT
+
+
+HAS_ROLE_ROW = RowDecoder(tables.Has_Role)
+INSERT_USER_ROLE = queries.register(
+    "has_role.insert",
+    f"INSERT INTO {tables.Has_Role.__name__}"
+    " (valid_from, valid_to, created_date, user_id, role_name, given_by) VALUES (?,?,?,?,?,?)",
+)
+SELECT_USER_ROLES = queries.register(
+    "has_role.by_user_id", f"SELECT {HAS_ROLE_ROW.columns} FROM {tables.Has_Role.__name__} WHERE user_id = ?"
+)
+SELECT_USER_VALID_ROLES = queries.register(
+    "has_role.valid_by_user_id",
+    f"SELECT role_name FROM {tables.Has_Role.__name__}"
+    " WHERE user_id = :user_id AND valid_from <= :now AND valid_to >= :now",
+)
+SELECT_ROLE_USER_IDS = queries.register(
+    "has_role.user_ids", f"SELECT user_id FROM {tables.Has_Role.__name__} WHERE role_name = ?"
+)
+UPDATE_ROLE = queries.register_updates(
+    "has_role.update",
+    tables.Has_Role.__name__,
+    ("valid_from", "valid_to"),
+    where="user_id = :user_id AND role_name = :role_name",
+)
+REPLACE_ROLE = queries.register(
+    "has_role.replace",
+    f"UPDATE {tables.Has_Role.__name__} SET role_name = ?, given_by = ?, created_date = ?"
+    " WHERE user_id = ? AND role_name = ?",
+)
+DELETE_ROLE = queries.register(
+    "has_role.delete", f"DELETE FROM {tables.Has_Role.__name__} WHERE user_id = ? AND role_name = ?"
+)
+
+
 class UserRoleRepository(msgspec.Struct, gc=False):
     db: SQLite
 
@@ -35,34 +79,49 @@ class UserRoleRepository(msgspec.Struct, gc=False):
         now = datetime.now(UTC)
         start_time = shared.datetime_to_isofmtZ(valid_from) if valid_from else time_helpers.DATETIME_MIN_STR
         end_time = time_helpers.generate_end_date(now, valid_to)
-        query = (
-            f"INSERT INTO {tables.Has_Role.__name__}"
-            " (valid_from, valid_to, created_date, user_id, role_name, given_by) "
-            f"VALUES ('{start_time}', '{end_time}', '{shared.datetime_to_isofmtZ(now)}', ?, ?, ?)"
-        )
+        params = (start_time, end_time, shared.datetime_to_isofmtZ(now), user_id, role, given_by)
 
         try:
-            await self.db.execute_void(query, (user_id, role, given_by))
+            await self.db.execute_void(INSERT_USER_ROLE, params)
         except aiosqlite.IntegrityError as e:
             raise exceptions.IntegrityError(str(e)) from e
 
+    async def insert_user_roles(
+        self, roles: Sequence[NewRole], given_by: types.UserID | None = None
+    ) -> list[Exception | None]:
+        """In one transaction. Returns the error of every role, or None. IntegrityError if a value already exists,
+        UserInputError if valid_to is expired"""
+        now = datetime.now(UTC)
+        _now = shared.datetime_to_isofmtZ(now)
+        errors: list[Exception | None] = [None] * len(roles)
+        indices: list[int] = []
+        rows: list[tuple] = []
+        for i, (user_id, role, valid_from, valid_to) in enumerate(roles):
+            try:
+                end_time = time_helpers.generate_end_date(now, valid_to)
+            except exceptions.UserInputError as e:
+                errors[i] = e
+                continue
+            start_time = shared.datetime_to_isofmtZ(valid_from) if valid_from else time_helpers.DATETIME_MIN_STR
+            indices.append(i)
+            rows.append((start_time, end_time, _now, user_id, role, given_by))
+
+        for i, error in zip(indices, integrity_errors(await self.db.execute_batch(((INSERT_USER_ROLE, rows),)))):
+            errors[i] = error
+        return errors
+
     # endregion
     # region: Read
     async def get_user_roles(self, user_id: types.UserID):
-        query = f"SELECT * FROM {tables.Has_Role.__name__} WHERE user_id = ?"
-        return [msgspec.convert(row, type=tables.Has_Role) for row in await self.db.fetch_all(query, (user_id,))]
+        return await self.db.fetch_structs(HAS_ROLE_ROW, SELECT_USER_ROLES, (user_id,))
 
     async def get_user_valid_roles(self, user_id: types.UserID):
-        now = shared.datetime_now_isofmtZ()
-        query = (
-            f"SELECT role_name FROM {tables.Has_Role.__name__} "
-            f"WHERE user_id = ? AND valid_from <= '{now}' AND valid_to >= '{now}'"
-        )
-        return [enums.UserRoles(row["role_name"]) for row in await self.db.fetch_all(query, (user_id,))]
+        params = {"user_id": user_id, "now": shared.datetime_now_isofmtZ()}
+        rows = await self.db.fetch_all(SELECT_USER_VALID_ROLES, params)
+        return [enums.UserRoles(row["role_name"]) for row in rows]
 
     async def find_user_ids_by_role(self, role: enums.UserRoles) -> list[types.UserID]:
-        query = f"SELECT user_id FROM {tables.Has_Role.__name__} WHERE role_name = ?"
-        return await self.db.fetch_all(query, (role,))  # type: ignore
+        return await self.db.fetch_all(SELECT_ROLE_USER_IDS, (role,))  # type: ignore
 
     # endregion
     # region: Update
@@ -71,16 +130,17 @@ class UserRoleRepository(msgspec.Struct, gc=False):
             raise exceptions.UserInputError("No fields given")
 
         now = datetime.now(UTC)
-        clauses = []
+        values: dict[str, str] = {}
         if field := fields.get("valid_from"):
             if field <= now:
                 raise exceptions.UserInputError("Not allowed to move valid date in the past")
-            clauses.append(f"valid_from = '{shared.datetime_to_isofmtZ(field)}'")
+            values["valid_from"] = shared.datetime_to_isofmtZ(field)
         if "valid_to" in fields:
-            clauses.append(f"valid_to = '{time_helpers.generate_end_date(now, fields['valid_to'])}'")
+            values["valid_to"] = time_helpers.generate_end_date(now, fields["valid_to"])
+        if not values:
+            raise exceptions.UserInputError("No fields given")
 
-        query = f"UPDATE {tables.Has_Role.__name__} SET {",".join(clauses)} WHERE user_id = ? AND role_name = ?"
-        await self.db.execute_void(query, (user_id, role))
+        await self.db.execute_void(UPDATE_ROLE[frozenset(values)], dict(**values, user_id=user_id, role_name=role))
 
     async def replace_role(
         self,
@@ -95,18 +155,12 @@ class UserRoleRepository(msgspec.Struct, gc=False):
         """
         now = shared.datetime_now_isofmtZ()
 
-        query = (
-            f"UPDATE {tables.Has_Role.__name__}"
-            " SET role_name = ?, given_by = ?, created_date = ?"
-            " WHERE user_id = ? AND role_name = ?"
-        )
         try:
-            await self.db.execute_void(query, (new_role, given_by, now, user_id, old_role))
+            await self.db.execute_void(REPLACE_ROLE, (new_role, given_by, now, user_id, old_role))
         except aiosqlite.IntegrityError as e:
             raise exceptions.IntegrityError(str(e)) from e
 
     # endregion
     # region: Delete
     async def delete_role(self, user_id: types.UserID, role: enums.UserRoles):
-        query = f"DELETE FROM {tables.Has_Role.__name__} WHERE user_id = ? AND role_name = ?"
-        await self.db.execute_void(query, (user_id, role))
+        await self.db.execute_void(DELETE_ROLE, (user_id, role))
@@ -0,0 +1,25 @@
+"""
+Opaque cursors for keyset pagination. A cursor holds the sort key of the last row of a page, the next page continues
+after it with a range scan on an index of that key, instead of stepping over OFFSET rows.
+"""
+
+import base64
+from typing import Any
+
+import msgspec
+from core import exceptions
+
+
+def encode(*key: Any) -> str:
+    return base64.urlsafe_b64encode(msgspec.msgpack.encode(key)).decode().rstrip("=")
+
+
+def decode[T](cursor: str, type: type[T]) -> T:
+    """
+    Raises:
+        UserInputError: if the cursor is not a key of type
+    """
+    try:
+        return msgspec.msgpack.decode(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)), type=type)
+    except (ValueError, msgspec.DecodeError) as e:
+        raise exceptions.UserInputError("Invalid cursor") from e
@@ -0,0 +1,65 @@
+"""
+Registry of the SQL statements. Every statement is a fixed, parameterized string registered once by name at import,
+so SQLite's statement cache (per connection) reuses its prepared form. Values are always bound, never inlined.
+Dynamic updates pick one of a bounded set of precomputed variants, one per set of columns.
+SQLite records the executions of every statement here, by name.
+"""
+
+import itertools
+from typing import Iterable
+
+import msgspec
+
+ADHOC = "adhoc"  # Statements that were not registered
+
+
+class QueryStats(msgspec.Struct):
+    calls: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+_names: dict[str, str] = {}  # sql -> name
+_stats: dict[str, QueryStats] = {}  # name -> stats
+
+
+def register(name: str, sql: str) -> str:
+    if name in _stats or _names.setdefault(sql, name) != name:
+        raise ValueError(f"Statement {name} is already registered, or as {_names[sql]}")
+    _stats[name] = QueryStats()
+    return sql
+
+
+def register_updates(
+    name: str,
+    table: str,
+    columns: Iterable[str],
+    where: str,
+    extra_set: str = "",  # e.g. ", last_updated_date = :now"
+    only_if_changed=False,  # Skip rows (and the write) where every value is unchanged
+) -> dict[frozenset[str], str]:
+    """UPDATE variants for every non-empty subset of columns, bound as :column"""
+    columns = tuple(columns)
+    variants: dict[frozenset[str], str] = {}
+    for count in range(1, len(columns) + 1):
+        for subset in itertools.combinations(columns, count):
+            sql = f"UPDATE {table} SET {", ".join(f"{col} = :{col}" for col in subset)}{extra_set} WHERE {where}"
+            if only_if_changed:
+                sql += f" AND ({" OR ".join(f"{col} IS NOT :{col}" for col in subset)})"
+            variants[frozenset(subset)] = register(f"{name}[{",".join(subset)}]", sql)
+    return variants
+
+
+def record(sql: str, seconds: float, error=False) -> None:
+    stats = _stats.setdefault(_names.get(sql, ADHOC), QueryStats())
+    ms = seconds * 1000
+    stats.calls += 1
+    stats.errors += error
+    stats.total_ms += ms
+    stats.max_ms = max(stats.max_ms, ms)
+
+
+def stats() -> dict[str, QueryStats]:
+    """Executed statements, by total time spent"""
+    return dict(sorted(((k, v) for k, v in _stats.items() if v.calls), key=lambda item: -item[1].total_ms))
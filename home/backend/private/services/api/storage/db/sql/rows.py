@@ -0,0 +1,31 @@
+"""
+Decodes plain row tuples into table Structs, without aiosqlite.Row. Select `decoder.columns` to get the Struct's field
+order. A batch is converted in one msgspec call through an array_like twin of the Struct (same fields and types,
+lax like strict=False), then every Struct is built positionally.
+"""
+
+from itertools import starmap
+from typing import Any, Iterable, Sequence
+
+import msgspec
+
+_astuple = msgspec.structs.astuple
+
+
+class RowDecoder[T: msgspec.Struct]:
+    __slots__ = ("type", "columns", "_row_type")
+
+    def __init__(self, type: type[T]) -> None:
+        fields = msgspec.structs.fields(type)
+        self.type = type
+        self.columns = ", ".join(field.name for field in fields)
+        self._row_type = msgspec.defstruct(
+            f"{type.__name__}Row", [(field.name, field.type) for field in fields], array_like=True
+        )
+
+    def one(self, row: Sequence[Any]) -> T:
+        return self.type(*_astuple(msgspec.convert(row, type=self._row_type, strict=False)))
+
+    def all(self, rows: Iterable[Sequence[Any]]) -> list[T]:
+        rows = msgspec.convert(rows if isinstance(rows, list) else list(rows), type=list[self._row_type], strict=False)
+        return list(starmap(self.type, map(_astuple, rows)))
@@ -24,7 +24,7 @@ CREATE TABLE registration ( -- Historical, when created (READ ONLY)
         ON DELETE SET NULL
 );
 CREATE INDEX idx_registration_created_by ON registration(created_by);
-CREATE INDEX idx_registration_created_date ON registration(created_date);
+CREATE INDEX idx_registration_created_date_user ON registration(created_date, user_id); -- Keyset pages
 
 CREATE TABLE user_profile (
     user_id           TEXT PRIMARY KEY NOT NULL,
@@ -35,6 +35,41 @@ CREATE TABLE user_profile (
 );
 CREATE INDEX idx_user_data_api_name ON user_profile(display_name COLLATE NOCASE);
 
+-- Substring search (case-insensitive, 3+ characters), ranked with bm25. Kept in sync with user and user_profile.
+-- Rows are found by user_id, the rowid of user is not stable across VACUUM.
+CREATE VIRTUAL TABLE user_search USING fts5(
+    user_id UNINDEXED,
+    login_name,
+    login_mail,
+    display_name,
+    tokenize = 'trigram'
+);
+
+CREATE TRIGGER user_search_insert_user AFTER INSERT ON user
+BEGIN
+    INSERT INTO user_search (user_id, login_name, login_mail) VALUES (NEW.user_id, NEW.login_name, NEW.login_mail);
+END;
+
+CREATE TRIGGER user_search_update_user AFTER UPDATE OF login_name, login_mail ON user
+BEGIN
+    UPDATE user_search SET login_name = NEW.login_name, login_mail = NEW.login_mail WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER user_search_delete_user AFTER DELETE ON user
+BEGIN
+    DELETE FROM user_search WHERE user_id = OLD.user_id;
+END;
+
+CREATE TRIGGER user_search_insert_profile AFTER INSERT ON user_profile
+BEGIN
+    UPDATE user_search SET display_name = NEW.display_name WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER user_search_update_profile AFTER UPDATE OF display_name ON user_profile
+BEGIN
+    UPDATE user_search SET display_name = NEW.display_name WHERE user_id = NEW.user_id;
+END;
+
 -- ====================
 -- Roles & Access
 -- ====================
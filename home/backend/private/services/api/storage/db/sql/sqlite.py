@@ -1,17 +1,54 @@
+import asyncio
+import time
 from contextlib import asynccontextmanager
-from typing import Any, AsyncGenerator, Iterable
+from typing import Any, AsyncGenerator, Iterable, NamedTuple, Sequence
 
 import aiosqlite
 import aiosqlitepool
+import msgspec
+
+from . import queries
+from .rows import RowDecoder
 
 type DBConnection = aiosqlite.Connection
 
 
+class WriterStats(msgspec.Struct):
+    writes: int = 0
+    failed: int = 0  # Rolled back on their own, the rest of the batch was committed
+    commits: int = 0  # writes / commits is the mean batch size
+    queue_wait_ms: float = 0.0  # Sum, enqueued until the batch started
+    queue_wait_ms_max: float = 0.0
+    commit_ms: float = 0.0  # Sum, BEGIN until COMMIT returned
+    commit_ms_max: float = 0.0
+
+
+class _Write(NamedTuple):
+    query: str
+    params: Iterable[Any] | dict[str, Any]
+    future: asyncio.Future[int]
+    enqueued: float
+
+
 class SQLite:
-    __slots__ = ("_pool",)
+    """Reads use a pool of query_only connections. Single statement writes are queued to one writer connection,
+    which commits everything that arrived within group_commit_window (up to max_batch) in one transaction.
+    Bulk writes bypass the queue with execute_batch."""
+
+    __slots__ = (
+        "group_commit_window",
+        "max_batch",
+        "stats",
+        "_pool",
+        "_connection_factory",
+        "_writer",
+        "_writer_lock",
+        "_writes",
+        "_writer_task",
+    )
 
-    def __init__(self, dbfile: str, pool_size=5) -> None:
-        async def _connection_factory() -> DBConnection:
+    def __init__(self, dbfile: str, pool_size=5, group_commit_window=0.002, max_batch=64) -> None:
+        async def _connection_factory(query_only=True) -> DBConnection:
             conn = await aiosqlite.connect(dbfile)
             await conn.execute("PRAGMA journal_mode = WAL")
             await conn.execute("PRAGMA synchronous = NORMAL")
@@ -19,37 +56,232 @@ class SQLite:
             await conn.execute("PRAGMA temp_store = MEMORY")
             await conn.execute("PRAGMA foreign_keys = ON")
             await conn.execute("PRAGMA mmap_size = 268435456")
+            await conn.execute("PRAGMA busy_timeout = 5000")
+            if query_only:
+                await conn.execute("PRAGMA query_only = ON")
             conn.row_factory = aiosqlite.Row
 
             return conn
 
+        self.group_commit_window = group_commit_window  # seconds
+        self.max_batch = max_batch
+        self.stats = WriterStats()
         self._pool = aiosqlitepool.SQLiteConnectionPool(
             connection_factory=_connection_factory,  # type: ignore
             pool_size=pool_size,
         )
+        self._connection_factory = _connection_factory
+        self._writer: DBConnection | None = None
+        self._writer_lock = asyncio.Lock()  # Held by a batch or a connect() transaction
+        self._writes: asyncio.Queue[_Write] = asyncio.Queue()
+        self._writer_task: asyncio.Task | None = None
 
     @asynccontextmanager
-    async def connect(self) -> AsyncGenerator[DBConnection, None]:
+    async def read(self) -> AsyncGenerator[DBConnection, None]:
         async with self._pool.connection() as conn:
             yield conn  # type: ignore
 
+    @asynccontextmanager
+    async def connect(self) -> AsyncGenerator[DBConnection, None]:
+        """
+        The writer connection, for multi statement transactions. Commit before leaving, the rest is rolled back.
+        Attached databases are detached on leaving, the connection is shared.
+        """
+        async with self._writer_lock:
+            conn = await self._writer_connection()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    await conn.rollback()
+                await self._detach_all(conn)
+
     async def close(self) -> None:
+        if self._writer_task is not None:
+            await self._writes.join()
+            self._writer_task.cancel()
+        async with self._writer_lock:
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
         await self._pool.close()
 
-    async def fetch_all(self, query: str, params: Iterable[Any] | None = None) -> Iterable[Any]:
+    async def fetch_all(self, query: str, params: Iterable[Any] | dict[str, Any] | None = None) -> Iterable[Any]:
+        conn: DBConnection
+        async with self._pool.connection() as conn:  # type: ignore
+            start, error = time.perf_counter(), True
+            try:
+                rows = await conn.execute_fetchall(query, params)
+                error = False
+                return rows
+            finally:
+                queries.record(query, time.perf_counter() - start, error)
+
+    async def fetch_one(self, query: str, params: Iterable[Any] | dict[str, Any] | None = None) -> Any | None:
         conn: DBConnection
         async with self._pool.connection() as conn:  # type: ignore
-            return await conn.execute_fetchall(query, params)
+            start, error = time.perf_counter(), True
+            try:
+                cur = await conn.execute(query, params)
+                row = await cur.fetchone()
+                error = False
+                return row
+            finally:
+                queries.record(query, time.perf_counter() - start, error)
 
-    async def fetch_one(self, query: str, params: Iterable[Any] | None = None) -> Any | None:
+    async def fetch_structs[T: msgspec.Struct](
+        self, decoder: RowDecoder[T], query: str, params: Iterable[Any] | dict[str, Any] | None = None
+    ) -> list[T]:
+        """fetch_all as plain tuples, decoded as one batch. Select decoder.columns"""
         conn: DBConnection
         async with self._pool.connection() as conn:  # type: ignore
-            cur = await conn.execute(query, params)
-            return await cur.fetchone()
+            start, error = time.perf_counter(), True
+            try:
+                cur = await conn.execute(query, params)
+                cur.row_factory = None
+                rows = await cur.fetchall()
+                error = False
+            finally:
+                queries.record(query, time.perf_counter() - start, error)
+        return decoder.all(rows)
 
-    async def execute_void(self, query: str, params: Iterable[Any]) -> None:
-        """Return nothing. Should be for INSERT, UPDATE, DELETE"""
+    async def fetch_struct[T: msgspec.Struct](
+        self, decoder: RowDecoder[T], query: str, params: Iterable[Any] | dict[str, Any] | None = None
+    ) -> T | None:
         conn: DBConnection
         async with self._pool.connection() as conn:  # type: ignore
-            await conn.execute(query, params)
+            start, error = time.perf_counter(), True
+            try:
+                cur = await conn.execute(query, params)
+                cur.row_factory = None
+                row = await cur.fetchone()
+                error = False
+            finally:
+                queries.record(query, time.perf_counter() - start, error)
+        return None if row is None else decoder.one(row)
+
+    async def execute_void(self, query: str, params: Iterable[Any] | dict[str, Any]) -> int:
+        """For INSERT, UPDATE, DELETE. Returns the number of changed rows once committed, or raises its own error."""
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._write_loop(), name="sqlite_writer")
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait(_Write(query, params, future, time.perf_counter()))
+        return await future
+
+    async def execute_batch(self, statements: Sequence[tuple[str, Sequence[Any]]]) -> list[Exception | None]:
+        """
+        Applies a batch of items in one transaction, item i is every statement run with its i:th params. Each
+        statement runs once with executemany. If one fails, the batch is applied again item by item under savepoints,
+        so only the failing items are left out. Returns the error of every item, or None.
+        """
+        errors: list[Exception | None] = [None] * (len(statements[0][1]) if statements else 0)
+        if not errors:
+            return errors
+
+        enqueued = time.perf_counter()
+        async with self.connect() as conn:
+            start = time.perf_counter()
+            self._record_wait((start - enqueued) * 1000, len(errors))  # Waited for the writer lock
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                for query, rows in statements:
+                    executed, error = time.perf_counter(), True
+                    try:
+                        await conn.executemany(query, rows)
+                        error = False
+                    finally:
+                        queries.record(query, time.perf_counter() - executed, error)
+                await conn.commit()
+            except aiosqlite.Error:
+                await conn.rollback()
+                await conn.execute("BEGIN IMMEDIATE")
+                for i in range(len(errors)):
+                    await conn.execute("SAVEPOINT item")
+                    try:
+                        for query, rows in statements:
+                            await conn.execute(query, rows[i])
+                    except aiosqlite.Error as e:
+                        await conn.execute("ROLLBACK TO item")
+                        self.stats.failed += 1
+                        errors[i] = e
+                    finally:
+                        await conn.execute("RELEASE item")
+                await conn.commit()
+            self._record_commit(len(errors), (time.perf_counter() - start) * 1000)
+        return errors
+
+    @staticmethod
+    async def _detach_all(conn: DBConnection):
+        async with conn.execute("PRAGMA database_list") as cur:
+            attached = [row[1] for row in await cur.fetchall() if row[1] not in ("main", "temp")]
+        for name in attached:
+            await conn.execute(f"DETACH DATABASE {name}")
+
+    async def _writer_connection(self) -> DBConnection:
+        if self._writer is None:
+            self._writer = await self._connection_factory(query_only=False)
+        return self._writer
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._writes.get()]
+            if self.group_commit_window:
+                await asyncio.sleep(self.group_commit_window)
+            while len(batch) < self.max_batch and not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            try:
+                async with self._writer_lock:
+                    await self._commit(await self._writer_connection(), batch)
+            except Exception as e:
+                for write in batch:
+                    if not write.future.done():
+                        write.future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    def _record_wait(self, wait_ms: float, writes=1):
+        self.stats.queue_wait_ms += wait_ms * writes
+        self.stats.queue_wait_ms_max = max(self.stats.queue_wait_ms_max, wait_ms)
+
+    def _record_commit(self, writes: int, commit_ms: float):
+        self.stats.writes += writes
+        self.stats.commits += 1
+        self.stats.commit_ms += commit_ms
+        self.stats.commit_ms_max = max(self.stats.commit_ms_max, commit_ms)
+
+    async def _commit(self, conn: DBConnection, batch: list[_Write]):
+        start = time.perf_counter()
+        for write in batch:
+            self._record_wait((start - write.enqueued) * 1000)
+
+        done: list[tuple[_Write, int]] = []
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            for write in batch:
+                if write.future.cancelled():
+                    continue
+                await conn.execute("SAVEPOINT write")  # A failing statement only undoes itself
+                executed = time.perf_counter()
+                try:
+                    cur = await conn.execute(write.query, write.params)
+                    queries.record(write.query, time.perf_counter() - executed)
+                    done.append((write, cur.rowcount))
+                except Exception as e:
+                    queries.record(write.query, time.perf_counter() - executed, error=True)
+                    await conn.execute("ROLLBACK TO write")
+                    self.stats.failed += 1
+                    if not write.future.done():  # The caller may have been cancelled meanwhile
+                        write.future.set_exception(e)
+                finally:
+                    await conn.execute("RELEASE write")
             await conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                await conn.rollback()
+            raise
+
+        self._record_commit(len(batch), (time.perf_counter() - start) * 1000)
+        for write, rowcount in done:
+            if not write.future.done():
+                write.future.set_result(rowcount)
@@ -50,7 +50,7 @@ class Has_Role(Struct):
 
 class Service(Struct):
     name: str
-    url: str
+    url: str | None
     description: str
     created_date: shared.DateTimeUTC
 
@@ -69,8 +69,8 @@ class User_Bans(Struct):
     _id: int  # Auto-incremented(table wide). Users can have multiple bans.
     user_id: types.UserID
     is_active: bool
-    banned_by: types.UserID
-    unbanned_by: types.UserID
+    banned_by: types.UserID | None
+    unbanned_by: types.UserID | None
     reason: str
     start_time: shared.DateTimeUTC
     end_time: shared.DateTimeUTC
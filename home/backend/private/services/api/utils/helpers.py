@@ -3,7 +3,7 @@ import base64
 import secrets
 import time
 from concurrent.futures.process import ProcessPoolExecutor
-from typing import Any, Callable, cast
+from typing import Any, Callable, Iterable, cast
 
 import msgspec
 from bcrypt import checkpw, gensalt, hashpw
@@ -15,7 +15,10 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 
-process_pool = ProcessPoolExecutor(2)
+PROCESS_POOL_WORKERS = 2
+process_pool = ProcessPoolExecutor(PROCESS_POOL_WORKERS)
+# Bulk work queues at most this many calls on the pool at a time, so login checks are not queued behind all of it
+_bulk_slots = asyncio.Semaphore(PROCESS_POOL_WORKERS)
 
 
 async def pool_runner[T](func: Callable[..., T], *args):
@@ -38,6 +41,16 @@ async def hash_password_b64_threaded(password: str) -> str:
     return await pool_runner(hash_password_b64, password)
 
 
+async def hash_passwords_b64_threaded(passwords: Iterable[str]) -> list[str]:
+    """In order, spread over the process pool. Interleaves with other pool calls, like check_password_b64_threaded."""
+
+    async def hash_password(password: str) -> str:
+        async with _bulk_slots:
+            return await pool_runner(hash_password_b64, password)
+
+    return await asyncio.gather(*(hash_password(password) for password in passwords))
+
+
 def hash_password_b64(password: str) -> str:
     return base64.b64encode(hashpw(password.encode(), gensalt())).decode()
 
@@ -0,0 +1,316 @@
+"""
+Incremental page-level backups of the SQLite databases.
+
+Every run snapshots each database with the backup API and compares its pages to the page digests of the last run.
+Only changed pages are archived, so the upload scales with churn instead of database size. Every FULL_EVERY:th run is
+a full snapshot that starts a new chain. A database without digests (or with a new page size) is stored in full.
+
+The databases are processed in parallel, WORKERS at a time. A snapshot is taken in memory and its changed pages are
+zstd compressed straight into the FTP data connection, nothing is written to disk but the digests.
+Every database is uploaded to the FTP backup folder as "{seq:06d}_{full|incr}.{file}.zst".
+The KEEP_CHAINS newest chains are kept.
+
+Restore any point of a chain, from the FTP backup folder or a local folder of backups:
+python3 backup.py restore <ftp | folder> <output folder> [seq, default: latest]
+
+Manual run:
+python3 backup.py [full]
+"""
+
+__import__("sys").path.append("/")
+
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
+
+import msgspec
+import utils
+import zstandard
+
+from appdata import cfg_schema
+
+FULL_EVERY = int(os.environ.get("BACKUP_FULL_EVERY", 7))  # runs
+KEEP_CHAINS = int(os.environ.get("BACKUP_KEEP_CHAINS", 2))
+WORKERS = int(os.environ.get("BACKUP_WORKERS", 3))  # Each holds a database snapshot in memory
+ZSTD_LEVEL = int(os.environ.get("BACKUP_ZSTD_LEVEL", 3))
+DIGEST_SIZE = 8  # bytes, blake2b per page
+BACKUP_NAME = re.compile(r"^(\d{6})_(full|incr)\.(.+)\.zst$")
+
+type Upload = Callable[[str, BinaryIO], bool]  # (name, stream) -> stored
+
+
+class DatabaseDelta(msgspec.Struct):  # Header of a backup: u32 length + json, followed by the pages
+    page_size: int
+    page_count: int
+    pages: list[int] | None = None  # Changed page numbers, 1-based, in backup order. None: every page
+
+
+class BackupState(msgspec.Struct):  # Last uploaded run, "state.json" in the state folder
+    seq: int = 0
+    full_seq: int = 0
+    page_sizes: dict[str, int] = {}
+
+
+class DatabaseStats(msgspec.Struct):
+    database_bytes: int = 0
+    changed_bytes: int = 0
+    uploaded_bytes: int = 0  # Compressed
+    seconds: float = 0.0
+    uploaded: bool = False
+
+
+class BackupStats(msgspec.Struct):
+    seq: int
+    full: bool
+    seconds: float = 0.0
+    databases: dict[str, DatabaseStats] = {}
+
+    @property
+    def uploaded(self) -> bool:
+        return all(stats.uploaded for stats in self.databases.values())
+
+
+def backup_name(seq: int, full: bool, file: str) -> str:
+    return f"{seq:06d}_{"full" if full else "incr"}.{file}.zst"
+
+
+def parse_names(names: list[str]) -> list[tuple[int, bool, str]]:
+    """Backups as sorted (seq, full, name)"""
+    return sorted((int(m[1]), m[2] == "full", m[0]) for name in names if (m := BACKUP_NAME.match(name)))
+
+
+def select_chain(names: list[str], seq: int | None = None) -> list[str]:
+    """Backups to apply, in order, to restore seq: the last full snapshot up to seq and the incrementals after it"""
+    backups = [backup for backup in parse_names(names) if seq is None or backup[0] <= seq]
+    fulls = [backup_seq for backup_seq, full, _ in backups if full]
+    if not fulls:
+        raise ValueError("No full snapshot to restore from")
+    chain = [backup for backup in backups if backup[0] >= fulls[-1]]
+    if seq is not None and chain[-1][0] != seq:
+        raise ValueError(f"No backup with seq {seq}")
+    seqs = sorted({backup_seq for backup_seq, _, _ in chain})
+    if seqs != list(range(seqs[0], seqs[-1] + 1)):
+        raise ValueError(f"Chain from {seqs[0]} is broken")
+    return [name for _, _, name in chain]
+
+
+def expired_backups(names: list[str], keep_chains: int) -> list[str]:
+    """Backups older than the keep_chains newest full snapshots"""
+    backups = parse_names(names)
+    fulls = sorted({seq for seq, full, _ in backups if full})
+    if len(fulls) <= keep_chains:
+        return []
+    return [name for seq, _, name in backups if seq < fulls[-keep_chains]]
+
+
+def snapshot(source: Path) -> tuple[bytes, int]:
+    """Consistent in memory copy of a live database, as (database image, page size)"""
+    source_conn = sqlite3.connect(source)
+    target_conn = sqlite3.connect(":memory:")
+    source_conn.backup(target_conn)
+    (page_size,) = target_conn.execute("PRAGMA page_size").fetchone()
+    image = target_conn.serialize()
+    source_conn.close()
+    target_conn.close()
+    return image, page_size
+
+
+def diff_pages(image: bytes, page_size: int, digests: bytes | None) -> tuple[DatabaseDelta, bytearray]:
+    """digests: of the last run, None keeps every page"""
+    view = memoryview(image)
+    new_digests = bytearray()
+    changed: list[int] = []
+    for page, offset in enumerate(range(0, len(image), page_size), 1):
+        digest = hashlib.blake2b(view[offset : offset + page_size], digest_size=DIGEST_SIZE).digest()
+        if digests is None or digests[len(new_digests) : len(new_digests) + DIGEST_SIZE] != digest:
+            changed.append(page)
+        new_digests += digest
+    return DatabaseDelta(page_size, len(image) // page_size, None if digests is None else changed), new_digests
+
+
+class DeltaReader(io.RawIOBase):  # Header and pages of a delta as a readable stream
+    def __init__(self, image: bytes, delta: DatabaseDelta):
+        self._chunks = self._iter_chunks(memoryview(image), delta)
+        self._chunk = memoryview(b"")
+
+    @staticmethod
+    def _iter_chunks(view: memoryview, delta: DatabaseDelta) -> Iterator[bytes | memoryview]:
+        header = msgspec.json.encode(delta)
+        yield len(header).to_bytes(4, "big") + header
+        if delta.pages is None:
+            yield view
+            return
+        for page in delta.pages:
+            yield view[(page - 1) * delta.page_size : page * delta.page_size]
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            if (chunk := next(self._chunks, None)) is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def backup_database(
+    source: Path,
+    name: str,
+    digests_file: Path | None,  # Of the last run, None for a full snapshot
+    page_size: int | None,  # Of the last run
+    upload: Upload,
+) -> tuple[DatabaseStats, int, bytearray]:
+    """Returns the stats, page size and the digests of the snapshot"""
+    stats = DatabaseStats()
+    start = time.perf_counter()
+    image, new_page_size = snapshot(source)
+    digests = None
+    if digests_file is not None and page_size == new_page_size and digests_file.exists():
+        digests = digests_file.read_bytes()
+    delta, new_digests = diff_pages(image, new_page_size, digests)
+    stats.database_bytes = len(image)
+    stats.changed_bytes = len(image) if delta.pages is None else len(delta.pages) * new_page_size
+
+    stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_reader(DeltaReader(image, delta))
+    stats.uploaded = upload(name, stream)  # type: ignore
+    stats.uploaded_bytes = stream.tell()
+    stats.seconds = time.perf_counter() - start
+    return stats, new_page_size, new_digests
+
+
+def digest_file(state_folder: Path, seq: int, file: str) -> Path:
+    return state_folder / f"{seq:06d}_{file}.pages"
+
+
+def commit(state_folder: Path, state: BackupState, digests: dict[str, bytearray]) -> None:
+    """Digests are written per seq, so the state is switched to the new run by one atomic replace"""
+    state_folder.mkdir(parents=True, exist_ok=True)
+    for file, pages in digests.items():
+        digest_file(state_folder, state.seq, file).write_bytes(pages)
+    (state_folder / "state.json.tmp").write_bytes(msgspec.json.encode(state))
+    os.replace(state_folder / "state.json.tmp", state_folder / "state.json")
+    for path in state_folder.glob("*.pages"):
+        if not path.name.startswith(f"{state.seq:06d}_"):
+            path.unlink()
+
+
+def backup(data_path: Path, files: list[str], state_folder: Path, upload: Upload, full=False) -> BackupStats:
+    """The state and digests only advance if every database was uploaded, otherwise the next run redoes this seq"""
+    state_file = state_folder / "state.json"
+    state = msgspec.json.decode(state_file.read_bytes(), type=BackupState) if state_file.exists() else BackupState()
+    seq = state.seq + 1
+    full = full or state.seq == 0 or seq - state.full_seq >= FULL_EVERY
+    stats = BackupStats(seq=seq, full=full)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(min(WORKERS, len(files))) as executor:  # Snapshots, hashing, zstd and TLS release the GIL
+        results = executor.map(
+            lambda file: backup_database(
+                data_path / file,
+                backup_name(seq, full, file),
+                None if full else digest_file(state_folder, state.seq, file),
+                state.page_sizes.get(file),
+                upload,
+            ),
+            files,
+        )
+        new_state = BackupState(seq=seq, full_seq=seq if full else state.full_seq)
+        new_digests: dict[str, bytearray] = {}
+        for file, (database_stats, page_size, digests) in zip(files, results):
+            stats.databases[file] = database_stats
+            new_state.page_sizes[file] = page_size
+            new_digests[file] = digests
+    stats.seconds = time.perf_counter() - start
+    if stats.uploaded:
+        commit(state_folder, new_state, new_digests)
+    return stats
+
+
+def ftp_upload(ftp_cfg: cfg_schema.FileKeyFTP) -> Upload:
+    return lambda name, stream: utils.BackupFolderFTP_TLS(**ftp_cfg, target_file=name).upload_fileobj(stream)
+
+
+def backup_db_routine(data_path: str, state_folder: str, files: list[str], ftp_cfg: cfg_schema.FileKeyFTP, full=False):
+    stats = backup(Path(data_path), files, Path(state_folder), ftp_upload(ftp_cfg), full)
+    if stats.uploaded:
+        ftp = utils.BackupFolderFTP_TLS(**ftp_cfg, target_file="")
+        if expired := expired_backups(ftp.list_files(), KEEP_CHAINS):
+            ftp.delete_files(expired)
+    return stats
+
+
+def read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size and (chunk := stream.read(size - len(data))):
+        data += chunk
+    if len(data) < size:
+        raise EOFError("Truncated backup")
+    return bytes(data)
+
+
+def restore(backups: list[Path], output: Path) -> list[Path]:
+    """Applies a chain of backups, in order, into output. Returns the restored databases."""
+    output.mkdir(parents=True, exist_ok=True)
+    restored: set[Path] = set()
+    for path in backups:
+        target = output / BACKUP_NAME.match(path.name)[3]  # type: ignore
+        with open(path, "rb") as f, zstandard.ZstdDecompressor().stream_reader(f) as src:
+            header = read_exact(src, int.from_bytes(read_exact(src, 4), "big"))  # type: ignore
+            delta = msgspec.json.decode(header, type=DatabaseDelta)
+            pages = range(1, delta.page_count + 1) if delta.pages is None else delta.pages
+            with open(target, "wb" if delta.pages is None else "r+b") as dst:
+                for page in pages:
+                    dst.seek((page - 1) * delta.page_size)
+                    dst.write(read_exact(src, delta.page_size))  # type: ignore
+                dst.truncate(delta.page_count * delta.page_size)
+        restored.add(target)
+    for target in restored:
+        conn = sqlite3.connect(target)
+        (result,) = conn.execute("PRAGMA quick_check").fetchone()
+        conn.close()
+        if result != "ok":
+            raise ValueError(f"{target.name}: {result}")
+    return sorted(restored)
+
+
+def main(args: list[str]):
+    data_path = Path(os.environ["DATA_PATH"])
+    ftp_cfg = cfg_schema.load_file(str(data_path / cfg_schema.FILENAME))["ftp"]
+    if args[:1] != ["restore"]:
+        stats = backup_db_routine(
+            str(data_path),
+            str(data_path / "backup_state"),
+            [os.environ[key] for key in ("DB_INTERNAL", "DB_DATA", "DB_APP")],
+            ftp_cfg,
+            full=args[:1] == ["full"],
+        )
+        print(msgspec.json.encode(stats).decode())
+        return
+
+    source, output = args[1], Path(args[2])
+    seq = int(args[3]) if len(args) > 3 else None
+    with tempfile.TemporaryDirectory() as tmp:
+        if source == "ftp":
+            ftp = utils.BackupFolderFTP_TLS(**ftp_cfg, target_file=tmp)
+            backups = ftp.get_files(select_chain(ftp.list_files(), seq), Path(tmp))
+        else:
+            backups = [Path(source) / name for name in select_chain(os.listdir(source), seq)]
+        for target in restore(backups, output):
+            print(f"Restored {target} from {len(backups)} backups")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+"""
+Compares the legacy backup routine (temp copies, BZIP2 level 9 zip, upload read back from disk) with backup.py
+(parallel in memory snapshots, zstd streamed to the upload): duration, uploaded size, peak temp disk usage and peak RSS.
+The FTP upload is replaced by a sink that reads the stream. Every run is a fresh process, for the RSS.
+
+python3 bench_backup.py [devices=50] [days=365]
+"""
+
+__import__("sys").path.append("/")
+
+import multiprocessing
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import suppress
+from pathlib import Path
+from typing import BinaryIO
+
+import backup
+import bench_measurements
+
+FILES = ["internal.sqlite", "data.sqlite", "app.sqlite"]
+
+
+def make_databases(data_path: Path, devices: int, days: int):
+    for file in FILES:
+        conn = sqlite3.connect(data_path / file)
+        conn.execute("PRAGMA journal_mode = WAL")
+        if file == "data.sqlite":
+            conn.executescript(bench_measurements.COMPACT)
+            conn.executemany("INSERT INTO device (name) VALUES (?)", ((f"device{i}",) for i in range(devices)))
+            for batch in bench_measurements.snapshots(devices, days, compact=True):
+                conn.executemany(bench_measurements.COMPACT_INSERT, batch)
+        else:
+            conn.execute("CREATE TABLE kv (key TEXT PRIMARY KEY, value BLOB)")
+            conn.executemany("INSERT INTO kv VALUES (?, ?)", ((str(i), os.urandom(64)) for i in range(20_000)))
+        conn.commit()
+        conn.close()
+
+
+def add_day(data_path: Path, devices: int):
+    """A day of new readings, the churn between two nightly backups"""
+    conn = sqlite3.connect(data_path / "data.sqlite")
+    for batch in bench_measurements.snapshots(devices, 1, compact=True):
+        conn.executemany(bench_measurements.COMPACT_INSERT, [(ts + 86400, *row) for ts, *row in batch])
+    conn.commit()
+    conn.close()
+
+
+def legacy_routine(data_path: str, tmp_folder: str, zip_file: str, files: list[str]) -> int:
+    """backup_db_routine before backup.py, the upload reads the zip from disk"""
+    with suppress(FileNotFoundError):
+        shutil.rmtree(tmp_folder)
+    os.mkdir(tmp_folder)
+
+    filefiles: list[tuple[str, str]] = []
+    for file in files:
+        tmp_filepath = os.path.join(tmp_folder, file)
+        filefiles.append((file, tmp_filepath))
+        source_conn = sqlite3.connect(os.path.join(data_path, file))
+        target_conn = sqlite3.connect(tmp_filepath)
+        with target_conn:
+            source_conn.backup(target_conn)
+        source_conn.close()
+        target_conn.close()
+
+    zip_filepath = os.path.join(tmp_folder, zip_file)
+    with zipfile.ZipFile(zip_filepath, "w", zipfile.ZIP_BZIP2, compresslevel=9) as zipf:
+        for file, tmp_filepath in filefiles:
+            zipf.write(tmp_filepath, arcname=file)
+
+    with open(zip_filepath, "rb") as f:
+        return sink_upload("", f)
+
+
+def sink_upload(name: str, stream: BinaryIO) -> int:
+    size = 0
+    while block := stream.read(2**16):  # storbinary blocksize of utils.BackupFolderFTP_TLS
+        size += len(block)
+    return size
+
+
+class DiskSampler(threading.Thread):  # Peak size of the files in a folder
+    def __init__(self, folder: Path):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            size = 0
+            for root, _, files in os.walk(self.folder):
+                for file in files:
+                    with suppress(FileNotFoundError):
+                        size += os.path.getsize(os.path.join(root, file))
+            self.peak = max(self.peak, size)
+            time.sleep(0.005)
+
+
+def measure(variant: str, data_path: Path, work: Path, results):
+    os.chdir(work)
+    sampler = DiskSampler(work)
+    sampler.start()
+    start = time.perf_counter()
+    if variant == "legacy":
+        uploaded = legacy_routine(str(data_path), "tmp", "dbs.zip", FILES)
+    else:
+        uploaded_bytes: list[int] = []
+        stats = backup.backup(
+            data_path,
+            FILES,
+            work / "backup_state",
+            lambda name, stream: uploaded_bytes.append(sink_upload(name, stream)) is None,
+        )
+        uploaded = sum(uploaded_bytes)
+        assert stats.uploaded
+    seconds = time.perf_counter() - start
+    sampler.running = False
+    sampler.join()
+    results.put((seconds, uploaded, sampler.peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run(variant: str, data_path: Path, work: Path) -> tuple[float, int, int, float]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(variant, data_path, work, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(devices: int, days: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path, work = Path(tmp) / "data", Path(tmp) / "work"
+        data_path.mkdir()
+        work.mkdir()
+        make_databases(data_path, devices, days)
+        size = sum(os.path.getsize(data_path / file) for file in FILES)
+        print(f"{len(FILES)} databases, {size / 1e6:.1f} MB, {os.cpu_count()} cpus, zstd level {backup.ZSTD_LEVEL}")
+        print(f"{'routine':<18} {'seconds':>8} {'upload MB':>10} {'peak disk MB':>13} {'peak rss MB':>12}")
+        for name, variant in (("legacy bzip2 zip", "legacy"), ("full", "backup"), ("incremental, +1d", "backup")):
+            if name.startswith("incremental"):
+                add_day(data_path, devices)
+            seconds, uploaded, disk, rss = run(variant, data_path, work)
+            shutil.rmtree(work / "tmp", ignore_errors=True)
+            print(f"{name:<18} {seconds:>8.2f} {uploaded / 1e6:>10.2f} {disk / 1e6:>13.2f} {rss:>12.1f}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(devices=int(args[0]) if len(args) > 0 else 50, days=int(args[1]) if len(args) > 1 else 365)
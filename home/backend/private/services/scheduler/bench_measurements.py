@@ -0,0 +1,123 @@
+"""
+Compares the legacy measurements layout against the compact one: file size, insert rate and range query latency.
+Also runs migrate_measurements.py on the legacy database. Only needs the standard library.
+
+python3 bench_measurements.py [devices=50] [days=60]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import migrate_measurements
+
+SENSORS = 2
+TYPES = (0, 1)  # temperature, humidity
+INTERVAL = 1800  # One snapshot every 30 minutes, as the scheduler used to write
+QUERY_DAYS = 7
+QUERY_ROUNDS = 200
+
+LEGACY = """
+CREATE TABLE measurements (
+    timestamp   UNIXTIME NOT NULL,
+    device_name TEXT NOT NULL COLLATE NOCASE,
+    sensor_id   INTEGER NOT NULL,
+    type_id     INTEGER NOT NULL,
+    value       REAL NOT NULL
+);
+CREATE INDEX idx_measurements_timestamp ON measurements (timestamp);
+CREATE INDEX idx_measurements_sensor ON measurements (sensor_id);
+CREATE INDEX idx_measurements_sensor_type_time ON measurements (sensor_id, type_id, timestamp);
+CREATE INDEX idx_measurements_type_time ON measurements (type_id, timestamp);
+"""
+LEGACY_INSERT = "INSERT INTO measurements (timestamp, device_name, sensor_id, type_id, value) VALUES (?,?,?,?,?)"
+LEGACY_QUERY = """
+SELECT timestamp, value FROM measurements
+WHERE sensor_id = ? AND type_id = ? AND timestamp >= ? AND timestamp < ? AND device_name = ?
+"""
+
+COMPACT = """
+CREATE TABLE device (
+    device_id INTEGER PRIMARY KEY,
+    name      TEXT NOT NULL UNIQUE COLLATE NOCASE
+);
+CREATE TABLE measurements (
+    device_id INTEGER NOT NULL,
+    sensor_id INTEGER NOT NULL,
+    type_id   INTEGER NOT NULL,
+    timestamp UNIXTIME NOT NULL,
+    value     REAL NOT NULL,
+    PRIMARY KEY(device_id, sensor_id, type_id, timestamp)
+) WITHOUT ROWID;
+CREATE INDEX idx_measurements_timestamp ON measurements (timestamp);
+"""
+COMPACT_INSERT = "INSERT INTO measurements (timestamp, device_id, sensor_id, type_id, value) VALUES (?,?,?,?,?)"
+COMPACT_QUERY = """
+SELECT timestamp, value FROM measurements
+WHERE device_id = (SELECT device_id FROM device WHERE name = ?5)
+    AND sensor_id = ?1 AND type_id = ?2 AND timestamp >= ?3 AND timestamp < ?4
+"""
+
+
+def snapshots(devices: int, days: int, compact: bool):
+    """One executemany batch per snapshot, like the periodic writers"""
+    start = int(time.time()) - days * 86400
+    for ts in range(start, start + days * 86400, INTERVAL):
+        yield [
+            (ts, device + 1 if compact else f"device{device}", sensor_id, type_id, random.uniform(-20, 40))
+            for device in range(devices)
+            for sensor_id in range(SENSORS)
+            for type_id in TYPES
+        ]
+
+
+def run(path: str, schema: str, insert: str, query: str, devices: int, days: int, compact: bool):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(schema)
+    if compact:
+        conn.executemany("INSERT INTO device (name) VALUES (?)", ((f"device{i}",) for i in range(devices)))
+        conn.commit()
+
+    rows = 0
+    start = time.perf_counter()
+    for batch in snapshots(devices, days, compact):
+        conn.executemany(insert, batch)
+        conn.commit()
+        rows += len(batch)
+    insert_sec = time.perf_counter() - start
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    end = int(time.time())
+    timings = []
+    for _ in range(QUERY_ROUNDS):
+        params = (random.randrange(SENSORS), random.choice(TYPES), end - QUERY_DAYS * 86400, end)
+        start = time.perf_counter()
+        conn.execute(query, params + (f"device{random.randrange(devices)}",)).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    conn.close()
+    timings.sort()
+
+    size_mb = os.path.getsize(path) / 1e6
+    print(
+        f"{'compact' if compact else 'legacy':>8}: {rows} rows, {size_mb:7.2f} MB, {rows / insert_sec:9.0f} rows/s,"
+        f" {QUERY_DAYS}d range query median {timings[len(timings) // 2]:.3f} ms, p99 {timings[int(len(timings) * 0.99)]:.3f} ms"
+    )
+
+
+def main(devices: int, days: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy, compact = os.path.join(tmp, "legacy.sqlite"), os.path.join(tmp, "compact.sqlite")
+        run(legacy, LEGACY, LEGACY_INSERT, LEGACY_QUERY, devices, days, compact=False)
+        run(compact, COMPACT, COMPACT_INSERT, COMPACT_QUERY, devices, days, compact=True)
+
+        migrate_measurements.migrate(legacy)
+        print(f"legacy migrated: {os.path.getsize(legacy) / 1e6:7.2f} MB")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(devices=int(args[0]) if len(args) > 0 else 50, days=int(args[1]) if len(args) > 1 else 60)
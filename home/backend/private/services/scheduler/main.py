@@ -2,11 +2,13 @@ __import__("sys").path.append("/")
 import asyncio
 import os
 from concurrent.futures.process import ProcessPoolExecutor
-from datetime import UTC, datetime, timedelta
+from datetime import UTC
 from pathlib import Path
 
+import backup
 import msgspec
 import netifaces
+import rollups
 import utils
 import uvloop  # type: ignore
 from aiocron import crontab
@@ -19,22 +21,18 @@ asyncio.set_event_loop(loop)
 DATA_PATH = Path(os.environ["DATA_PATH"])
 CONFIG = cfg_schema.load_file(str(DATA_PATH / Path(cfg_schema.FILENAME)))
 
-decode_sensor = msgspec.msgpack.Decoder(shared.SensorData).decode
-cache = shared.ValkeyBasic(unix_socket_path="/mem/cache_data", max_connections=2)
 process_pool = ProcessPoolExecutor(1)
 
 
-CRON_DB_DUMP_MINUTE = 30
-
-
 async def main():
     try:
+        async with utils.connect_db(DATA_PATH / Path(os.environ["DB_DATA"])) as conn:
+            await rollups.check_layout(conn)  # Fails at startup instead of every hour
         await asyncio.gather(
             ddns(CONFIG["ddns"]),
             scan_app_db_expired_registrations(),
         )
     finally:
-        await cache.close()
         process_pool.shutdown(cancel_futures=True)
 
 
@@ -77,36 +75,28 @@ async def ddns(cfg: cfg_schema.FileKeyDDNS, update_interval: int = 600):
 
 @crontab("40 3 * * *", tz=UTC, loop=loop)
 async def backup_databases():
-    TMP_FOLDER = "tmp"
-    ZIP_FILE = "dbs.zip"
-
-    await loop.run_in_executor(
-        process_pool,
-        utils.backup_db_routine,
-        str(DATA_PATH),
-        TMP_FOLDER,
-        ZIP_FILE,
-        [os.environ[key] for key in ("DB_INTERNAL", "DB_DATA", "DB_APP")],
-        CONFIG["ftp"],
-    )
-
-
-@crontab("*/30 * * * *".format(CRON_DB_DUMP_MINUTE), tz=UTC, loop=loop)
-async def dump_data_to_db():
-    now = datetime.now(UTC)
-    unixtime = int(now.timestamp())
-    new_rows = []
-
-    for device_data in (decode_sensor(x) for x in await cache.get_many(*await cache.keys("sensor:*")) if x):
-        if (datetime.fromisoformat(device_data.date) + timedelta(minutes=CRON_DB_DUMP_MINUTE)) >= now:
-            for key, value in device_data.data.items():
-                type_id = shared.MeasurementTypes[key.upper()].value
-                new_rows.append((unixtime, device_data.device_name, device_data.sensor_id, type_id, value))
-
-    query = "INSERT INTO measurements (timestamp, device_name, sensor_id, type_id, value) VALUES (?,?,?,?,?)"
-    async with utils.connect_db(DATA_PATH / Path(os.environ["DB_DATA"])) as conn:
-        await conn.executemany(query, new_rows)
-        await conn.commit()
+    STATE_FOLDER = "backup_state"
+
+    try:
+        stats = await loop.run_in_executor(
+            process_pool,
+            backup.backup_db_routine,
+            str(DATA_PATH),
+            str(DATA_PATH / STATE_FOLDER),
+            [os.environ[key] for key in ("DB_INTERNAL", "DB_DATA", "DB_APP")],
+            CONFIG["ftp"],
+        )
+        print("Backup:", msgspec.json.encode(stats).decode())
+    except Exception as e:
+        shared.print_err(e)
+
+
+@crontab("5 * * * *", tz=UTC, loop=loop)
+async def update_rollups():
+    try:
+        await rollups.update_rollups(DATA_PATH / Path(os.environ["DB_DATA"]))
+    except Exception as e:
+        shared.print_err(e)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+"""
+Online migration of data.sqlite measurements to the compact layout:
+device dictionary + WITHOUT ROWID table clustered on (device_id, sensor_id, type_id, timestamp).
+
+Rows are copied in small committed chunks, so readers and writers are only blocked for one chunk at a time.
+Only the final catch-up and table swap runs in a single (short) transaction.
+
+python3 migrate_measurements.py [db file, default: $DATA_PATH/$DB_DATA]
+"""
+
+import os
+import sqlite3
+import sys
+import time
+
+CHUNK_ROWS = 50_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device (
+    device_id INTEGER PRIMARY KEY,
+    name      TEXT NOT NULL UNIQUE COLLATE NOCASE
+);
+
+CREATE TABLE IF NOT EXISTS measurements_new (
+    device_id INTEGER NOT NULL,
+    sensor_id INTEGER NOT NULL,
+    type_id   INTEGER NOT NULL,
+    timestamp UNIXTIME NOT NULL,
+    value     REAL NOT NULL,
+    FOREIGN KEY(device_id) REFERENCES device(device_id),
+    FOREIGN KEY(type_id) REFERENCES measurement_types(type_id),
+    PRIMARY KEY(device_id, sensor_id, type_id, timestamp)
+) WITHOUT ROWID;
+"""
+
+COPY = """
+INSERT OR IGNORE INTO measurements_new (device_id, sensor_id, type_id, timestamp, value)
+SELECT d.device_id, m.sensor_id, m.type_id, m.timestamp, m.value
+FROM measurements m
+JOIN device d ON d.name = m.device_name
+WHERE m.rowid > ? AND m.rowid <= ?
+"""
+
+ADD_DEVICES = """
+INSERT OR IGNORE INTO device (name)
+SELECT DISTINCT device_name FROM measurements WHERE rowid > ? AND rowid <= ?
+"""
+
+
+def is_migrated(conn: sqlite3.Connection) -> bool:
+    return "device_id" in {row[1] for row in conn.execute("PRAGMA table_info(measurements)")}
+
+
+def migrate(dbfilepath: str, chunk_rows: int = CHUNK_ROWS) -> None:
+    conn = sqlite3.connect(dbfilepath, isolation_level=None)  # Explicit transactions
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA busy_timeout = 10000")
+    if is_migrated(conn):
+        print("Already migrated")
+        conn.close()
+        return
+
+    start = time.perf_counter()
+    conn.executescript(SCHEMA)
+
+    copied_to = 0
+    while True:
+        (max_rowid,) = conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM measurements").fetchone()
+        if max_rowid - copied_to <= chunk_rows:
+            break
+        conn.execute("BEGIN")
+        conn.execute(ADD_DEVICES, (copied_to, copied_to + chunk_rows))
+        conn.execute(COPY, (copied_to, copied_to + chunk_rows))
+        conn.execute("COMMIT")
+        copied_to += chunk_rows
+        print(f"Copied rowid <= {copied_to}/{max_rowid}")
+
+    # Catch up rows inserted meanwhile and swap tables
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(ADD_DEVICES, (copied_to, sys.maxsize))
+    conn.execute(COPY, (copied_to, sys.maxsize))
+    conn.execute("DROP TABLE measurements")  # Drops its indexes as well
+    conn.execute("ALTER TABLE measurements_new RENAME TO measurements")
+    conn.execute("CREATE INDEX idx_measurements_timestamp ON measurements (timestamp)")
+    conn.execute("COMMIT")
+    conn.execute("VACUUM")  # Return the space of the old table and indexes
+    conn.close()
+    print(f"Migrated in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.environ["DATA_PATH"], os.environ["DB_DATA"]))
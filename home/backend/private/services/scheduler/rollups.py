@@ -0,0 +1,154 @@
+"""
+Hourly and daily rollups of the measurements in data.sqlite.
+Only completed periods are rolled up, from the high-water mark of the previous run.
+
+Backfill (or rebuild) existing data:
+python3 rollups.py [--rebuild]
+"""
+
+from __future__ import annotations
+
+__import__("sys").path.append("/")
+
+import time
+from pathlib import Path
+from typing import Literal
+
+import aiosqlite
+import utils
+
+type Rollup = Literal["hourly", "daily"]
+
+HOUR = 3600
+DAY = 86400
+BACKFILL_CHUNK = 7 * DAY  # Keeps each transaction small on large databases
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements_hourly (
+    bucket_start UNIXTIME NOT NULL,
+    device_name  TEXT NOT NULL COLLATE NOCASE,
+    sensor_id    INTEGER NOT NULL,
+    type_id      INTEGER NOT NULL,
+    count        INTEGER NOT NULL,
+    min          REAL,
+    max          REAL,
+    sum          REAL,
+    PRIMARY KEY(device_name, sensor_id, type_id, bucket_start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS measurements_daily (
+    bucket_start UNIXTIME NOT NULL,
+    device_name  TEXT NOT NULL COLLATE NOCASE,
+    sensor_id    INTEGER NOT NULL,
+    type_id      INTEGER NOT NULL,
+    count        INTEGER NOT NULL,
+    min          REAL,
+    max          REAL,
+    sum          REAL,
+    PRIMARY KEY(device_name, sensor_id, type_id, bucket_start)
+) WITHOUT ROWID;
+
+-- Everything before high_water is rolled up
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name       TEXT PRIMARY KEY NOT NULL,
+    high_water UNIXTIME NOT NULL
+);
+"""
+
+# Buckets are recomputed in full, so rerunning a range is idempotent
+ROLLUP_HOURLY = """
+INSERT OR REPLACE INTO measurements_hourly (bucket_start, device_name, sensor_id, type_id, count, min, max, sum)
+SELECT (ts / 3600) * 3600 AS bucket, device_name, sensor_id, type_id, SUM(n), MIN(lo), MAX(hi), SUM(total)
+FROM (
+    SELECT m.timestamp AS ts, d.name AS device_name, m.sensor_id, m.type_id, 1 AS n,
+        m.value AS lo, m.value AS hi, m.value AS total
+    FROM measurements m
+    JOIN device d ON d.device_id = m.device_id
+    WHERE m.timestamp >= :start AND m.timestamp < :end
+    UNION ALL
+    SELECT window_start, device_name, sensor_id, type_id,
+        count, COALESCE(min, last), COALESCE(max, last), COALESCE(sum, last * count)
+    FROM measurement_windows
+    WHERE window_start >= :start AND window_start < :end
+)
+GROUP BY bucket, device_name, sensor_id, type_id
+"""
+
+ROLLUP_DAILY = """
+INSERT OR REPLACE INTO measurements_daily (bucket_start, device_name, sensor_id, type_id, count, min, max, sum)
+SELECT (bucket_start / 86400) * 86400 AS bucket, device_name, sensor_id, type_id, SUM(count), MIN(min), MAX(max), SUM(sum)
+FROM measurements_hourly
+WHERE bucket_start >= :start AND bucket_start < :end
+GROUP BY bucket, device_name, sensor_id, type_id
+"""
+
+ROLLUPS: dict[Rollup, tuple[int, str]] = {
+    "hourly": (HOUR, ROLLUP_HOURLY),
+    "daily": (DAY, ROLLUP_DAILY),  # Has to run after hourly
+}
+
+
+async def check_layout(conn: aiosqlite.Connection) -> None:
+    """Rollups read the compact measurements layout, raises on a database that was not migrated yet"""
+    async with conn.execute("PRAGMA table_info(measurements)") as cur:
+        if "device_id" not in {row[1] for row in await cur.fetchall()}:
+            raise RuntimeError("measurements has the legacy layout, run migrate_measurements.py first")
+
+
+async def _first_timestamp(conn: aiosqlite.Connection) -> int | None:
+    query = (
+        "SELECT MIN(ts) FROM ("
+        "  SELECT MIN(timestamp) AS ts FROM measurements UNION ALL SELECT MIN(window_start) FROM measurement_windows"
+        ")"
+    )
+    async with conn.execute(query) as cur:
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def _high_water(conn: aiosqlite.Connection, name: Rollup) -> int | None:
+    async with conn.execute("SELECT high_water FROM rollup_state WHERE name = ?", (name,)) as cur:
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def update_rollups(db_path: Path, now: int | None = None, rebuild=False) -> None:
+    """Roll up every completed hour/day since the last run. Starts from the oldest data if never run."""
+    now = int(time.time()) if now is None else now
+    async with utils.connect_db(db_path) as conn:
+        await check_layout(conn)
+        await conn.executescript(SCHEMA)
+        if rebuild:
+            await conn.execute("DELETE FROM measurements_hourly")
+            await conn.execute("DELETE FROM measurements_daily")
+            await conn.execute("DELETE FROM rollup_state")
+        await conn.commit()
+
+        for name, (period, query) in ROLLUPS.items():
+            end = now - now % period
+            if (start := await _high_water(conn, name)) is None:
+                if (first := await _first_timestamp(conn)) is None:
+                    continue
+                start = first - first % period
+            while start < end:
+                chunk_end = min(end, start + max(period, BACKFILL_CHUNK))
+                await conn.execute(query, dict(start=start, end=chunk_end))
+                await conn.execute(
+                    "INSERT OR REPLACE INTO rollup_state (name, high_water) VALUES (?, ?)",
+                    (name, chunk_end),
+                )
+                await conn.commit()
+                start = chunk_end
+
+
+if __name__ == "__main__":
+    import asyncio
+    import os
+    import sys
+
+    asyncio.run(
+        update_rollups(
+            Path(os.environ["DATA_PATH"]) / Path(os.environ["DB_DATA"]),
+            rebuild="--rebuild" in sys.argv[1:],
+        )
+    )
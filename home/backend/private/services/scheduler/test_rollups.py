@@ -0,0 +1,101 @@
+"""
+Rollups over the compact measurements layout (device table + clustered measurements) and measurement_windows.
+
+python3 -m unittest test_rollups
+"""
+
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+import bench_measurements
+import rollups
+
+WINDOWS = """
+CREATE TABLE measurement_windows (
+    window_start UNIXTIME NOT NULL,
+    window_sec   INTEGER NOT NULL,
+    device_name  TEXT NOT NULL COLLATE NOCASE,
+    sensor_id    INTEGER NOT NULL,
+    type_id      INTEGER NOT NULL,
+    count        INTEGER NOT NULL,
+    min          REAL,
+    max          REAL,
+    sum          REAL,
+    last         REAL,
+    PRIMARY KEY(device_name, sensor_id, type_id, window_start)
+) WITHOUT ROWID;
+"""
+
+DAY_START = 1_767_225_600  # 2026-01-01 00:00 UTC
+
+
+class RollupTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp.name) / "data.db"
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(bench_measurements.COMPACT + WINDOWS)
+        conn.execute("INSERT INTO device (device_id, name) VALUES (1, 'kitchen')")
+        conn.executemany(
+            bench_measurements.COMPACT_INSERT,
+            [
+                (DAY_START + 60, 1, 0, 0, 20.0),
+                (DAY_START + 1800, 1, 0, 0, 22.0),
+                (DAY_START + 3600 + 60, 1, 0, 0, 30.0),
+            ],
+        )
+        conn.execute(
+            "INSERT INTO measurement_windows VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (DAY_START + 600, 60, "kitchen", 0, 0, 4, 18.0, 25.0, 84.0, 21.0),
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetch(self, query: str):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(query).fetchall()
+        finally:
+            conn.close()
+
+    async def test_hourly_and_daily(self):
+        await rollups.update_rollups(self.db_path, now=DAY_START + 2 * rollups.DAY)
+
+        hourly = self.fetch(
+            "SELECT bucket_start, device_name, count, min, max, sum FROM measurements_hourly ORDER BY bucket_start"
+        )
+        self.assertEqual(
+            hourly,
+            [
+                (DAY_START, "kitchen", 6, 18.0, 25.0, 126.0),
+                (DAY_START + 3600, "kitchen", 1, 30.0, 30.0, 30.0),
+            ],
+        )
+        daily = self.fetch("SELECT bucket_start, count, min, max, sum FROM measurements_daily")
+        self.assertEqual(daily, [(DAY_START, 7, 18.0, 30.0, 156.0)])
+        high_water = dict(self.fetch("SELECT name, high_water FROM rollup_state"))
+        self.assertEqual(high_water, {"hourly": DAY_START + 2 * rollups.DAY, "daily": DAY_START + 2 * rollups.DAY})
+
+    async def test_only_completed_periods(self):
+        await rollups.update_rollups(self.db_path, now=DAY_START + 3600 + 120)
+
+        self.assertEqual(self.fetch("SELECT bucket_start FROM measurements_hourly"), [(DAY_START,)])
+        self.assertEqual(self.fetch("SELECT * FROM measurements_daily"), [])
+
+    async def test_legacy_layout(self):
+        legacy_path = Path(self.tmp.name) / "legacy.db"
+        conn = sqlite3.connect(legacy_path)
+        conn.executescript(bench_measurements.LEGACY + WINDOWS)
+        conn.close()
+
+        with self.assertRaisesRegex(RuntimeError, "migrate_measurements"):
+            await rollups.update_rollups(legacy_path, now=DAY_START + rollups.DAY)
+
+
+if __name__ == "__main__":
+    unittest.main()
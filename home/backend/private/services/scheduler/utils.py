@@ -1,16 +1,13 @@
 from __future__ import annotations
 
-import os
-import shutil
-import sqlite3
-import zipfile
 from contextlib import asynccontextmanager, suppress
 from ftplib import FTP, FTP_TLS, error_perm
 from pathlib import Path
+from typing import BinaryIO
 
 import aiosqlite
 
-from appdata import cfg_schema, shared
+from appdata import shared
 
 
 class SingleFileBackupFTP_TLS(FTP_TLS):
@@ -89,28 +86,35 @@ class SingleFileBackupFTP_TLS(FTP_TLS):
         return self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session), size  # type:ignore
 
 
-def backup_db_routine(data_path: str, tmp_folder: str, zip_file: str, files: list[str], ftp_cfg: cfg_schema.FileKeyFTP):
-    with suppress(FileNotFoundError):
-        shutil.rmtree(tmp_folder)
-    os.mkdir(tmp_folder)
-
-    filefiles: list[tuple[str, str]] = []
-    for file in files:
-        tmp_filepath = os.path.join(tmp_folder, file)
-        filefiles.append((file, tmp_filepath))
-        source_conn = sqlite3.connect(os.path.join(data_path, file))
-        target_conn = sqlite3.connect(tmp_filepath)
-        with target_conn:
-            source_conn.backup(target_conn)
-        source_conn.close()
-        target_conn.close()
-
-    zip_filepath = os.path.join(tmp_folder, zip_file)
-    with zipfile.ZipFile(zip_filepath, "w", zipfile.ZIP_BZIP2, compresslevel=9) as zipf:
-        for file, tmp_filepath in filefiles:
-            zipf.write(tmp_filepath, arcname=file)
-
-    SingleFileBackupFTP_TLS(**ftp_cfg, target_file=zip_filepath).upload_file()
+class BackupFolderFTP_TLS(SingleFileBackupFTP_TLS):  # Files are kept in the backup folder, rotated by the caller
+    def upload_file(self) -> bool:
+        with open(self.target_file, "rb") as f:
+            return self.upload_fileobj(f)
+
+    def upload_fileobj(self, f: BinaryIO, blocksize: int = 2**16) -> bool:
+        """Stored as target_file.name, f is read until empty, so it can be a stream"""
+        with self:
+            with suppress(error_perm):
+                self.storbinary(f"STOR {self.backup_folder.name}/{self.target_file.name}", f, blocksize)
+                return True
+            return False
+
+    def list_files(self) -> list[str]:
+        with self:
+            return self.lsdir(self.backup_folder.name)
+
+    def delete_files(self, names: list[str]) -> None:
+        with self:
+            for name in names:
+                self.delete(f"{self.backup_folder.name}/{name}")
+
+    def get_files(self, names: list[str], folder: Path) -> list[Path]:
+        folder.mkdir(parents=True, exist_ok=True)
+        with self:
+            for name in names:
+                with open(folder / name, "wb") as f:
+                    self.retrbinary(f"RETR {self.backup_folder.name}/{name}", f.write)
+        return [folder / name for name in names]
 
 
 @asynccontextmanager
@@ -0,0 +1,74 @@
+"""
+Compares reading all sensors with KEYS + MGET (legacy layout) against HVALS on the category hash.
+Writes to a live Valkey under a "bench" prefix and removes the keys afterwards.
+
+python3 bench_cache_index.py [devices=10000] [rounds=20] [unix socket=/mem/cache_data]
+"""
+
+__import__("sys").path.append("/")
+
+import asyncio
+import sys
+import time
+
+import msgspec
+
+from appdata import shared
+
+PREFIX = "bench"
+SENSORS_PER_DEVICE = 2
+
+
+async def main(devices: int, rounds: int, socket: str):
+    cache = shared.ValkeyBasic(unix_socket_path=socket)
+    encoder = msgspec.msgpack.Encoder().encode
+    legacy: dict[str, bytes] = {}
+    fields: dict[str, bytes] = {}
+    for device in range(devices):
+        for sensor_id in range(SENSORS_PER_DEVICE):
+            value = encoder(
+                shared.SensorData(
+                    location="home",
+                    device_name=f"device{device}",
+                    sensor_id=sensor_id,
+                    data={"temperature": 21.5, "humidity": 40.0},
+                    timestamp=time.time_ns() // 1_000_000,
+                    version=shared.SENSOR_DATA_VERSION,
+                )
+            )
+            legacy[f"{PREFIX}:sensor:device{device}:{sensor_id}"] = value
+            fields[f"device{device}:{sensor_id}"] = value
+
+    hash_name = f"{PREFIX}:{shared.CACHE_SENSORS}"
+    try:
+        await cache.set_batch(legacy, {hash_name: fields})
+
+        async def legacy_read():
+            return await cache.get_many(*await cache.keys(f"{PREFIX}:sensor:*"))
+
+        async def hash_read():
+            return await cache.hash_values(hash_name)
+
+        print(f"{devices} devices, {len(fields)} sensors, {rounds} rounds")
+        for name, func in (("KEYS + MGET", legacy_read), ("HVALS", hash_read)):
+            timings = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                assert len(await func()) == len(fields)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"{name:>12}: median {timings[len(timings) // 2]:8.2f} ms, max {timings[-1]:8.2f} ms")
+    finally:
+        await cache.delete(hash_name, *legacy)
+        await cache.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(
+        main(
+            devices=int(args[0]) if len(args) > 0 else 10_000,
+            rounds=int(args[1]) if len(args) > 1 else 20,
+            socket=args[2] if len(args) > 2 else "/mem/cache_data",
+        )
+    )
@@ -0,0 +1,286 @@
+"""
+Ingest benchmark: replays synthetic device traffic through the listener pipeline
+(msg_handler -> CacheWriteBuffer -> cache, SensorsView, WindowAggregator and the uplink queue).
+The broker and Valkey are in process stand-ins, so it runs offline.
+
+Latency is publish -> flushed to the cache, measured for the oldest unflushed message per cache field.
+Reports throughput, latency percentiles, peak asyncio task count and RSS.
+
+python3 bench_ingest.py [rate msgs/s, 0 = as fast as possible, default 2000] [devices=100] [seconds=10]
+
+Regression gates, exits with 1 if not met:
+BENCH_MIN_RATE=<msgs/s> BENCH_MAX_P99_MS=<ms> python3 bench_ingest.py ...
+"""
+
+__import__("sys").path.append("/")
+
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+from contextlib import suppress
+
+import msgspec
+import utils
+
+TICK = 0.001  # seconds between publish bursts when rate limited
+RELAY_SHARE = 10  # Every nth message is a relay status
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99, "max": 1}
+
+
+class FakeTopic(msgspec.Struct, gc=False):
+    value: str
+
+
+class FakeMessage(msgspec.Struct, gc=False):
+    topic: FakeTopic
+    payload: bytes
+    retain: bool = False
+
+
+class FakeClient:
+    """Stand-in for aiomqtt.Client: messages are fed from a queue, publishes are acknowledged on the next loop turn"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue[FakeMessage | None]()
+        self.published = 0
+
+    @property
+    async def messages(self):
+        while (msg := await self.queue.get()) is not None:
+            yield msg
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        await asyncio.sleep(0)
+        self.published += 1
+
+
+class FakeValkey:
+    """Stand-in for shared.ValkeyBasic.set_batch, records when each hash field became visible"""
+
+    def __init__(self, clock: "Clock"):
+        self.clock = clock
+        self.hashes: dict[str, dict[str, bytes]] = {}
+        self.versions: dict[str, dict[str, int]] = {}
+        self.published = 0
+
+    async def set_batch(
+        self,
+        keys: dict[str, bytes],
+        hashes: dict[str, dict[str, bytes]],
+        publish: dict[str, bytes] | None = None,
+        versioned: dict[str, dict[str, tuple[int, bytes]]] | None = None,
+    ):
+        await asyncio.sleep(0)  # One round trip
+        for name, fields in hashes.items():
+            self.hashes.setdefault(name, {}).update(fields)
+            self.clock.flushed(fields)
+        for name, fields in (versioned or {}).items():  # Same as shared.HSET_IF_NEWER
+            values, versions = self.hashes.setdefault(name, {}), self.versions.setdefault(name, {})
+            for field, (version, value) in fields.items():
+                if version > versions.get(field, -1):
+                    versions[field], values[field] = version, value
+            self.clock.flushed(fields)
+        self.published += len(publish or ())
+
+
+class Clock:
+    def __init__(self):
+        self.pending_since: dict[str, float] = {}  # cache field -> publish time of the oldest unflushed message
+        self.latencies: list[float] = []
+
+    def published(self, field: str):
+        self.pending_since.setdefault(field, time.perf_counter())
+
+    def flushed(self, fields: dict[str, bytes]):
+        now = time.perf_counter()
+        for field in fields:
+            if (since := self.pending_since.pop(field, None)) is not None:
+                self.latencies.append(now - since)
+
+
+def make_traffic(devices: int) -> list[tuple[str, FakeMessage]]:
+    """One message per (device, sensor) and a relay status per RELAY_SHARE messages, as (cache field, message)"""
+    traffic = []
+    for i in range(devices * 2):
+        device, sensor_id = f"device{i // 2}", i % 2
+        if i % RELAY_SHARE == 0:
+            traffic.append((device, FakeMessage(FakeTopic(f"{device}/relay/status"), b'{"0":true,"1":false}')))
+        payload = b'{"temperature":%.1f,"humidity":%.1f,"airpressure":1013.2}' % (20 + i % 7, 40 + i % 13)
+        traffic.append((f"{device}:{sensor_id}", FakeMessage(FakeTopic(f"{device}/sensor/{sensor_id}"), payload)))
+    return traffic
+
+
+async def publisher(
+    client: FakeClient,
+    clock: Clock,
+    devices: int,
+    rate: int,
+    seconds: float,
+    shard: tuple[int, int] = (0, 1),  # (index, count), every count:th message of the stream, like $share
+) -> int:
+    traffic = make_traffic(devices)
+    index, count = shard
+    sent = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        due = int(elapsed * rate) if rate else sent + 1000
+        for _ in range(due - sent):
+            field, msg = traffic[(sent * count + index) % len(traffic)]
+            clock.published(field)
+            client.queue.put_nowait(msg)
+            sent += 1
+        await asyncio.sleep(TICK if rate else 0)
+    client.queue.put_nowait(None)
+    return sent
+
+
+async def consumer(client: FakeClient, cache_writer, aggregator, sensors_view, uplink) -> int:
+    """The local_mqtt loop of main.py"""
+    handled = 0
+    async for message in client.messages:
+        utils.msg_handler(
+            message,  # type: ignore
+            location="home",
+            cache=cache_writer,
+            aggregator=aggregator,
+            sensors_view=sensors_view,
+            uplink=uplink,
+        )
+        handled += 1
+    return handled
+
+
+async def sample_tasks(peak: list[int]):
+    while True:
+        peak[0] = max(peak[0], len(asyncio.all_tasks()))
+        await asyncio.sleep(0.01)
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+class IngestResult(msgspec.Struct):
+    rate: int
+    devices: int
+    sent: int
+    handled: int
+    elapsed: float
+    latency_ms: dict[str, float]  # p50, p90, p99, max
+    latency_samples: int
+    peak_tasks: int
+    rss_mb: tuple[float, float, float]  # before, after, peak
+    cache: utils.CacheWriterStats
+    uplink: utils.PublishQueueStats
+
+    @property
+    def throughput(self) -> float:
+        return self.handled / self.elapsed
+
+
+async def run(
+    rate: int,
+    devices: int,
+    seconds: float,
+    shard: tuple[int, int] = (0, 1),
+    last_write_wins: bool = False,
+) -> IngestResult:
+    clock = Clock()
+    cache_writer = utils.CacheWriteBuffer(FakeValkey(clock), last_write_wins=last_write_wins)  # type: ignore
+    sensors_view = utils.SensorsView(cache_writer)
+    uplink = utils.CoalescingPublishQueue(is_connected=True)
+    local, external = FakeClient(), FakeClient()
+    peak_tasks = [0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        aggregator = utils.WindowAggregator(os.path.join(tmp, "data.sqlite"))
+        background = [
+            asyncio.create_task(coro)
+            for coro in (
+                cache_writer.run(),
+                aggregator.run(),
+                sensors_view.run(),
+                uplink.forward(external),  # type: ignore
+                sample_tasks(peak_tasks),
+            )
+        ]
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        handled, sent = await asyncio.gather(
+            consumer(local, cache_writer, aggregator, sensors_view, uplink),
+            publisher(local, clock, devices, rate, seconds, shard),
+        )
+        elapsed = time.perf_counter() - start
+        await cache_writer.flush()
+        for task in background:
+            task.cancel()
+            with suppress(BaseException):
+                await task
+        await aggregator.flush(force=True)
+
+    latencies = sorted(clock.latencies)
+    return IngestResult(
+        rate=rate,
+        devices=devices,
+        sent=sent,
+        handled=handled,
+        elapsed=elapsed,
+        latency_ms={name: percentile(latencies, p) for name, p in PERCENTILES.items()},
+        latency_samples=len(latencies),
+        peak_tasks=peak_tasks[0],
+        rss_mb=(rss_before, rss_mb(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        cache=cache_writer.stats,
+        uplink=uplink.stats,
+    )
+
+
+def report(result: IngestResult) -> bool:
+    """Prints the result, returns True if a regression gate failed"""
+    latency = result.latency_ms
+    print(
+        f"{result.sent} messages from {result.devices} devices,"
+        f" target {result.rate or 'max'} msgs/s, {result.elapsed:.1f} s"
+    )
+    print(f"throughput: {result.throughput:12,.0f} msgs/s")
+    print(
+        f"latency ms: p50 {latency['p50']:.2f}, p90 {latency['p90']:.2f},"
+        f" p99 {latency['p99']:.2f}, max {latency['max']:.2f} ({result.latency_samples} samples)"
+    )
+    print(f"tasks:      peak {result.peak_tasks}")
+    print(f"rss MB:     {result.rss_mb[0]:.1f} -> {result.rss_mb[1]:.1f}, peak {result.rss_mb[2]:.1f}")
+    print(f"cache:      {msgspec.json.encode(result.cache).decode()}")
+    print(f"uplink:     {msgspec.json.encode(result.uplink).decode()}")
+
+    failed = False
+    if (min_rate := float(os.environ.get("BENCH_MIN_RATE", 0))) and result.throughput < min_rate:
+        print(f"FAIL: throughput below {min_rate:,.0f} msgs/s")
+        failed = True
+    if (max_p99 := float(os.environ.get("BENCH_MAX_P99_MS", 0))) and latency["p99"] > max_p99:
+        print(f"FAIL: p99 latency above {max_p99} ms")
+        failed = True
+    return failed
+
+
+async def main(rate: int, devices: int, seconds: float):
+    return report(await run(rate, devices, seconds))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(
+        asyncio.run(
+            main(
+                rate=int(args[0]) if len(args) > 0 else 2000,
+                devices=int(args[1]) if len(args) > 1 else 100,
+                seconds=float(args[2]) if len(args) > 2 else 10,
+            )
+        )
+    )
@@ -0,0 +1,121 @@
+"""
+Messages/sec through msg_handler: the previous untyped decode + test_value path against the typed fast path.
+Runs in process only, cache writes end in a CacheWriteBuffer that is never flushed.
+
+python3 bench_msg_handler.py [messages=200000] [devices=20]
+"""
+
+__import__("sys").path.append("/")
+
+import sys
+import time
+from typing import cast
+
+import msgspec
+import utils
+
+from appdata import shared
+
+untyped_decoder = msgspec.json.Decoder().decode
+
+
+class Topic(msgspec.Struct):
+    value: str
+
+
+class Message(msgspec.Struct):
+    topic: Topic
+    payload: bytes
+    retain: bool = False
+
+
+def test_value(key: str, value: float | int) -> bool:
+    match key.lower():
+        case "temperature":
+            _min, _max = -50, 60
+        case "humidity":
+            _min, _max = 0, 100
+        case "airpressure":
+            _min, _max = 800, 1300
+        case _:
+            raise ValueError(f"Unknown key: {key}")
+    return _min <= value <= _max
+
+
+def legacy_msg_handler(msg: Message, location: str, cache: utils.CacheWriteBuffer) -> None | shared.MQTTPacket:
+    try:
+        location = location.strip().lower()
+        topic = msg.topic.value.strip().lower()
+        payload = cast(bytes, msg.payload)
+        paths = topic.split("/")
+        if paths[0] == "error":
+            return None
+
+        device_name, device_type, payload_tag = paths
+        match device_type:
+            case "relay":
+                statusdata = shared.StatusData(
+                    device_type=device_type,
+                    location=location,
+                    device_name=device_name,
+                    data=untyped_decoder(payload),
+                )
+                cache.hset(shared.CACHE_RELAYS, device_name, utils.encoder(statusdata))
+                cache.publish(shared.CHANNEL_RELAYS, device_name, utils.json_encoder(statusdata))
+            case "sensor":
+                __data: dict[str, float] = untyped_decoder(payload)
+                data = {k.lower(): v for k, v in __data.items() if test_value(k, v)}
+                if len(__data) == len(data):
+                    sensordata = shared.SensorData(
+                        location=location,
+                        device_name=device_name,
+                        sensor_id=int(payload_tag),
+                        data=data,
+                        timestamp=time.time_ns() // 1_000_000,
+                        version=shared.SENSOR_DATA_VERSION,
+                    )
+                    cache.hset(shared.CACHE_SENSORS, f"{device_name}:{payload_tag}", utils.encoder(sensordata))
+                    cache.publish(
+                        shared.CHANNEL_SENSORS, f"{device_name}:{payload_tag}", utils.json_encoder(sensordata)
+                    )
+                    return shared.MQTTPacket(topic=f"{location}/{topic}", payload=payload, retain=msg.retain)
+    except Exception as e:
+        shared.print_err(e)
+
+
+def make_messages(count: int, devices: int) -> list[Message]:
+    messages = []
+    for i in range(count):
+        device = f"device{i % devices}"
+        if i % 10 == 0:
+            messages.append(Message(Topic(f"{device}/relay/status"), b'{"0":true,"1":false}'))
+        else:
+            payload = b'{"temperature":%.1f,"humidity":%.1f,"airpressure":1013.2}' % (20 + i % 7, 40 + i % 13)
+            messages.append(Message(Topic(f"{device}/sensor/{i % 2}"), payload))
+    return messages
+
+
+def run(name: str, handler, messages: list[Message]) -> float:
+    cache = utils.CacheWriteBuffer(cast(shared.ValkeyBasic, None))
+    start = time.perf_counter()
+    for msg in messages:
+        handler(msg, "home", cache)
+    rate = len(messages) / (time.perf_counter() - start)
+    print(f"{name:>8}: {rate:12,.0f} msgs/s")
+    return rate
+
+
+def main(count: int, devices: int):
+    messages = make_messages(count, devices)
+    print(f"{count} messages, {devices} devices, 10% relays")
+    before = run("before", legacy_msg_handler, messages)
+    after = run("after", utils.msg_handler, messages)
+    print(f"{after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(
+        count=int(args[0]) if len(args) > 0 else 200_000,
+        devices=int(args[1]) if len(args) > 1 else 20,
+    )
@@ -0,0 +1,60 @@
+"""
+Throughput versus worker count for worker mode (WORKERS > 1 in main.py).
+Every worker process runs the bench_ingest pipeline at full speed on its share of the message stream,
+the way the broker load balances a $share subscription, with last-write-wins cache writes.
+Only measures the listener side, the broker and Valkey are in process stand-ins.
+
+python3 bench_workers.py [max workers, default cpu count] [devices=100] [seconds=5]
+"""
+
+__import__("sys").path.append("/")
+
+import asyncio
+import multiprocessing
+import os
+import sys
+
+import bench_ingest
+
+
+def worker(index: int, count: int, devices: int, seconds: float, barrier, results):
+    barrier.wait()  # Start together, spawning takes a while
+    result = asyncio.run(bench_ingest.run(0, devices, seconds, shard=(index, count), last_write_wins=True))
+    results.put(result)
+
+
+def run_workers(count: int, devices: int, seconds: float) -> list[bench_ingest.IngestResult]:
+    context = multiprocessing.get_context("spawn")
+    barrier, results = context.Barrier(count), context.Queue()
+    processes = [
+        context.Process(target=worker, args=(i, count, devices, seconds, barrier, results)) for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return collected
+
+
+def main(max_workers: int, devices: int, seconds: float):
+    counts = [n for n in (1, 2, 4, 8, 16, 32) if n < max_workers] + [max_workers]
+    print(f"{devices} devices, {seconds} s per run, {os.cpu_count()} cpus")
+    print(f"{'workers':>7} {'msgs/s':>12} {'per worker':>12} {'speedup':>8} {'p99 ms':>8} {'rss MB':>8}")
+    baseline = 0.0
+    for count in counts:
+        results = run_workers(count, devices, seconds)
+        throughput = sum(result.throughput for result in results)
+        baseline = baseline or throughput
+        p99 = max(result.latency_ms["p99"] for result in results)
+        rss = sum(result.rss_mb[2] for result in results)
+        print(f"{count:>7} {throughput:>12,.0f} {throughput / count:>12,.0f} {throughput / baseline:>7.2f}x {p99:>8.1f} {rss:>8.0f}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(
+        max_workers=int(args[0]) if len(args) > 0 else os.cpu_count() or 1,
+        devices=int(args[1]) if len(args) > 1 else 100,
+        seconds=float(args[2]) if len(args) > 2 else 5,
+    )
@@ -3,12 +3,15 @@ from __future__ import annotations
 __import__("sys").path.append("/")
 
 import asyncio
+import multiprocessing
 import os
+import signal
+import time
 from contextlib import suppress
+from multiprocessing.connection import wait
 
 import aiomqtt
 import load_config
-import msgspec
 import utils
 import uvloop  # type:ignore
 
@@ -19,30 +22,120 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 CFG = load_config.load(os.environ["DATA_PATH"])
 THIS_LOCATION: str = CFG["current_loc"]
 
-cache = shared.ValkeyBasic(unix_socket_path="/mem/cache_data", max_connections=5)
-
+CACHE_FLUSH_INTERVAL = float(os.environ.get("CACHE_FLUSH_INTERVAL", 0.05))  # seconds
+CACHE_FLUSH_MAX_KEYS = int(os.environ.get("CACHE_FLUSH_MAX_KEYS", 512))
+UPLINK_QUEUE_CAPACITY = int(os.environ.get("UPLINK_QUEUE_CAPACITY", 1024))
+UPLINK_MAX_INFLIGHT = int(os.environ.get("UPLINK_MAX_INFLIGHT", 16))
+# Link frames on the external link: up to LINK_BATCH_SIZE readings per publish, waiting at most LINK_BATCH_DELAY s.
+# 1 sends every reading as its own publish. Received frames are always unpacked.
+LINK_BATCH_SIZE = int(os.environ.get("LINK_BATCH_SIZE", 1))
+LINK_BATCH_DELAY = float(os.environ.get("LINK_BATCH_DELAY", 0.5))
+STATS_INTERVAL = 10  # seconds
+AGGREGATE_WINDOW = int(os.environ.get("AGGREGATE_WINDOW", 1800))  # seconds
+AGGREGATES = tuple(os.environ.get("AGGREGATES", ",".join(utils.AGGREGATES)).replace(" ", "").split(","))
+# Worker mode: local messages are load balanced by the broker over WORKERS processes ($share subscriptions, MQTT v5).
+# Worker 0 owns the external bridge and the sensors view, all workers write the cache and the aggregates.
+WORKERS = int(os.environ.get("WORKERS", 1))
+SHARE_GROUP = os.environ.get("SHARE_GROUP", "sensor_listener")
+# Readings within the deadband of the last accepted one are not written or forwarded, "temperature=0.1,humidity=0.5"
+DEADBANDS = utils.parse_deadbands(os.environ["DEADBANDS"]) if "DEADBANDS" in os.environ else utils.DEADBANDS
+MAX_SILENCE = float(os.environ.get("MAX_SILENCE", 300))  # seconds, unchanged readings are still accepted this often
+LATE_AFTER = int(os.environ.get("LATE_AFTER", 120))  # seconds, older readings are backfilled into measurements
 
-async def main():
-    push_to_global = utils.AsyncConnectionQueue[shared.MQTTPacket](is_connected=False)
-    try:
-        await asyncio.gather(
+cache = shared.ValkeyBasic(unix_socket_path="/mem/cache_data", max_connections=5)
+cache_writer = utils.CacheWriteBuffer(
+    cache,
+    flush_interval=CACHE_FLUSH_INTERVAL,
+    max_keys=CACHE_FLUSH_MAX_KEYS,
+    stats_key="stats:sensor_listener:cache_writer",
+    last_write_wins=WORKERS > 1,  # Messages of a device may be handled by different workers
+)
+sensors_view = utils.SensorsView(cache_writer, interval=float(os.environ.get("SENSORS_VIEW_INTERVAL", 1.0)))
+ingest_view = sensors_view if WORKERS == 1 else None  # Workers only see a share, the view is reloaded from the cache
+deadband = utils.Deadband(DEADBANDS, max_silence=MAX_SILENCE)
+# Worker mode: the broker spreads a sensor's readings over the workers, a per worker deadband could then keep a value
+# that another worker already replaced. So only the bridge filters (uplink), the workers write every reading.
+ingest_deadband = deadband if WORKERS == 1 else None
+backfill = utils.Backfill(os.path.join(os.environ["DATA_PATH"], os.environ["DB_DATA"]), late_after=LATE_AFTER)
+aggregator = utils.WindowAggregator(
+    os.path.join(os.environ["DATA_PATH"], os.environ["DB_DATA"]),
+    window=AGGREGATE_WINDOW,
+    aggregates=AGGREGATES,  # type: ignore
+)
+
+
+async def main(worker: int = 0):
+    push_to_global = utils.CoalescingPublishQueue(
+        is_connected=False,
+        capacity=UPLINK_QUEUE_CAPACITY,
+        max_inflight=UPLINK_MAX_INFLIGHT,
+    )
+    tasks = [
+        cache_writer.run(),
+        aggregator.run(),
+        backfill.run(),
+        local_mqtt(worker, push_to_global),
+        report_stats(worker, push_to_global),
+    ]
+    if WORKERS > 1:
+        cache_writer.stats_key = f"stats:sensor_listener:{worker}:cache_writer"
+    if worker == 0:
+        with suppress(Exception):
+            await utils.migrate_cache_layout(cache)
+        with suppress(Exception):
+            await sensors_view.load(cache)
+        tasks += [
+            sensors_view.run(source=None if ingest_view else cache),
             external_mqtt(push_to_global),
-            local_mqtt(push_to_global),
-        )
+        ]
+        if WORKERS > 1:
+            tasks.append(bridge_mqtt(push_to_global))
+    try:
+        await asyncio.gather(*tasks)
     finally:
+        with suppress(Exception):
+            await cache_writer.flush()
+        with suppress(Exception):
+            await aggregator.flush(force=True)
+        with suppress(Exception):
+            await backfill.flush()
         await cache.aclose()
 
 
-async def external_mqtt(push_to_global: utils.AsyncConnectionQueue[shared.MQTTPacket]):
-    async def queue_handler(client: aiomqtt.Client):
-        while True:
-            await client.publish(**msgspec.to_builtins(await push_to_global.get()), qos=1)
+async def report_stats(worker: int, push_to_global: utils.CoalescingPublishQueue):
+    prefix = f"stats:sensor_listener:{worker}:" if WORKERS > 1 else "stats:sensor_listener:"  # Every worker writes
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        if worker == 0:
+            cache_writer.set("stats:sensor_listener:uplink", utils.encoder(push_to_global.stats))
+            cache_writer.set("stats:sensor_listener:deadband", utils.encoder(deadband.stats))
+        cache_writer.set(prefix + "backfill", utils.encoder(backfill.stats))
+        cache_writer.set(prefix + "aggregates", utils.encoder(aggregator.stats))
 
+
+async def external_mqtt(push_to_global: utils.CoalescingPublishQueue):
     async def message_handler(client: aiomqtt.Client):
         async for msg in client.messages:
             loc, rest = msg.topic.value.split("/", maxsplit=1)
-            msg.topic = aiomqtt.topic.Topic(rest)
-            shared.fire_forget_coro(utils.msg_handler(msg, location=loc, cache=cache))
+            if rest == shared.LINK_BATCH_TOPIC:
+                try:
+                    messages = utils.unpack_link_frame(msg)
+                except Exception as e:
+                    shared.print_err(e)
+                    continue
+            else:
+                msg.topic = aiomqtt.topic.Topic(rest)
+                messages = (msg,)
+            for message in messages:
+                utils.msg_handler(
+                    message,
+                    location=loc,
+                    cache=cache_writer,
+                    aggregator=aggregator,
+                    sensors_view=ingest_view,
+                    deadband=ingest_deadband,
+                    backfill=backfill,
+                )
 
     while True:
         with suppress(BaseException):
@@ -52,29 +145,96 @@ async def external_mqtt(push_to_global: utils.AsyncConnectionQueue[shared.MQTTPa
                 for location in CFG["other_loc"]:
                     await client.subscribe(location + "/#", qos=1)
                 await asyncio.gather(
-                    queue_handler(client),
+                    push_to_global.forward(
+                        client,
+                        batch_topic=f"{THIS_LOCATION}/{shared.LINK_BATCH_TOPIC}" if LINK_BATCH_SIZE > 1 else None,
+                        max_batch=LINK_BATCH_SIZE,
+                        max_delay=LINK_BATCH_DELAY,
+                    ),
                     message_handler(client),
                 )
         push_to_global.set(False)
         await asyncio.sleep(30)
 
 
-async def local_mqtt(push_to_global: utils.AsyncConnectionQueue[shared.MQTTPacket]):
-    async def handle_local_mqtt_msg(message: aiomqtt.Message):
-        if push_msg := await utils.msg_handler(message, location=THIS_LOCATION, cache=cache):
-            await push_to_global.put(push_msg)
+async def local_mqtt(worker: int, push_to_global: utils.CoalescingPublishQueue):
+    if WORKERS == 1:
+        client_cfg, protocol, subs = CFG["internal"], aiomqtt.ProtocolVersion.V31, CFG["subs"]
+    else:  # Forwarding is done by bridge_mqtt
+        client_cfg = CFG["internal"] | dict(identifier=f"{CFG['internal']['identifier']}_{worker}")
+        protocol = aiomqtt.ProtocolVersion.V5
+        subs = [f"$share/{SHARE_GROUP}/{sub}" for sub in CFG["subs"]]
 
     while True:
         with suppress(BaseException):
-            async with aiomqtt.Client(**CFG["internal"], protocol=aiomqtt.ProtocolVersion.V31) as client:
+            async with aiomqtt.Client(**client_cfg, protocol=protocol) as client:
                 await client.publish("void", client.identifier)
+                for sub in subs:
+                    await client.subscribe(sub, qos=1)
+
+                async for message in client.messages:
+                    utils.msg_handler(
+                        message,
+                        location=THIS_LOCATION,
+                        cache=cache_writer,
+                        aggregator=aggregator,
+                        sensors_view=ingest_view,
+                        deadband=ingest_deadband,
+                        backfill=backfill,
+                        uplink=push_to_global if WORKERS == 1 else None,
+                    )
+        await asyncio.sleep(30)
+
+
+async def bridge_mqtt(push_to_global: utils.CoalescingPublishQueue):
+    """Worker mode: the bridge owner receives all local messages, only to forward them to the other locations"""
+    client_cfg = CFG["internal"] | dict(identifier=f"{CFG['internal']['identifier']}_bridge")
+    while True:
+        with suppress(BaseException):
+            async with aiomqtt.Client(**client_cfg, protocol=aiomqtt.ProtocolVersion.V5) as client:
                 for sub in CFG["subs"]:
                     await client.subscribe(sub, qos=1)
 
                 async for message in client.messages:
-                    shared.fire_forget_coro(handle_local_mqtt_msg(message))
+                    utils.msg_handler(
+                        message, location=THIS_LOCATION, cache=None, deadband=deadband, uplink=push_to_global
+                    )
         await asyncio.sleep(30)
 
 
+def run_worker(worker: int):
+    asyncio.run(main(worker))
+
+
+def run_workers():
+    """One process per worker, restarted if it exits"""
+    context = multiprocessing.get_context("spawn")
+    workers: dict[int, tuple[int, multiprocessing.process.BaseProcess]] = {}
+
+    def start(worker: int):
+        process = context.Process(target=run_worker, args=(worker,), name=f"sensor_listener_{worker}")
+        process.start()
+        workers[process.sentinel] = (worker, process)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # Stop the workers on exit
+    try:
+        for worker in range(WORKERS):
+            start(worker)
+        while True:
+            for sentinel in wait(list(workers)):
+                worker, process = workers.pop(sentinel)  # type: ignore
+                shared.print_err(f"Worker {worker} exited with {process.exitcode}, restarting")
+                time.sleep(1)
+                start(worker)
+    finally:
+        for _, process in workers.values():
+            process.terminate()
+        for _, process in workers.values():
+            process.join()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())
@@ -1,91 +1,799 @@
 from __future__ import annotations
 
 import asyncio
+import time
+from collections.abc import Mapping
 from contextlib import suppress
-from typing import Literal, cast
+from functools import lru_cache
+from pathlib import Path
+from typing import Annotated, Literal, cast
 
 import aiomqtt as mqtt
+import aiosqlite
 import msgspec
 
 from appdata import shared
 
 encoder = msgspec.msgpack.Encoder().encode
-decoder = msgspec.json.Decoder().decode
+json_encoder = msgspec.json.Encoder().encode
+link_decoder = msgspec.msgpack.Decoder(list[shared.LinkReading]).decode
 
 
-class AsyncConnectionQueue[T](asyncio.Queue[T]):  # To prevent "memory leak" from adding too many items to queue.
-    __slots__ = ("is_connected",)
+class PublishQueueStats(msgspec.Struct):
+    depth: int = 0
+    published: int = 0
+    coalesced: int = 0  # Packets replaced by a newer packet on the same topic
+    dropped: int = 0  # Packets evicted due to capacity or discarded while disconnected
+    errors: int = 0
+    frames: int = 0  # Link frames, each carrying several published packets
 
-    def __init__(self, is_connected: bool):
+
+class CoalescingPublishQueue:  # Bounded, latest value per topic wins. Only accepts packets while connected.
+    __slots__ = ("capacity", "max_inflight", "is_connected", "stats", "_pending", "_has_data")
+
+    def __init__(self, is_connected: bool, capacity: int = 1024, max_inflight: int = 16):
+        if capacity <= 0 or max_inflight <= 0:
+            raise ValueError("capacity and max_inflight has to be positive")
+        self.capacity = capacity
+        self.max_inflight = max_inflight
         self.is_connected = is_connected
-        super().__init__()
+        self.stats = PublishQueueStats()
+        self._pending: dict[str, shared.MQTTPacket] = {}
+        self._has_data = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, packet: shared.MQTTPacket) -> bool:
+        if not self.is_connected:
+            return False
+        if packet.topic in self._pending:
+            self.stats.coalesced += 1
+        elif len(self._pending) >= self.capacity:  # Evict the oldest topic
+            del self._pending[next(iter(self._pending))]
+            self.stats.dropped += 1
+        self._pending[packet.topic] = packet
+        self.stats.depth = len(self._pending)
+        self._has_data.set()
+        return True
 
-    async def put(self, data: T):
-        if self.is_connected:
-            await super().put(data)
+    async def get(self) -> shared.MQTTPacket:
+        while not self._pending:
+            self._has_data.clear()
+            await self._has_data.wait()
+        return self._pop()
+
+    async def get_batch(self, max_size: int, max_delay: float) -> list[shared.MQTTPacket]:
+        """Waits for a packet, then at most max_delay seconds for up to max_size packets"""
+        batch = [await self.get()]
+        deadline = time.monotonic() + max_delay
+        while len(batch) < max_size:
+            if self._pending:
+                batch.append(self._pop())
+            elif (remaining := deadline - time.monotonic()) > 0:
+                self._has_data.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._has_data.wait(), remaining)
+            else:
+                break
+        return batch
+
+    def _pop(self) -> shared.MQTTPacket:
+        packet = self._pending.pop(next(iter(self._pending)))
+        self.stats.depth = len(self._pending)
+        return packet
 
     def set(self, value: bool):
         self.is_connected = value
         if not value:  # Clear queue if not connected
-            with suppress(asyncio.QueueEmpty):
-                while not self.get_nowait():
-                    pass
+            self.stats.dropped += len(self._pending)
+            self._pending.clear()
+            self.stats.depth = 0
+
+    async def forward(
+        self,
+        client: mqtt.Client,
+        batch_topic: str | None = None,
+        max_batch: int = 1,
+        max_delay: float = 0.0,
+    ):
+        """Publish packets with up to max_inflight unacknowledged QoS 1 publishes. Raises on publish errors.
+        With a batch_topic, up to max_batch packets collected within max_delay seconds are sent as one link frame.
+        Retained packets are always sent as they are."""
+
+        async def publish(packets: list[shared.MQTTPacket]):
+            try:
+                framed = [packet for packet in packets if not packet.retain] if batch_topic else []
+                if len(framed) < 2:
+                    framed = []
+                for packet in packets:
+                    if not framed or packet.retain:
+                        await client.publish(packet.topic, packet.payload, qos=1, retain=packet.retain)
+                if framed:
+                    await client.publish(cast(str, batch_topic), pack_link_frame(framed), qos=1)
+                    self.stats.frames += 1
+                self.stats.published += len(packets)
+            except Exception:
+                self.stats.errors += 1
+                raise
+            finally:
+                window.release()
+
+        window = asyncio.Semaphore(self.max_inflight)
+        async with asyncio.TaskGroup() as tg:
+            while True:
+                await window.acquire()  # Keep packets coalescable until they can be sent
+                tg.create_task(publish(await self.get_batch(max_batch if batch_topic else 1, max_delay)))
+
+
+def pack_link_frame(packets: list[shared.MQTTPacket]) -> bytes:
+    """Packets of one location, "{location}/{topic}", as a link frame"""
+    return encoder([shared.LinkReading(packet.topic.partition("/")[2], packet.payload) for packet in packets])
+
+
+def unpack_link_frame(msg: mqtt.Message) -> list[mqtt.Message]:
+    return [
+        mqtt.Message(reading.topic, reading.payload, msg.qos, False, msg.mid, None)
+        for reading in link_decoder(cast(bytes, msg.payload))
+    ]
+
+
+class CacheWriterStats(msgspec.Struct):
+    flushes: int = 0
+    keys_written: int = 0
+    coalesced: int = 0  # Writes replaced by a newer value before being flushed
+    errors: int = 0
+    last_flush_size: int = 0
+    max_flush_size: int = 0
+    last_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_flush_ms: float = 0.0
+
+
+class CacheWriteBuffer:  # Write-behind buffer, latest value per key/hash field wins. Flushed as one pipeline.
+    __slots__ = (
+        "cache",
+        "flush_interval",
+        "max_keys",
+        "stats_key",
+        "last_write_wins",
+        "stats",
+        "_pending",
+        "_versions",
+        "_publishes",
+        "_has_data",
+        "_is_full",
+    )
+
+    def __init__(
+        self,
+        cache: shared.ValkeyBasic,
+        flush_interval: float = 0.05,  # seconds
+        max_keys: int = 512,  # Flush immediately when this many distinct keys/hash fields are pending
+        stats_key: str | None = None,  # If given, stats are written to the cache with every flush
+        last_write_wins: bool = False,  # Hash fields are versioned, for multiple writer processes
+    ):
+        if flush_interval <= 0 or max_keys <= 0:
+            raise ValueError("flush_interval and max_keys has to be positive")
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.stats_key = stats_key
+        self.last_write_wins = last_write_wins
+        self.stats = CacheWriterStats()
+        self._pending: dict[tuple[str | None, str], bytes] = {}  # (hash name or None for plain keys, key)
+        self._versions: dict[tuple[str, str], int] = {}  # Microseconds, if last_write_wins
+        self._publishes: dict[tuple[str, str], bytes] = {}  # (channel, key), json. Published as one array
+        self._has_data = asyncio.Event()
+        self._is_full = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending) + len(self._publishes)
+
+    def set(self, key: str, value: bytes):
+        self._put((None, key), value)
+
+    def hset(self, name: str, field: str, value: bytes, timestamp: int | None = None):
+        """With last_write_wins the newest timestamp (epoch ms) wins, by default the write time"""
+        if self.last_write_wins:
+            version = time.time_ns() // 1000 if timestamp is None else timestamp * 1000
+            if self._versions.get(key := (name, field), 0) > version:  # An older reading that arrived late
+                return
+            self._versions[key] = version
+        self._put((name, field), value)
+
+    def publish(self, channel: str, key: str, message: bytes):
+        """Queue a json message, only the latest per key is published. Sent as a json array per channel and flush"""
+        self._publishes[(channel, key)] = message
+        self._has_data.set()
+        if len(self) >= self.max_keys:
+            self._is_full.set()
+
+    def _put(self, key: tuple[str | None, str], value: bytes):
+        if key in self._pending:
+            self.stats.coalesced += 1
+        self._pending[key] = value
+        self._has_data.set()
+        if len(self) >= self.max_keys:
+            self._is_full.set()
+
+    async def run(self):
+        while True:
+            await self._has_data.wait()
+            if not self._is_full.is_set():
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._is_full.wait(), self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        self._has_data.clear()
+        self._is_full.clear()
+        if not self._pending and not self._publishes:
+            return
+
+        batch, self._pending = self._pending, {}
+        publishes, self._publishes = self._publishes, {}
+        versions, self._versions = self._versions, {}
+        stats = self.stats
+        keys: dict[str, bytes] = {}
+        hashes: dict[str, dict[str, bytes]] = {}
+        versioned: dict[str, dict[str, tuple[int, bytes]]] = {}
+        for (name, key), value in batch.items():
+            if name is None:
+                keys[key] = value
+            elif (version := versions.get((name, key))) is not None:
+                versioned.setdefault(name, {})[key] = (version, value)
+            elif (fields := hashes.get(name)) is None:
+                hashes[name] = {key: value}
+            else:
+                fields[key] = value
+        if self.stats_key is not None:
+            keys[self.stats_key] = encoder(stats)
+        channels: dict[str, list[bytes]] = {}
+        for (channel, _), message in publishes.items():
+            channels.setdefault(channel, []).append(message)
+        messages = {channel: b"[" + b",".join(xs) + b"]" for channel, xs in channels.items()}
+
+        start = time.perf_counter()
+        try:
+            await self.cache.set_batch(keys, hashes, messages, versioned)
+        except Exception as e:
+            stats.errors += 1
+            shared.print_err(e)
+            for key, value in batch.items():  # Requeue, but never overwrite newer values
+                self._pending.setdefault(key, value)
+            for key, value in publishes.items():
+                self._publishes.setdefault(key, value)
+            for key, version in versions.items():
+                self._versions.setdefault(key, version)
+            self._has_data.set()
+            await asyncio.sleep(self.flush_interval)  # Do not spin while the cache is unavailable
+            return
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        size = len(batch)
+        stats.flushes += 1
+        stats.keys_written += size
+        stats.last_flush_size = size
+        stats.max_flush_size = max(stats.max_flush_size, size)
+        stats.last_flush_ms = elapsed_ms
+        stats.max_flush_ms = max(stats.max_flush_ms, elapsed_ms)
+        stats.total_flush_ms += elapsed_ms
+
+
+type Aggregate = Literal["min", "max", "sum", "last"]  # count is always kept
+AGGREGATES: tuple[Aggregate, ...] = ("min", "max", "sum", "last")
+MEASUREMENT_TYPE_IDS = {m.name.lower(): m.value for m in shared.MeasurementTypes}
+
+
+ROLLUP_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name       TEXT PRIMARY KEY NOT NULL,
+    high_water UNIXTIME NOT NULL
+);
+"""
+REWIND_ROLLUP = "UPDATE rollup_state SET high_water = min(high_water, ?) WHERE name = ?"
+ROLLUP_PERIODS = (("hourly", 3600), ("daily", 86400))
+
+
+async def rewind_rollups(conn: aiosqlite.Connection, oldest: int):
+    """Rolled up periods that got new data, from oldest, are rolled up again by the scheduler"""
+    for name, period in ROLLUP_PERIODS:
+        await conn.execute(REWIND_ROLLUP, (oldest - oldest % period, name))
+
+
+class WindowStats(msgspec.Struct):
+    windows: int = 0
+    rows_written: int = 0
+    errors: int = 0
+    pending_rows: int = 0  # Of failed writes, retried with the next flush
+    dropped_rows: int = 0  # Failed writes beyond max_pending_rows
+
+
+class WindowAggregator:  # Running aggregate per (device, sensor_id, type), flushed once per window.
+    __slots__ = ("db_path", "window", "aggregates", "max_pending_rows", "stats", "_window_start", "_current", "_failed")
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS measurement_windows (
+        window_start UNIXTIME NOT NULL,
+        window_sec   INTEGER NOT NULL,
+        device_name  TEXT NOT NULL COLLATE NOCASE,
+        sensor_id    INTEGER NOT NULL,
+        type_id      INTEGER NOT NULL,
+        count        INTEGER NOT NULL,
+        min          REAL,
+        max          REAL,
+        sum          REAL,
+        last         REAL,
+        last_ts      UNIXTIME,
+        FOREIGN KEY(type_id) REFERENCES measurement_types(type_id),
+        PRIMARY KEY(device_name, sensor_id, type_id, window_start)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_measurement_windows_time ON measurement_windows (window_start);
+    """ + ROLLUP_STATE_SCHEMA
+    ADD_LAST_TS = "ALTER TABLE measurement_windows ADD COLUMN last_ts UNIXTIME"  # Tables created before last_ts
+    # Merges with an existing row, i.e. a window that was partially flushed before a restart, or by another worker.
+    # last is the reading with the newest last_ts, not of the last flush.
+    INSERT = """
+    INSERT INTO measurement_windows
+        (window_start, window_sec, device_name, sensor_id, type_id, count, min, max, sum, last, last_ts)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT (device_name, sensor_id, type_id, window_start) DO UPDATE SET
+        count = count + excluded.count,
+        min = min(min, excluded.min),
+        max = max(max, excluded.max),
+        sum = sum + excluded.sum,
+        last = CASE WHEN excluded.last_ts >= IFNULL(last_ts, 0) THEN excluded.last ELSE last END,
+        last_ts = max(IFNULL(last_ts, 0), excluded.last_ts)
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path,
+        window: int = 300,
+        aggregates: tuple[Aggregate, ...] = AGGREGATES,
+        max_pending_rows: int = 10_000,
+    ):
+        if window <= 0 or max_pending_rows < 0:
+            raise ValueError("window has to be positive and max_pending_rows non-negative")
+        if unknown := set(aggregates).difference(AGGREGATES):
+            raise ValueError(f"Unknown aggregates: {unknown}")
+        self.db_path = db_path
+        self.window = window  # seconds, windows are aligned to the unix epoch
+        self.aggregates = aggregates
+        self.max_pending_rows = max_pending_rows
+        self.stats = WindowStats()
+        self._window_start = self._current_window_start()
+        # [count, min, max, sum, last, timestamp of last]
+        self._current: dict[tuple[str, int, int], list[float]] = {}
+        self._failed: list[tuple] = []  # Rows of failed writes, the upsert merges them into their windows later
+
+    def add(self, device_name: str, sensor_id: int, timestamp: int, data: dict[str, float]):
+        if self._current_window_start() != self._window_start:  # Window ended before run() got to flush it
+            if rows := self._rotate():
+                shared.task_supervisor.spawn("aggregate_flush", self._write(rows))
+        current = self._current
+        for key, value in data.items():
+            agg_key = (device_name, sensor_id, MEASUREMENT_TYPE_IDS[key])
+            if (agg := current.get(agg_key)) is None:
+                current[agg_key] = [1, value, value, value, value, timestamp]
+            else:
+                agg[0] += 1
+                if value < agg[1]:
+                    agg[1] = value
+                if value > agg[2]:
+                    agg[2] = value
+                agg[3] += value
+                if timestamp >= agg[5]:  # Readings with a device timestamp may arrive out of order
+                    agg[4] = value
+                    agg[5] = timestamp
+
+    async def setup(self):
+        async with aiosqlite.connect(self.db_path) as conn:
+            await conn.executescript(self.SCHEMA)
+            async with conn.execute("PRAGMA table_info(measurement_windows)") as cur:
+                if "last_ts" not in {row[1] for row in await cur.fetchall()}:
+                    await conn.execute(self.ADD_LAST_TS)
+            await conn.commit()
+
+    async def run(self):
+        await self.setup()
+        while True:
+            await asyncio.sleep(self._window_start + self.window - time.time())
+            await self.flush()
+
+    async def flush(self, force=False):
+        """Flush the finished window. force also flushes the current, unfinished, window."""
+        if (rows := self._rotate(force)) or self._failed:
+            await self._write(rows)
+
+    def _rotate(self, force=False) -> list[tuple]:
+        window_start = self._window_start
+        if (next_window_start := self._current_window_start()) == window_start and not force:
+            return []
+        self._window_start = next_window_start
+        batch, self._current = self._current, {}
+
+        keep = [agg in self.aggregates for agg in AGGREGATES]
+        last_ts = "last" in self.aggregates
+        return [
+            (window_start, self.window, device_name, sensor_id, type_id, int(agg[0]))
+            + tuple(value if k else None for value, k in zip(agg[1:5], keep))
+            + (int(agg[5]) if last_ts else None,)
+            for (device_name, sensor_id, type_id), agg in batch.items()
+        ]
+
+    async def _write(self, rows: list[tuple]):
+        rows, self._failed = self._failed + rows, []
+        try:
+            async with aiosqlite.connect(self.db_path) as conn:
+                await conn.execute("PRAGMA journal_mode = WAL")
+                await conn.executemany(self.INSERT, rows)
+                await rewind_rollups(conn, min(row[0] for row in rows))  # A window may end after its hour was rolled up
+                await conn.commit()
+        except Exception as e:  # E.g. busy, when all workers flush at the window boundary
+            self.stats.errors += 1
+            shared.print_err(e)
+            self._failed[:0] = rows  # Retried with the next flush
+            if (excess := len(self._failed) - self.max_pending_rows) > 0:
+                del self._failed[:excess]
+                self.stats.dropped_rows += excess
+        else:
+            self.stats.windows += len({row[0] for row in rows})
+            self.stats.rows_written += len(rows)
+        self.stats.pending_rows = len(self._failed)
+
+    def _current_window_start(self) -> int:
+        now = int(time.time())
+        return now - now % self.window
+
+
+class BackfillStats(msgspec.Struct):
+    readings: int = 0
+    rows_written: int = 0
+    flushes: int = 0
+    errors: int = 0
+    oldest_lag: int = 0  # seconds, of the oldest reading in the last flush
+
 
+class Backfill:  # Late readings, e.g. relayed after a link outage, written to measurements at their own time.
+    SCHEMA = ROLLUP_STATE_SCHEMA
+    INSERT_DEVICE = "INSERT OR IGNORE INTO device (name) VALUES (?)"
+    INSERT = """
+    INSERT OR REPLACE INTO measurements (device_id, sensor_id, type_id, timestamp, value)
+    SELECT device_id, ?, ?, ?, ? FROM device WHERE name = ?
+    """
 
-async def msg_handler(msg: mqtt.Message, location: str, cache: shared.ValkeyBasic) -> None | shared.MQTTPacket:
+    __slots__ = ("db_path", "late_after", "flush_interval", "max_rows", "stats", "_rows", "_is_full")
+
+    def __init__(self, db_path: str | Path, late_after: int = 120, flush_interval: float = 5.0, max_rows: int = 1000):
+        if late_after <= 0 or flush_interval <= 0 or max_rows <= 0:
+            raise ValueError("late_after, flush_interval and max_rows has to be positive")
+        self.db_path = db_path
+        self.late_after = late_after  # seconds, older readings are late
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.stats = BackfillStats()
+        self._rows: list[tuple[int, int, int, float, str]] = []  # (sensor_id, type_id, timestamp, value, device_name)
+        self._is_full = asyncio.Event()
+
+    def add(self, device_name: str, sensor_id: int, timestamp: int, data: dict[str, float]):
+        self.stats.readings += 1
+        for key, value in data.items():
+            self._rows.append((sensor_id, MEASUREMENT_TYPE_IDS[key], timestamp, value, device_name))
+        if len(self._rows) >= self.max_rows:
+            self._is_full.set()
+
+    async def setup(self):
+        """Raises on the legacy measurements layout, scheduler/migrate_measurements.py has to run first"""
+        async with aiosqlite.connect(self.db_path) as conn:
+            async with conn.execute("PRAGMA table_info(measurements)") as cur:
+                if "device_id" not in {row[1] for row in await cur.fetchall()}:
+                    raise RuntimeError("measurements has the legacy layout, run migrate_measurements.py first")
+            await conn.executescript(self.SCHEMA)
+            await conn.commit()
+
+    async def run(self):
+        await self.setup()
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._is_full.wait(), self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        self._is_full.clear()
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        oldest = min(row[2] for row in rows)
+        try:
+            async with aiosqlite.connect(self.db_path) as conn:
+                await conn.execute("PRAGMA journal_mode = WAL")
+                await conn.executemany(self.INSERT_DEVICE, {(row[4],) for row in rows})
+                await conn.executemany(self.INSERT, rows)
+                await rewind_rollups(conn, oldest)
+                await conn.commit()
+        except Exception as e:
+            self.stats.errors += 1
+            shared.print_err(e)
+            self._rows[:0] = rows[: max(0, 10 * self.max_rows - len(self._rows))]  # Retried with the next flush
+            return
+        self.stats.flushes += 1
+        self.stats.rows_written += len(rows)
+        self.stats.oldest_lag = int(time.time()) - oldest
+
+
+class SensorsView:  # Materialized {location: {device_name: {sensor_id: {date, timestamp, data}}}} json, served as is.
+    __slots__ = ("cache", "interval", "version", "_view", "_dirty", "_loaded")
+
+    def __init__(self, cache: CacheWriteBuffer, interval: float = 1.0):
+        self.cache = cache
+        self.interval = interval  # seconds, minimum time between renders
+        self.version = time.time_ns() // 1000  # Keeps increasing across restarts
+        self._view: dict[str, dict[str, dict[int, shared.SensorData]]] = {}
+        self._dirty = False
+        self._loaded: list[bytes] = []
+
+    def update(self, data: shared.SensorData):
+        self._view.setdefault(data.location, {}).setdefault(data.device_name, {})[data.sensor_id] = data
+        self._dirty = True
+
+    def seen(self, topic: Topic, timestamp: int) -> shared.SensorData | None:
+        """An unchanged reading, only moves the timestamp (epoch ms) forward. Returns the refreshed reading."""
+        sensors = self._view.get(topic.location, {}).get(topic.device_name, {})
+        if (data := sensors.get(topic.sensor_id)) is None or data.timestamp >= timestamp:
+            return None
+        sensors[topic.sensor_id] = data = msgspec.structs.replace(data, timestamp=timestamp)
+        self._dirty = True
+        return data
+
+    async def load(self, cache: shared.ValkeyBasic):
+        """Seed the view from the cache, sensors that published before a restart are kept"""
+        values = await cache.hash_values(shared.CACHE_SENSORS)
+        if values == self._loaded:
+            return
+        self._loaded = values
+        decode = msgspec.msgpack.Decoder(shared.SensorData).decode
+        for value in values:
+            with suppress(msgspec.DecodeError):
+                self.update(decode(value))
+
+    async def run(self, source: shared.ValkeyBasic | None = None):
+        """With a source the view is reloaded from the cache every interval, for when other processes write sensors"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if source is not None:
+                with suppress(Exception):
+                    await self.load(source)
+            if self._dirty:
+                self.render()
+
+    def render(self):
+        self._dirty = False
+        self.version += 1
+        self.cache.hset(shared.CACHE_SENSORS_VIEW, "version", str(self.version).encode())
+        view = {
+            location: {
+                name: {sensor_id: data.to_dict() for sensor_id, data in sensors.items()}
+                for name, sensors in devices.items()
+            }
+            for location, devices in self._view.items()
+        }
+        self.cache.hset(shared.CACHE_SENSORS_VIEW, "json", json_encoder(view))
+
+
+async def migrate_cache_layout(cache: shared.ValkeyBasic) -> int:
+    """Move legacy "sensor:{device}:{id}" and "relay:{device}" keys into the category hashes.
+    Existing hash fields are newer and are kept. Returns number of migrated keys."""
+    migrated = 0
+    for prefix, name in (("sensor:", shared.CACHE_SENSORS), ("relay:", shared.CACHE_RELAYS)):
+        async for key in cache.scan_iter(match=prefix + "*", count=1000):
+            if (value := await cache.get(key)) is not None:
+                await cache.hsetnx(name, key.decode().removeprefix(prefix), value)  # type: ignore
+                migrated += 1
+            await cache.delete(key)
+    return migrated
+
+
+DEADBANDS: dict[shared.MeasurementTypes, float] = {
+    shared.MeasurementTypes.TEMPERATURE: 0.1,
+    shared.MeasurementTypes.HUMIDITY: 0.5,
+    shared.MeasurementTypes.AIRPRESSURE: 0.5,
+}
+
+
+def parse_deadbands(spec: str) -> dict[shared.MeasurementTypes, float]:
+    """"temperature=0.1,humidity=0.5" -> {MeasurementTypes.TEMPERATURE: 0.1, ...}"""
+    deadbands = {}
+    for item in filter(None, spec.replace(" ", "").split(",")):
+        name, band = item.split("=")
+        deadbands[shared.MeasurementTypes[name.upper()]] = float(band)
+    return deadbands
+
+
+class DeadbandStats(msgspec.Struct):
+    accepted: int = 0
+    suppressed: int = 0  # Readings within the deadband of the last accepted reading
+
+
+class Deadband:  # Change detection per sensor. Compared to the last accepted reading, so slow drift is still caught.
+    # changed() only compares, accept() records the reading once it was actually written or queued.
+    __slots__ = ("bands", "max_silence", "stats", "_last")
+
+    def __init__(self, deadbands: Mapping[shared.MeasurementTypes, float] = DEADBANDS, max_silence: float = 300):
+        if max_silence <= 0 or any(band < 0 for band in deadbands.values()):
+            raise ValueError("max_silence has to be positive and deadbands non-negative")
+        self.bands = {measurement.name.lower(): band for measurement, band in deadbands.items()}
+        self.max_silence = max_silence  # seconds, a reading is accepted at least this often
+        self.stats = DeadbandStats()
+        self._last: dict[str, tuple[float, dict[str, float]]] = {}  # key -> (accepted at, reading)
+
+    def changed(self, key: str, data: dict[str, float]) -> bool:
+        now = time.monotonic()
+        if (last := self._last.get(key)) is not None and now - last[0] < self.max_silence:
+            accepted, bands = last[1], self.bands
+            if accepted.keys() == data.keys() and all(
+                abs(value - accepted[name]) <= bands.get(name, 0) for name, value in data.items()
+            ):
+                self.stats.suppressed += 1
+                return False
+        return True
+
+    def accept(self, key: str, data: dict[str, float]):
+        self._last[key] = (time.monotonic(), data)
+        self.stats.accepted += 1
+
+
+def _measurement(measurement: shared.MeasurementTypes):
+    low, high = shared.MEASUREMENT_RANGES[measurement]
+    return Annotated[float, msgspec.Meta(ge=low, le=high)]
+
+
+Temperature = _measurement(shared.MeasurementTypes.TEMPERATURE)
+Humidity = _measurement(shared.MeasurementTypes.HUMIDITY)
+AirPressure = _measurement(shared.MeasurementTypes.AIRPRESSURE)
+
+
+class SensorPayload(msgspec.Struct, forbid_unknown_fields=True, omit_defaults=True, gc=False):
+    """Payload of "{device}/sensor/{sensor_id}". Keys are lower case, values are range checked while decoding.
+    timestamp is when it was measured, if the device knows, else set by the first location that forwards it."""
+
+    temperature: Temperature | None = None
+    humidity: Humidity | None = None
+    airpressure: AirPressure | None = None
+    timestamp: Annotated[int, msgspec.Meta(ge=0)] | None = None  # unix time
+
+
+MEASUREMENT_FIELDS = tuple(field for field in SensorPayload.__struct_fields__ if field != "timestamp")
+sensor_decoder = msgspec.json.Decoder(SensorPayload).decode
+relay_decoder = msgspec.json.Decoder(dict[str, bool]).decode
+
+
+class Topic(msgspec.Struct, frozen=True, gc=False):
+    location: str
+    device_name: str
+    device_type: Literal["relay", "sensor"]
+    sensor_id: int  # 0 for relays
+    field: str  # Field in the cache hash
+    forward: str  # Topic forwarded to the other locations
+
+
+@lru_cache(maxsize=4096)
+def parse_topic(location: str, topic: str) -> Topic | None:
+    """Parsed once per (location, topic). None for topics that are not cached."""
+    location = location.strip().lower()
+    topic = topic.strip().lower()
+    paths = topic.split("/")
+    if paths[0] == "error":
+        # err_msg = ErrorMsg(**json.loads(payload), location=location, date=timenow_utc("seconds"))
+        # await self.db.insert_error(err_msg)
+        return None
+
+    device_name, device_type, payload_tag = paths  # device_type: relay, sensor, switch
+    match device_type:
+        case "relay":
+            return Topic(location, device_name, device_type, 0, device_name, f"{location}/{topic}")
+        case "sensor":
+            return Topic(
+                location,
+                device_name,
+                device_type,
+                int(payload_tag),  # 0..n sensor
+                f"{device_name}:{payload_tag}",
+                f"{location}/{topic}",
+            )
+    return None
+
+
+def msg_handler(
+    msg: mqtt.Message,
+    location: str,
+    cache: CacheWriteBuffer | None,  # None only validates and returns the packet to forward
+    aggregator: WindowAggregator | None = None,
+    sensors_view: SensorsView | None = None,
+    deadband: Deadband | None = None,  # Unchanged readings only update the seen time (view, stream), not forwarded
+    backfill: Backfill | None = None,  # Late readings are only written to measurements, at their own time
+    uplink: CoalescingPublishQueue | None = None,  # Queues the packet to forward, else it is only returned
+) -> None | shared.MQTTPacket:
     try:
-        location = location.strip().lower()
-        topic = msg.topic.value.strip().lower()
+        if (topic := parse_topic(location, msg.topic.value)) is None:
+            return None
         payload = cast(bytes, msg.payload)
-        paths = topic.split("/")
-        if paths[0] == "error":
-            # err_msg = ErrorMsg(**json.loads(payload), location=location, date=timenow_utc("seconds"))
-            # await self.db.insert_error(err_msg)
+        if cache is None:
+            if topic.device_type == "sensor":
+                sensor = sensor_decoder(payload)
+                data = {key: value for key in MEASUREMENT_FIELDS if (value := getattr(sensor, key)) is not None}
+                if deadband is None or deadband.changed(topic.field, data):
+                    return _forward(_forward_packet(topic, sensor, payload, msg.retain), topic, data, deadband, uplink)
+            return None
+        if topic.device_type == "relay":
+            statusdata = shared.StatusData(
+                device_type=topic.device_type,
+                location=topic.location,
+                device_name=topic.device_name,
+                data=relay_decoder(payload),
+            )
+            cache.hset(shared.CACHE_RELAYS, topic.field, encoder(statusdata))
+            cache.publish(shared.CHANNEL_RELAYS, topic.field, json_encoder(statusdata))
+            return None
+
+        sensor = sensor_decoder(payload)
+        data = {key: value for key in MEASUREMENT_FIELDS if (value := getattr(sensor, key)) is not None}
+        now = int(time.time())
+        timestamp = now if sensor.timestamp is None else min(sensor.timestamp, now)
+        if backfill is not None and timestamp < now - backfill.late_after:
+            backfill.add(topic.device_name, topic.sensor_id, timestamp, data)
+            return None
+        if aggregator is not None:  # Gets every reading
+            aggregator.add(topic.device_name, topic.sensor_id, timestamp, data)
+        cache.hset(shared.CACHE_SENSORS_SEEN, topic.field, b"%d" % (timestamp * 1000), timestamp * 1000)
+        if deadband is not None and not deadband.changed(topic.field, data):
+            if sensors_view is not None and (refreshed := sensors_view.seen(topic, timestamp * 1000)):
+                cache.publish(shared.CHANNEL_SENSORS, topic.field, json_encoder(refreshed))
             return None
 
-        device_name, device_type, payload_tag = paths  # device_type: relay, sensor, switch
-        match device_type:
-            case "relay":
-                statusdata = shared.StatusData(
-                    device_type=device_type,
-                    location=location,
-                    device_name=device_name,
-                    data=decoder(payload),  # payload: json_ser(dict[str, bool])
-                )
-                await cache.set(f"{device_type}:{device_name}", encoder(statusdata))
-            case "sensor":
-                __data: dict[str, float] = decoder(payload)
-                data = {k.lower(): v for k, v in __data.items() if test_value(k, v)}
-                if len(__data) == len(data):
-                    sensordata = shared.SensorData(
-                        date=shared.datetime_now_isofmtZ("seconds"),
-                        location=location,
-                        device_name=device_name,
-                        sensor_id=int(payload_tag),  # 0..n sensor
-                        data=data,
-                    )
-                    await cache.set(f"{device_type}:{device_name}:{payload_tag}", encoder(sensordata))
-                    return shared.MQTTPacket(topic=f"{location}/{topic}", payload=payload, retain=msg.retain)
+        sensordata = shared.SensorData(
+            location=topic.location,
+            device_name=topic.device_name,
+            sensor_id=topic.sensor_id,
+            data=data,
+            timestamp=timestamp * 1000,
+            version=shared.SENSOR_DATA_VERSION,
+        )
+        cache.hset(shared.CACHE_SENSORS, topic.field, encoder(sensordata), sensordata.timestamp)
+        cache.publish(shared.CHANNEL_SENSORS, topic.field, json_encoder(sensordata))
+        if sensors_view is not None:
+            sensors_view.update(sensordata)
+        return _forward(_forward_packet(topic, sensor, payload, msg.retain, timestamp), topic, data, deadband, uplink)
+    except msgspec.ValidationError:
+        return None  # Unknown key or value out of range, drop the reading
     except Exception as e:
         shared.print_err(e)
 
 
-def test_value(key: str | Literal["temperature", "humidity", "airpressure"], value: float | int) -> bool:
-    match key.lower():
-        case "temperature":
-            _min, _max = -50, 60
-        case "humidity":
-            _min, _max = 0, 100
-        case "airpressure":
-            _min, _max = 800, 1300
-        case _:
-            raise ValueError(f"Unknown key: {key}")
-    return _min <= value <= _max
-
-
-# class ErrorMsg(TypedDict):
-#     date: str
-#     location: str
-#     device_name: str
-#     log_level: Literal["debug", "info", "warning", "error", "critical"]
-#     detail: str
+def _forward(
+    packet: shared.MQTTPacket,
+    topic: Topic,
+    data: dict[str, float],
+    deadband: Deadband | None,
+    uplink: CoalescingPublishQueue | None,
+) -> None | shared.MQTTPacket:
+    """The deadband only accepts a reading once its packet is queued, else the next reading is forwarded again"""
+    if uplink is not None and not uplink.put(packet):
+        return None
+    if deadband is not None:
+        deadband.accept(topic.field, data)
+    return packet
+
+
+def _forward_packet(
+    topic: Topic,
+    sensor: SensorPayload,
+    payload: bytes,
+    retain: bool,
+    timestamp: int | None = None,
+) -> shared.MQTTPacket:
+    if sensor.timestamp is None:  # Keep the time it was received here, it may be delivered late
+        sensor = msgspec.structs.replace(sensor, timestamp=int(time.time()) if timestamp is None else timestamp)
+        payload = json_encoder(sensor)
+    return shared.MQTTPacket(topic=topic.forward, payload=payload, retain=retain)
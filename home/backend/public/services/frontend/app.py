@@ -15,21 +15,33 @@ app = Quart(__name__)
 http = httpx.AsyncClient(base_url=f"https://{api}:{environ["APIPORT"]}/", verify=ROOT_CA)
 
 
+_last_etag: str | None = None
+_last_body: str | None = None
+
+
 @app.route("/")
 async def index():
+    global _last_etag, _last_body
+
     # Convert to a nicer format, use data/sensors instead for faster response
-    data = loads((await http.get("data/sensors")).content)
+    headers = {"If-None-Match": _last_etag} if _last_etag and _last_body else None
+    api_resp = await http.get("data/sensors", headers=headers)
     try:
-        refdict = data["home"]["kitchen"]
-        data["home"]["kitchen"] = refdict["0"]
+        if api_resp.status_code != 304:
+            data = loads(api_resp.content)
+            refdict = data["home"]["kitchen"]
+            data["home"]["kitchen"] = refdict["0"]
+
+            refdict = data["home"]["balcony"].pop("0")
+            data["home"]["balcony"]["inside"] = refdict
 
-        refdict = data["home"]["balcony"].pop("0")
-        data["home"]["balcony"]["inside"] = refdict
+            refdict = data["home"]["balcony"].pop("1")
+            data["home"]["balcony"]["outside"] = refdict
 
-        refdict = data["home"]["balcony"].pop("1")
-        data["home"]["balcony"]["outside"] = refdict
+            _last_body = dumps(data, indent=2)
+            _last_etag = api_resp.headers.get("ETag")
 
-        resp = await make_response(dumps(data, indent=2))
+        resp = await make_response(_last_body)
         resp.headers["Content-Type"] = "application/json"
         return resp
     except:
@@ -0,0 +1,179 @@
+"""
+Ingest benchmark: replays synthetic device traffic through MQTTHandler.msg_handler and the external forward queue,
+scheduled like _local_mqtt and _external_mqtt do. The brokers are in process stand-ins, so it runs offline.
+
+Latency is local publish -> forwarded to the external broker, measured for every message.
+Reports throughput, latency percentiles, peak asyncio task count and RSS.
+
+python3 bench_ingest.py [rate msgs/s, 0 = as fast as possible, default 500] [devices=10] [seconds=10]
+
+Regression gates, exits with 1 if not met:
+BENCH_MIN_RATE=<msgs/s> BENCH_MAX_P99_MS=<ms> python3 bench_ingest.py ...
+"""
+
+import asyncio
+import os
+import resource
+import sys
+import time
+from collections import deque
+from contextlib import suppress
+from typing import NamedTuple
+
+import utils
+
+TICK = 0.001  # seconds between publish bursts when rate limited
+LOCATION = "landet"
+
+
+class FakeTopic(NamedTuple):
+    value: str
+
+
+class FakeMessage(NamedTuple):
+    topic: FakeTopic
+    payload: bytes
+    retain: bool
+
+
+class FakeClient:
+    """Stand-in for aiomqtt.Client: messages are fed from a queue, publishes are acknowledged on the next loop turn"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue[FakeMessage | None]()
+        self.published = 0
+
+    @property
+    async def messages(self):
+        while (msg := await self.queue.get()) is not None:
+            yield msg
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        await asyncio.sleep(0)
+        self.published += 1
+
+
+def make_traffic(devices: int) -> list[tuple[str, bytes]]:
+    return [
+        (f"device{i}/sensor", b'{"temperature":%.2f,"humidity":%.1f}' % (20 + i % 7, 40 + i % 13))
+        for i in range(devices)
+    ]
+
+
+async def publisher(
+    client: FakeClient,
+    published: dict[str, deque[float]],  # topic -> publish times, in order
+    devices: int,
+    rate: int,
+    seconds: float,
+) -> int:
+    traffic = make_traffic(devices)
+    sent = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        due = int(elapsed * rate) if rate else sent + 1000
+        for _ in range(due - sent):
+            topic, payload = traffic[sent % len(traffic)]
+            published.setdefault(topic, deque()).append(time.perf_counter())
+            client.queue.put_nowait(FakeMessage(FakeTopic(topic), payload, False))
+            sent += 1
+        await asyncio.sleep(TICK if rate else 0)
+    client.queue.put_nowait(None)
+    return sent
+
+
+async def consumer(client: FakeClient, handler: utils.MQTTHandler) -> int:
+    """The message loop of MQTTHandler._local_mqtt"""
+    handled = 0
+    async for msg in client.messages:
+        utils.fire_forget_coro(handler.msg_handler(msg, LOCATION))  # type: ignore
+        handled += 1
+    return handled
+
+
+async def forwarder(
+    client: FakeClient,
+    handler: utils.MQTTHandler,
+    published: dict[str, deque[float]],
+    latencies: list[float],
+):
+    """The publish loop of MQTTHandler._external_mqtt"""
+    while True:
+        packet = await handler.push_external_msgs.get()
+        await client.publish(**packet, qos=1)
+        latencies.append(time.perf_counter() - published[packet["topic"].partition("/")[2]].popleft())
+
+
+async def sample_tasks(peak: list[int]):
+    while True:
+        peak[0] = max(peak[0], len(asyncio.all_tasks()))
+        await asyncio.sleep(0.01)
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+async def main(rate: int, devices: int, seconds: float):
+    handler = utils.MQTTHandler({})
+    handler.push_external_msgs.toggle(True)
+    local, external = FakeClient(), FakeClient()
+    published: dict[str, deque[float]] = {}
+    latencies: list[float] = []
+    peak_tasks = [0]
+    background = [
+        asyncio.create_task(forwarder(external, handler, published, latencies)),
+        asyncio.create_task(sample_tasks(peak_tasks)),
+    ]
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    handled, sent = await asyncio.gather(consumer(local, handler), publisher(local, published, devices, rate, seconds))
+    while handler.push_external_msgs.queue.qsize() or len(asyncio.all_tasks()) > len(background) + 1:
+        await asyncio.sleep(0)  # Drain handler tasks and the forward queue
+    await asyncio.sleep(TICK)  # Last publish in flight
+    elapsed = time.perf_counter() - start
+    for task in background:
+        task.cancel()
+        with suppress(BaseException):
+            await task
+
+    latencies.sort()
+    throughput = handled / elapsed
+    p99 = percentile(latencies, 0.99)
+    print(f"{sent} messages from {devices} devices, target {rate or 'max'} msgs/s, {elapsed:.1f} s")
+    print(f"throughput: {throughput:12,.0f} msgs/s, {external.published} forwarded")
+    print(
+        f"latency ms: p50 {percentile(latencies, 0.5):.2f}, p90 {percentile(latencies, 0.9):.2f},"
+        f" p99 {p99:.2f}, max {percentile(latencies, 1):.2f} ({len(latencies)} samples)"
+    )
+    print(f"tasks:      peak {peak_tasks[0]}")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"rss MB:     {rss_before:.1f} -> {rss_mb():.1f}, peak {peak_rss:.1f}")
+
+    failed = False
+    if (min_rate := float(os.environ.get("BENCH_MIN_RATE", 0))) and throughput < min_rate:
+        print(f"FAIL: throughput below {min_rate:,.0f} msgs/s")
+        failed = True
+    if (max_p99 := float(os.environ.get("BENCH_MAX_P99_MS", 0))) and p99 > max_p99:
+        print(f"FAIL: p99 latency above {max_p99} ms")
+        failed = True
+    return failed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(
+        asyncio.run(
+            main(
+                rate=int(args[0]) if len(args) > 0 else 500,
+                devices=int(args[1]) if len(args) > 1 else 10,
+                seconds=float(args[2]) if len(args) > 2 else 10,
+            )
+        )
+    )
@@ -35,7 +35,7 @@ async def main():
             await db.commit()
 
     await asyncio.gather(
-        utils.MQTTHandler(tmp_data).run(),
+        utils.MQTTHandler(tmp_data, utils.Deadband()).run(),
         http_requests(),
     )
 
@@ -1,16 +1,32 @@
 import asyncio
+import time
 from asyncio import Queue, Task, create_task
+from collections import deque
 from datetime import UTC, datetime
+from functools import cache
 from glob import glob
+from os import environ
 from ssl import SSLContext, create_default_context
 from typing import Coroutine, Literal, NoReturn, TypedDict, cast
 
 import aiomqtt as mqtt
+import msgspec
 import ujson as json
 import utils
 from aiofiles import open as async_open
 
-TEMPERATURE_FILE = glob("/sys/bus/w1/devices/28*")[0] + "/w1_slave"
+# Readings within the deadband of the last forwarded one are not forwarded, until MAX_SILENCE seconds have passed.
+DEADBANDS: dict[str, float] = {"temperature": 0.1, "humidity": 0.5, "airpressure": 0.5}
+MAX_SILENCE = 300
+# Link frames to home: up to LINK_BATCH_SIZE readings in one msgpack publish to "{location}/batch",
+# as [[topic without location, payload], ...], waiting at most LINK_BATCH_DELAY seconds. 1 disables.
+LINK_BATCH_SIZE = int(environ.get("LINK_BATCH_SIZE", 1))
+LINK_BATCH_DELAY = float(environ.get("LINK_BATCH_DELAY", 0.5))
+LINK_BATCH_TOPIC = "batch"
+# Readings while the link to home is down, sent with their timestamps on reconnect. The oldest are dropped first.
+OUTAGE_BUFFER = int(environ.get("OUTAGE_BUFFER", 10_000))
+
+TEMPERATURE_FILE = next(iter(glob("/sys/bus/w1/devices/28*")), "") + "/w1_slave"  # Read fails if not connected
 
 
 # Temp data and corresponding time when data was received.
@@ -25,71 +41,137 @@ class MQTTPacket(TypedDict):
     retain: bool
 
 
-class AsyncConnectionQueue:  # To prevent "memory leak" from adding too many items to queue.
-    __slots__ = ("is_connected", "queue")
+class AsyncConnectionQueue:  # Queue while connected, bounded outage buffer while not, to not grow without limit.
+    __slots__ = ("is_connected", "queue", "buffer")
 
-    def __init__(self, is_connected: bool):
+    def __init__(self, is_connected: bool, max_buffered: int = OUTAGE_BUFFER):
         self.is_connected = is_connected
         self.queue: Queue[MQTTPacket] = Queue()
+        self.buffer: deque[MQTTPacket] = deque(maxlen=max_buffered)
 
-    async def put(self, data: MQTTPacket):
+    async def put(self, data: MQTTPacket) -> bool:
         if self.is_connected:
             await self.queue.put(data)
+        elif self.buffer.maxlen:
+            self.buffer.append(data)
+        else:
+            return False
+        return True
 
     async def get(self):
         return await self.queue.get()
 
-    def toggle(self, value: bool):
+    async def get_batch(self, max_size: int, max_delay: float) -> list[MQTTPacket]:
+        """Waits for a packet, then at most max_delay seconds for up to max_size packets"""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + max_delay
+        while len(batch) < max_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            elif (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                break
+        return batch
+
+    def toggle(self, value: bool, unsent: list[MQTTPacket] | None = None):
+        """unsent: packets taken from the queue that were not published, buffered before the rest of the queue"""
         self.is_connected = value
-        if not value:  # Clear queue if not connected
+        if value:  # Replay the outage in order
+            while self.buffer:
+                self.queue.put_nowait(self.buffer.popleft())
+        else:
+            self.buffer.extend(unsent or ())
             while not self.queue.empty():
-                try:
-                    self.queue.get_nowait()
-                except:
-                    pass
+                self.buffer.append(self.queue.get_nowait())
+
+
+class Deadband:  # Compared to the last forwarded reading, so slow drift is still forwarded.
+    # changed() only compares, accept() records the reading once it was queued.
+    __slots__ = ("bands", "max_silence", "_last")
+
+    def __init__(self, bands: dict[str, float] = DEADBANDS, max_silence: float = MAX_SILENCE):
+        self.bands = bands
+        self.max_silence = max_silence
+        self._last: dict[str, tuple[float, dict[str, float]]] = {}
+
+    def changed(self, key: str, data: dict[str, float]) -> bool:
+        now = time.monotonic()
+        if (last := self._last.get(key)) is not None and now - last[0] < self.max_silence:
+            forwarded = last[1]
+            if forwarded.keys() == data.keys() and all(
+                abs(v - forwarded[k]) <= self.bands.get(k, 0) for k, v in data.items()
+            ):
+                return False
+        return True
+
+    def accept(self, key: str, data: dict[str, float]):
+        self._last[key] = (time.monotonic(), data)
 
 
 class MQTTHandler:
-    __slots__ = ("push_external_msgs", "external_mqtt_task", "tmp_data")
+    __slots__ = ("push_external_msgs", "external_mqtt_task", "tmp_data", "deadband")
 
-    def __init__(self, tmp_data: dict[str, TmpData]):
+    def __init__(self, tmp_data: dict[str, TmpData], deadband: Deadband | None = None):
         self.tmp_data = tmp_data
         self.external_mqtt_task = None
         self.push_external_msgs = AsyncConnectionQueue(is_connected=False)
+        self.deadband = deadband  # Unchanged readings only update tmp_data
 
     async def run(self) -> NoReturn:
         self.external_mqtt_task = asyncio.create_task(self._external_mqtt(), name="external_mqtt_task")
         await self._local_mqtt()
 
     async def _external_mqtt(self):
+        cfg = load_setup_cfg()
         while True:
+            packets: list[MQTTPacket] = []  # Taken from the queue, not published yet
             try:
-                async with mqtt.Client(**CFG["external"], protocol=mqtt.ProtocolVersion.V31) as c:
+                async with mqtt.Client(**cfg["external"], protocol=mqtt.ProtocolVersion.V31) as c:
                     await c.publish("void", c.identifier)
                     self.push_external_msgs.toggle(True)
                     while True:
-                        await c.publish(**await self.push_external_msgs.get(), qos=1)
+                        packets = await self.push_external_msgs.get_batch(LINK_BATCH_SIZE, LINK_BATCH_DELAY)
+                        if len(packets) == 1:
+                            await c.publish(**packets[0], qos=1)
+                            packets = []
+                            continue
+                        frame = [[p["topic"].partition("/")[2], p["payload"]] for p in packets if not p["retain"]]
+                        for packet in packets:
+                            if packet["retain"]:
+                                await c.publish(**packet, qos=1)
+                        if frame:
+                            topic = f'{cfg["current_loc"]}/{LINK_BATCH_TOPIC}'
+                            await c.publish(topic, msgspec.msgpack.encode(frame), qos=1)
+                        packets = []
             except:
-                self.push_external_msgs.toggle(False)
+                self.push_external_msgs.toggle(False, unsent=packets)
                 await asyncio.sleep(30)
 
-    async def _local_mqtt(self):
-        async def msg_handler(msg: mqtt.Message) -> None | MQTTPacket:
-            try:
-                full_topic = msg.topic.value.lower()
-                device_name = full_topic.split("/", 1)[0]
-                payload = cast(bytes, msg.payload)
-                _data: dict[str, float] = json.loads(payload)
-                data = {k.lower(): v for k, v in _data.items() if test_value(k, v)}
-                if len(_data) == len(data):
-                    self.tmp_data[device_name] = TmpData(date=datetime.now(UTC), data=data)
-                    await self.push_external_msgs.put(
-                        MQTTPacket(topic=f'{CFG["current_loc"]}/{full_topic}', payload=payload, retain=msg.retain)
-                    )
-            except:
-                pass
-            return None
+    async def msg_handler(self, msg: mqtt.Message, location: str) -> None:
+        try:
+            full_topic = msg.topic.value.lower()
+            device_name = full_topic.split("/", 1)[0]
+            payload = cast(bytes, msg.payload)
+            _data: dict[str, float] = json.loads(payload)
+            timestamp = int(_data.pop("timestamp", 0)) or int(time.time())  # Optional, unix time it was measured
+            data = {k.lower(): v for k, v in _data.items() if test_value(k, v)}
+            if len(_data) == len(data):
+                self.tmp_data[device_name] = TmpData(date=datetime.fromtimestamp(timestamp, UTC), data=data)
+                if self.deadband is not None and not self.deadband.changed(full_topic, data):
+                    return
+                # Forwarded with its timestamp, home backfills readings that arrive late
+                payload = json.dumps(data | {"timestamp": timestamp}).encode()
+                packet = MQTTPacket(topic=f"{location}/{full_topic}", payload=payload, retain=msg.retain)
+                if await self.push_external_msgs.put(packet) and self.deadband is not None:
+                    self.deadband.accept(full_topic, data)  # Only once queued, a dropped reading is sent again
+        except:
+            pass
 
+    async def _local_mqtt(self):
         async def publish_temp_to_mqtt_task(client: mqtt.Client, publish_topic: str) -> None:
             while True:
                 try:
@@ -105,17 +187,18 @@ class MQTTHandler:
                 except:
                     await asyncio.sleep(30)
 
-        publish_topic: str = next(sub for sub in CFG["subs"] if CFG["internal"]["username"] in sub)
+        cfg = load_setup_cfg()
+        publish_topic: str = next(sub for sub in cfg["subs"] if cfg["internal"]["username"] in sub)
         while True:
             task = None
             try:
-                async with mqtt.Client(**CFG["internal"], protocol=mqtt.ProtocolVersion.V31) as c:
-                    for sub in CFG["subs"]:
+                async with mqtt.Client(**cfg["internal"], protocol=mqtt.ProtocolVersion.V31) as c:
+                    for sub in cfg["subs"]:
                         await c.subscribe(sub, qos=1)
                     await c.publish("void", c.identifier)
                     task = asyncio.create_task(publish_temp_to_mqtt_task(c, publish_topic))
                     async for msg in c.messages:
-                        utils.fire_forget_coro(msg_handler(msg))
+                        utils.fire_forget_coro(self.msg_handler(msg, cfg["current_loc"]))
             except:
                 if task is not None:
                     task.cancel()
@@ -141,6 +224,7 @@ def fire_forget_coro(coro: Coroutine, tasks: set[Task] = set()):
     task.add_done_callback(tasks.discard)
 
 
+@cache
 def load_setup_cfg():
     __import__("sys").path.append("/")  # To import from appdata. "/" for linting
     from os import environ
@@ -193,6 +277,3 @@ async def read_temp() -> float | None:
     except:
         pass
     return None
-
-
-CFG = utils.load_setup_cfg()